@@ -0,0 +1,889 @@
+#!/usr/bin/env python
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Copyright (c) 2016, CJ Kucera
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the development team nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CJ KUCERA BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Benchmarks for choosable.py.  Run from the main directory, like so:
+#
+#     ./benchmark.py render
+#     ./benchmark.py render -f examples/romeo_full.yaml
+#
+# By default, every benchmark is run against all the example books.
+
+import os
+import sys
+import glob
+import time
+import array
+import random
+import argparse
+import threading
+import tempfile
+import py_compile
+import subprocess
+
+import choosable
+
+def best_time(func, repeat=3):
+    """
+    Runs the given function a few times, and returns the fastest time
+    (in seconds) along with the function's last return value.
+    """
+    best = None
+    result = None
+    for i in range(repeat):
+        start_time = time.time()
+        result = func()
+        elapsed = time.time() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+# Words to build synthetic summaries out of
+WORDS = ('sword fight punch kiss poison dagger castle ghost pirate ship '
+    'balcony nurse friar letter duel run hide climb wall garden tomb '
+    'potion robot dinosaur laser moon banquet crown throne skull river '
+    'storm horse knight dance masquerade prince guard escape wedding').split()
+
+def synthetic_book(num_pages, seed=0):
+    """
+    Builds a random book with the given number of pages, for benchmarking
+    things on books much bigger than the examples.  Most pages lead on to
+    one to three later pages, there's a handful of choices leading back,
+    about one page in twenty is an ending, and one in fifty leads to a
+    page we "haven't visited" yet.
+    """
+    rng = random.Random(seed)
+    book = choosable.Book('Synthetic %d' % (num_pages))
+    characters = [book.add_character(name) for name in ['Romeo', 'Juliet', 'Nurse', 'Other']]
+    for pagenum in range(1, num_pages+1):
+        summary = ' '.join([rng.choice(WORDS) for i in range(rng.randint(3, 7))])
+        page = choosable.Page(pagenum,
+            character=rng.choice(characters),
+            summary=summary,
+            canonical=(rng.random() < 0.2),
+            ending=(rng.random() < 0.05))
+        if not page.ending:
+            targets = set()
+            for i in range(rng.randint(1, 3)):
+                if rng.random() < 0.05:
+                    targets.add(rng.randint(1, pagenum))
+                elif rng.random() < 0.02:
+                    targets.add(num_pages + pagenum)
+                elif pagenum < num_pages:
+                    targets.add(rng.randint(pagenum+1, min(num_pages, pagenum+50)))
+            for target in targets:
+                page.add_choice(target, ' '.join([rng.choice(WORDS) for i in range(3)]))
+        book.add_page_obj(page)
+    return book
+
+def write_lines(filename, lines):
+    """
+    Writes the given iterable of lines out to a file
+    """
+    with open(filename, 'w') as df:
+        for line in lines:
+            df.write(line)
+
+def bench_render(filenames, tmpdir):
+    """
+    Compares the built-in layered layout/SVG renderer against
+    Graphviz's "dot" binary.
+    """
+    print('%-25s %10s %10s %10s' % ('Book', 'Built-in', 'dot', 'Speedup'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+
+        def builtin():
+            layout = choosable.LayeredLayout(book).run()
+            write_lines('%s.svg' % (base), layout.svg_lines())
+        (builtin_time, result) = best_time(builtin)
+
+        write_lines('%s.dot' % (base), choosable.dot_lines(book, 'bench'))
+        def graphviz():
+            subprocess.check_call(['dot', '-Tsvg', '%s.dot' % (base), '-o', '%s-dot.svg' % (base)])
+        try:
+            (dot_time, result) = best_time(graphviz)
+            print('%-25s %9.3fs %9.3fs %9.1fx' % (os.path.basename(filename),
+                builtin_time, dot_time, dot_time / builtin_time))
+        except OSError:
+            print('%-25s %9.3fs %10s %10s' % (os.path.basename(filename),
+                builtin_time, 'n/a', 'n/a'))
+
+def bench_layout(filenames, tmpdir):
+    """
+    Compares a full Graphviz layout against an incremental re-render
+    which keeps the previous layout (see GraphvizJobs), after adding one
+    new page to each book.
+    """
+    print('%-25s %10s %12s %10s' % ('Book', 'Full', 'Incremental', 'Speedup'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+        dot_filename = '%s.dot' % (base)
+        if os.path.exists('%s.layout' % (dot_filename)):
+            os.remove('%s.layout' % (dot_filename))
+        jobs = choosable.GraphvizJobs(incremental=True)
+        try:
+            write_lines(dot_filename, choosable.dot_lines(book, 'bench'))
+            full = jobs.start(dot_filename, '%s.svg' % (base), 'svg')[0]
+            full.wait()
+
+            page = book.pages_sorted()[0]
+            new_pagenum = max([pagenum for pagenum in book.pages.keys() if isinstance(pagenum, int)] +
+                [pagenum for pagenum in book.inbound.keys() if isinstance(pagenum, int)]) + 1
+            new_page = choosable.Page(new_pagenum, character=page.character, summary='New page')
+            book.add_page_obj(new_page)
+            page.add_choice(new_page.pagenum, 'To the new page')
+            write_lines(dot_filename, choosable.dot_lines(book, 'bench'))
+            incremental = jobs.start(dot_filename, '%s.svg' % (base), 'svg')[0]
+            incremental.wait()
+        except OSError:
+            print('%-25s %10s %12s %10s' % (os.path.basename(filename), 'n/a', 'n/a', 'n/a'))
+            continue
+        if full.retval != 0 or incremental.retval != 0 or not incremental.pinned:
+            print('%-25s %10s %12s %10s' % (os.path.basename(filename), 'failed', 'failed', 'n/a'))
+            continue
+        print('%-25s %9.3fs %11.3fs %9.1fx' % (os.path.basename(filename),
+            full.elapsed, incremental.elapsed, full.elapsed / incremental.elapsed))
+
+def bench_characters(filenames, tmpdir):
+    """
+    Compares rendering the whole book with Graphviz against rendering
+    each character's storyline as its own file (see --by-character), all
+    at once in parallel.
+    """
+    print('%-25s %10s %14s %10s' % ('Book', 'Whole', 'By character', 'Files'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        engine = choosable.BookEngine(book)
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+        jobs = choosable.GraphvizJobs(incremental=False)
+        try:
+            write_lines('%s.dot' % (base), engine.dot_lines('bench'))
+            start_time = time.time()
+            jobs.start('%s.dot' % (base), '%s.svg' % (base), 'svg')
+            jobs.wait()
+            whole_time = time.time() - start_time
+
+            dot_files = []
+            for (idx, (name, pagenums)) in enumerate(engine.character_pagenums()):
+                dot_files.append('%s_%d.dot' % (base, idx))
+                write_lines(dot_files[-1], engine.dot_lines('bench', pagenums=pagenums))
+            start_time = time.time()
+            for dot_filename in dot_files:
+                jobs.start(dot_filename, '%s.svg' % (dot_filename.split('.')[0]), 'svg')
+            jobs.wait()
+            character_time = time.time() - start_time
+        except OSError:
+            print('%-25s %10s %14s %10s' % (os.path.basename(filename), 'n/a', 'n/a', 'n/a'))
+            continue
+        print('%-25s %9.3fs %13.3fs %10d' % (os.path.basename(filename), whole_time, character_time, len(dot_files)))
+
+def bench_check(filenames, tmpdir):
+    """
+    Compares the time taken to check a book for problems (--check)
+    against the time taken to load it in the first place.
+    """
+    print('%-25s %10s %10s %10s' % ('Book', 'Load', 'Check', 'Overhead'))
+    books = [(os.path.basename(filename), filename) for filename in filenames]
+    big_filename = os.path.join(tmpdir, 'check.yaml')
+    synthetic_book(5000).save(big_filename)
+    books.append(('(5000 synthetic pages)', big_filename))
+    for (name, filename) in books:
+        def load():
+            savedict = choosable.Book.read_savedict(filename)
+            return (savedict, choosable.Book.load_from_dict(savedict))
+        (load_time, (savedict, book)) = best_time(load)
+        (check_time, problems) = best_time(lambda: choosable.lint_book(book, savedict=savedict))
+        print('%-25s %9.3fs %9.3fs %9.1f%%' % (name, load_time, check_time, check_time / load_time * 100))
+
+# Startup time budget, in seconds: how long "import choosable" can take,
+# and how long "choosable.py -d" can take to print its first line of
+# output for STARTUP_BOOK.  The startup benchmark fails if either is
+# exceeded.
+STARTUP_BUDGET = {
+        'import': 0.04,
+        'first output': 0.15,
+    }
+STARTUP_BOOK = os.path.join('examples', 'romeo.yaml')
+
+# Modules which shouldn't be imported unless they're actually needed
+LAZY_MODULES = ['yaml', 'numpy', 'colorama', 'subprocess', 'tempfile']
+
+def first_output_time(args):
+    """
+    Runs the given command, and returns how long it took to print its
+    first line of output, in seconds.
+    """
+    start_time = time.time()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+    process.stdout.readline()
+    elapsed = time.time() - start_time
+    process.communicate()
+    return elapsed
+
+def bench_startup(filenames, tmpdir):
+    """
+    Measures how long it takes to import choosable (using Python's
+    -X importtime), and how long a DOT export takes to get going, and
+    checks them against STARTUP_BUDGET.  Returns False if we're over
+    budget.
+    """
+    # Make sure there's compiled bytecode around to import, like there
+    # would be in a normal install.
+    py_compile.compile('choosable.py')
+
+    def import_times():
+        # Returns a dict of module name to cumulative import time
+        output = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import choosable'],
+            stderr=subprocess.PIPE, universal_newlines=True).communicate()[1]
+        imported = {}
+        for line in output.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[1].strip().isdigit():
+                imported[parts[2].strip()] = int(parts[1]) / 1000000.0
+        return imported
+    runs = [import_times() for i in range(5)]
+    import_best = min([imported['choosable'] for imported in runs])
+    imported = runs[0]
+
+    eager = [module for module in LAZY_MODULES if module in imported]
+    if len(eager) > 0:
+        print('Imported at startup (should be lazy): %s' % (', '.join(eager)))
+
+    dot_filename = os.path.join(tmpdir, 'startup.dot')
+    def dot_time(command, filename):
+        times = []
+        for i in range(5):
+            if os.path.exists(dot_filename):
+                os.remove(dot_filename)
+            times.append(first_output_time([sys.executable] + command + ['-f', filename, '-d', dot_filename]))
+        return min(times)
+
+    # Python never uses compiled bytecode for the script it's running,
+    # so "python -m choosable" starts up a bit faster.
+    results = [('import choosable', import_best, STARTUP_BUDGET['import'])]
+    for filename in sorted(set(filenames + [STARTUP_BOOK])):
+        for command in [['choosable.py'], ['-m', 'choosable']]:
+            if filename == STARTUP_BOOK and command == ['choosable.py']:
+                budget = STARTUP_BUDGET['first output']
+            else:
+                budget = None
+            results.append(('%s -d %s' % (' '.join(command), os.path.basename(filename)),
+                dot_time(command, filename), budget))
+
+    over = False
+    print('%-35s %10s %10s' % ('', 'Time', 'Budget'))
+    for (name, elapsed, budget) in results:
+        if budget is None:
+            print('%-35s %9.3fs' % (name, elapsed))
+        else:
+            status = ''
+            if elapsed > budget:
+                status = ' OVER BUDGET'
+                over = True
+            print('%-35s %9.3fs %9.3fs%s' % (name, elapsed, budget, status))
+    return not over and len(eager) == 0
+
+def bench_collapse(filenames, tmpdir):
+    """
+    Shows how much collapsing linear chains shrinks the DOT graph, and
+    how that affects dot's runtime.
+    """
+    print('%-25s %13s %13s %10s %10s' % ('Book', 'Nodes', 'Choices', 'dot', 'Collapsed'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+
+        chains = choosable.linear_chains(book)
+        removed = sum([len(chain)-1 for chain in chains.values()])
+        num_nodes = len(book.pages) + len([t for t in book.inbound.keys() if t not in book.pages])
+        num_choices = sum([len(sources) for sources in book.inbound.values()])
+
+        times = []
+        for collapse in [False, True]:
+            dot_filename = '%s-%s.dot' % (base, collapse)
+            write_lines(dot_filename, choosable.dot_lines(book, 'bench', collapse=collapse))
+            def graphviz():
+                subprocess.check_call(['dot', '-Tsvg', dot_filename, '-o', '%s.svg' % (dot_filename)])
+            try:
+                (dot_time, result) = best_time(graphviz)
+                times.append('%9.3fs' % (dot_time))
+            except OSError:
+                times.append('n/a')
+
+        print('%-25s %13s %13s %10s %10s' % (os.path.basename(filename),
+            '%d -> %d' % (num_nodes, num_nodes - removed),
+            '%d -> %d' % (num_choices, num_choices - removed),
+            times[0], times[1]))
+
+def bench_compress(filenames, tmpdir):
+    """
+    Compares file sizes and load/save times for plain, gzipped, and
+    xz-compressed books.
+    """
+    print('%-25s %-5s %10s %8s %10s %10s' % ('Book', 'Type', 'Size', 'Ratio', 'Load', 'Save'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+        plain_size = None
+        for extension in ['', '.gz', '.xz']:
+            book_filename = '%s.yaml%s' % (base, extension)
+            (save_time, result) = best_time(lambda: book.save(book_filename))
+            (load_time, result) = best_time(lambda: choosable.Book.load(book_filename))
+            size = os.path.getsize(book_filename)
+            if plain_size is None:
+                plain_size = size
+            print('%-25s %-5s %9.1fk %7.1fx %9.1fms %9.1fms' % (os.path.basename(filename),
+                extension.lstrip('.') or 'yaml', size/1024.0, float(plain_size)/size,
+                load_time*1000, save_time*1000))
+
+def bench_strings(filenames, tmpdir):
+    """
+    Shows how much memory sharing identical summaries saves once a book is
+    loaded, and compares the size and load time of the usual format with
+    the string-table format (see Book.pack_savedict).
+    """
+    print('%-25s %15s %12s %17s %17s' % ('Book', 'Summaries', 'Memory saved', 'Size', 'Load'))
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        summaries = [page.summary for page in book.pages.values()]
+        for page in book.pages.values():
+            summaries.extend([choice.summary for choice in page.choices.values()])
+        distinct = dict([(id(summary), summary) for summary in summaries])
+        saved = sum([sys.getsizeof(summary) for summary in summaries]) - sum([sys.getsizeof(summary) for summary in distinct.values()])
+
+        sizes = []
+        times = []
+        base = os.path.join(tmpdir, os.path.basename(filename).split('.')[0])
+        for string_table in [False, True]:
+            book_filename = '%s-%s.yaml' % (base, string_table)
+            book.string_table = string_table
+            book.save(book_filename)
+            (load_time, result) = best_time(lambda: choosable.Book.load(book_filename))
+            sizes.append(os.path.getsize(book_filename))
+            times.append(load_time)
+
+        print('%-25s %15s %11.1fk %17s %17s' % (os.path.basename(filename),
+            '%d -> %d' % (len(summaries), len(distinct)), saved/1024.0,
+            '%0.1fk -> %0.1fk' % (sizes[0]/1024.0, sizes[1]/1024.0),
+            '%0.1fms -> %0.1fms' % (times[0]*1000, times[1]*1000)))
+
+def bench_digest(filenames, tmpdir):
+    """
+    Times working out a book's digest from scratch, again after changing
+    one page, and when nothing's changed, against building a savedict
+    (which is what we used to compare to spot changes).
+    """
+    print('%-25s %10s %10s %10s %10s' % ('Book', 'Savedict', 'First', 'One page', 'Unchanged'))
+    books = [(os.path.basename(filename), choosable.Book.load(filename)) for filename in filenames]
+    books.append(('(20000 synthetic pages)', synthetic_book(20000)))
+    for (name, book) in books:
+        (savedict_time, savedict) = best_time(book.get_savedict)
+        start_time = time.time()
+        book.digest()
+        first_time = time.time() - start_time
+        page = book.pages_sorted()[0]
+        def change():
+            page.toggle_canonical()
+            return book.digest()
+        (change_time, digest) = best_time(change)
+        (unchanged_time, digest) = best_time(book.digest)
+        print('%-25s %9.2fms %9.2fms %9.3fms %9.3fms' % (name, savedict_time*1000, first_time*1000,
+            change_time*1000, unchanged_time*1000))
+
+def bench_listing(filenames, tmpdir):
+    """
+    Times listing pages on big synthetic books: the first screenful (as
+    the interactive page list shows it), the whole book, and listings
+    filtered by character, flag, page range, and summary text.
+    """
+    import itertools
+    filters = [
+            ('first screen', None),
+            ('everything', {}),
+            ('char:Juliet', {'character': 'Juliet'}),
+            ('canon ending', {'canonical': True, 'ending': True}),
+            ('1000-1100', {'first': 1000, 'last': 1100}),
+            ('unvisited', {'visited': False}),
+            ('text', {'text': WORDS[0]}),
+        ]
+    print('%-14s %-14s %10s %10s' % ('Book', 'Filter', 'Pages', 'Time'))
+    for num_pages in [10000, 100000]:
+        engine = choosable.BookEngine(synthetic_book(num_pages))
+        for (name, filters_used) in filters:
+            if filters_used is None:
+                listing = lambda: list(itertools.islice(engine.listing(), choosable.App.LIST_SIZE))
+            else:
+                listing = lambda: list(engine.listing(**filters_used))
+            (listing_time, results) = best_time(listing)
+            print('%-14s %-14s %10d %9.2fms' % ('%d pages' % (num_pages), name, len(results), listing_time*1000))
+
+def bench_export(filenames, tmpdir):
+    """
+    Times exporting big synthetic books to each graph format, along with
+    the peak memory used while doing so (not counting the book itself).
+    DOT is included for comparison, since it builds up its node list
+    before writing anything.  A small book is exported and read back in
+    first, to make sure that other tools will find its pages and choices
+    (in the right XML namespaces, for GraphML and GEXF).
+    """
+    import json
+    import tracemalloc
+    import xml.etree.ElementTree as ElementTree
+
+    def xml_counts(namespace, nodes_path, edges_path):
+        def counts(filename):
+            root = ElementTree.parse(filename).getroot()
+            ns = {'ns': namespace}
+            return (len(root.findall(nodes_path, ns)), len(root.findall(edges_path, ns)))
+        return counts
+    def json_counts(filename):
+        with open(filename) as df:
+            data = json.load(df)
+        return (len(data['nodes']), len(data['links']))
+    readers = {
+            'graphml': xml_counts('http://graphml.graphdrawing.org/xmlns',
+                'ns:graph/ns:node', 'ns:graph/ns:edge'),
+            'gexf': xml_counts('http://www.gexf.net/1.2draft',
+                'ns:graph/ns:nodes/ns:node', 'ns:graph/ns:edges/ns:edge'),
+            'json': json_counts,
+        }
+    book = synthetic_book(200)
+    expected = (len(choosable.graph_nodes(book)), sum([len(page.choices) for page in book.pages.values()]))
+    for name in sorted(choosable.EXPORT_FORMATS.keys()):
+        filename = os.path.join(tmpdir, 'check.%s' % (name))
+        write_lines(filename, choosable.EXPORT_FORMATS[name](book))
+        found = readers[name](filename)
+        if found != expected:
+            raise Exception('Read %d nodes and %d edges back from %s, expected %d and %d' % (
+                found[0], found[1], name, expected[0], expected[1]))
+
+    formats = [('dot', lambda book: choosable.dot_lines(book, 'bench'))]
+    for name in sorted(choosable.EXPORT_FORMATS.keys()):
+        formats.append((name, choosable.EXPORT_FORMATS[name]))
+
+    print('%-14s %-8s %10s %10s %12s' % ('Book', 'Format', 'Time', 'Size', 'Peak memory'))
+    for num_pages in [10000, 100000]:
+        book = synthetic_book(num_pages)
+        for (name, lines) in formats:
+            filename = os.path.join(tmpdir, 'export.%s' % (name))
+            (export_time, result) = best_time(lambda: write_lines(filename, lines(book)))
+            tracemalloc.start()
+            write_lines(filename, lines(book))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%-14s %-8s %9.2fs %9.1fM %11.2fM' % ('%d pages' % (num_pages), name,
+                export_time, os.path.getsize(filename)/1024.0/1024.0, peak/1024.0/1024.0))
+
+def bench_search(filenames, tmpdir):
+    """
+    Times building the summary search index, updating it, and searching
+    it, on a big synthetic book.
+    """
+    for num_pages in [10000, 100000]:
+        start_time = time.time()
+        book = synthetic_book(num_pages)
+        load_time = time.time() - start_time
+        print('%d pages (built in %0.2fs, including indexing), %d words indexed' % (
+            num_pages, load_time, len(book.search_index.vocabulary)))
+
+        for query in ['s', 'sw', 'swo', 'sword', 'sword f', 'sword fi', 'sword fight kiss']:
+            (search_time, results) = best_time(lambda: book.search(query, limit=25))
+            print('  %-20s %8.2fms %6d results' % ('"%s"' % (query), search_time*1000,
+                len(book.search(query))))
+
+        page = book.pages[num_pages // 2]
+        def update():
+            page.set_summary('a brand new summary about a robot wedding')
+            page.add_choice(num_pages * 3, 'a choice about lasers')
+            page.delete_choice(num_pages * 3)
+        (update_time, result) = best_time(update)
+        print('  %-20s %8.2fms' % ('update', update_time*1000))
+
+def bench_merge(filenames, tmpdir):
+    """
+    Times diffing and three-way merging big synthetic books, where each
+    side has changed a few percent of the pages.
+    """
+    for num_pages in [10000, 50000]:
+        base = synthetic_book(num_pages)
+        savedict = base.get_savedict()
+        ours = choosable.Book.load_from_dict(savedict)
+        theirs = choosable.Book.load_from_dict(savedict)
+        rng = random.Random(1)
+        for (book, name) in [(ours, 'ours'), (theirs, 'theirs')]:
+            character = book.characters['Other']
+            for i in range(num_pages // 50):
+                book.pages[rng.randint(1, num_pages)].set_summary('changed by %s' % (name))
+                book.add_page(num_pages * 3 + i, character=character, summary=name)
+            for i in range(num_pages // 200):
+                pagenum = rng.randint(1, num_pages)
+                if pagenum in book.pages:
+                    book.delete_page(pagenum)
+
+        (diff_time, changes) = best_time(lambda: choosable.diff_books(base, ours))
+        (merge_time, result) = best_time(lambda: choosable.merge_books(base, ours, theirs))
+        print('%d pages: diff %0.2fs (%d changes), merge %0.2fs (%d conflicts)' % (
+            num_pages, diff_time, len(changes), merge_time, len(result[1])))
+
+def bench_reach(filenames, tmpdir):
+    """
+    Times building the index of which endings and unvisited pages can be
+    reached from each page, and keeping it up to date as choices are
+    added, on big synthetic books.
+    """
+    for num_pages in [10000, 100000]:
+        book = synthetic_book(num_pages)
+        start_time = time.time()
+        (endings, unvisited) = book.reachable_counts(1)
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        for i in range(10):
+            book.pages[num_pages // 2 + i].add_choice(num_pages * 5 + i, 'a new choice')
+            book.reachable_counts(1)
+        add_time = (time.time() - start_time) / 10
+
+        print('%d pages: build %0.2fs, add choice %0.1fms (%d endings and %d unvisited reachable from page 1)' % (
+            num_pages, build_time, add_time*1000, endings, unvisited))
+
+def bench_route(filenames, tmpdir):
+    """
+    Times finding the shortest route between pages on big synthetic books
+    """
+    for num_pages in [10000, 100000]:
+        book = synthetic_book(num_pages)
+        unvisited = sorted([target for target in book.inbound.keys() if target not in book.pages])
+        print('%d pages' % (num_pages))
+        for (source, target) in [(1, num_pages // 2), (1, num_pages - 1), (1, unvisited[-1]), (num_pages // 2, 3)]:
+            for prefer_canon in [False, True]:
+                (route_time, route) = best_time(lambda: book.route(source, target, prefer_canon=prefer_canon))
+                if route is None:
+                    length = 'none'
+                else:
+                    length = '%d choices' % (len(route) - 1)
+                print('  %-18s %-8s %8.1fms  %s' % ('%s to %s' % (source, target),
+                    'canon' if prefer_canon else '', route_time*1000, length))
+
+def bench_snapshot(filenames, tmpdir):
+    """
+    Times building a GraphSnapshot of big synthetic books, and compares a
+    breadth-first search over it with one over the book's own page and
+    choice objects.  Path counting is checked on some tiny books first,
+    since it has to refuse to count around loops (including a page with
+    a choice back to itself).
+    """
+    for (choices, expected) in [
+            ([(1, 2), (1, 3), (2, 4), (3, 4)], [1, 1, 1, 2]),
+            ([(1, 2), (2, 2), (2, 3)], None),
+            ([(1, 2), (2, 3), (3, 2)], None),
+        ]:
+        book = choosable.Book('Paths')
+        character = book.add_character('Romeo')
+        for (source, target) in choices:
+            if source not in book.pages:
+                book.add_page(source, character, 'Page %d' % (source))
+            book.pages[source].add_choice(target, 'Go to %d' % (target))
+        snapshot = book.snapshot()
+        try:
+            counts = snapshot.path_counts(snapshot.index[1])
+            counts = [counts[snapshot.index[pagenum]] for pagenum in sorted(snapshot.index.keys())]
+        except Exception:
+            counts = None
+        if counts != expected:
+            raise Exception('Path counts for %s were %s, expected %s' % (choices, counts, expected))
+
+    for num_pages in [10000, 100000]:
+        book = synthetic_book(num_pages)
+
+        def dict_bfs():
+            depth = {1: 0}
+            frontier = [1]
+            while len(frontier) > 0:
+                next_frontier = []
+                for pagenum in frontier:
+                    if pagenum in book.pages:
+                        for target in book.pages[pagenum].choices.keys():
+                            if target not in depth:
+                                depth[target] = depth[pagenum] + 1
+                                next_frontier.append(target)
+                frontier = next_frontier
+            return depth
+
+        (build_time, snapshot) = best_time(lambda: choosable.GraphSnapshot(book))
+        (dict_time, result) = best_time(dict_bfs)
+        (bfs_time, result) = best_time(lambda: snapshot.bfs(snapshot.index[1]))
+        (scc_time, (component, num_components)) = best_time(snapshot.components)
+        size = sum([getattr(snapshot, name).buffer_info()[1] * getattr(snapshot, name).itemsize
+            for name in ['offsets', 'targets', 'in_offsets', 'sources', 'canonical', 'ending', 'character']])
+        print('%d pages: build %0.1fms (%0.1fM of arrays), BFS %0.1fms (objects: %0.1fms), SCC %0.1fms (%d components)' % (
+            num_pages, build_time*1000, size/1024.0/1024.0, bfs_time*1000, dict_time*1000,
+            scc_time*1000, num_components))
+
+def synthetic_snapshot(num_pages, seed=0):
+    """
+    Builds a GraphSnapshot of a random book with the given number of
+    pages directly with NumPy, without building the book itself (which
+    would take minutes at a million pages).  Every page but the endings
+    has one to three choices leading to later pages, anywhere up to
+    twice its own page number, so the book fans out quickly the way a
+    real one does.
+    """
+    choosable.import_numpy()
+    numpy = choosable.numpy
+    rng = numpy.random.RandomState(seed)
+    ending = (rng.random_sample(num_pages) < 0.05).astype(numpy.int8)
+    counts = numpy.where(ending == 1, 0, rng.randint(1, 4, num_pages))
+    counts[-1] = 0
+    sources = numpy.repeat(numpy.arange(num_pages), counts)
+    spans = numpy.minimum(2*sources + 1, num_pages - 1) - sources
+    targets = sources + 1 + (rng.random_sample(sources.size) * spans).astype(numpy.int64)
+    targets = numpy.minimum(targets, num_pages - 1)
+    in_order = numpy.argsort(targets, kind='stable')
+
+    snapshot = choosable.GraphSnapshot.__new__(choosable.GraphSnapshot)
+    snapshot.version = 0
+    snapshot.num_visited = num_pages
+    snapshot.pagenums = list(range(1, num_pages+1))
+    snapshot.index = dict([(pagenum, pagenum-1) for pagenum in snapshot.pagenums])
+    snapshot.characters = ['Romeo', 'Juliet', 'Nurse', 'Other']
+    snapshot.offsets = array.array('i', numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.intc).tobytes())
+    snapshot.targets = array.array('i', targets.astype(numpy.intc).tobytes())
+    snapshot.in_offsets = array.array('i', numpy.concatenate([[0], numpy.cumsum(numpy.bincount(targets, minlength=num_pages))]).astype(numpy.intc).tobytes())
+    snapshot.sources = array.array('i', sources[in_order].astype(numpy.intc).tobytes())
+    snapshot.canonical = array.array('b', (rng.random_sample(num_pages) < 0.2).astype(numpy.int8).tobytes())
+    snapshot.ending = array.array('b', ending.tobytes())
+    snapshot.character = array.array('i', rng.randint(0, 4, num_pages).astype(numpy.intc).tobytes())
+    return snapshot
+
+def bench_report(filenames, tmpdir):
+    """
+    Times the NumPy statistics report (see graph_report) on the example
+    books, and on big synthetic ones.
+    """
+    if not choosable.import_numpy():
+        print('NumPy is not available')
+        return
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        snapshot = book.snapshot()
+        (report_time, report) = best_time(lambda: choosable.graph_report(snapshot))
+        print('%-25s %8.1fms (%d levels deep)' % (os.path.basename(filename), report_time*1000, len(report['depth'])))
+    for num_pages in [100000, 1000000]:
+        start_time = time.time()
+        snapshot = synthetic_snapshot(num_pages)
+        build_time = time.time() - start_time
+        (report_time, report) = best_time(lambda: choosable.graph_report(snapshot))
+        print('%-25s %8.1fms (%d levels deep, snapshot built in %0.2fs)' % ('%d pages' % (num_pages),
+            report_time*1000, len(report['depth']), build_time))
+
+def bench_odds(filenames, tmpdir):
+    """
+    Times working out the Markov-chain reading odds (see reading_odds and
+    reading_outcomes) for every page of the example books, and of big
+    synthetic ones.
+    """
+    for filename in filenames:
+        book = choosable.Book.load(filename)
+        snapshot = book.snapshot()
+        (odds_time, odds) = best_time(lambda: choosable.reading_odds(snapshot))
+        (outcomes_time, (outcomes, length)) = best_time(lambda: choosable.reading_outcomes(snapshot, snapshot.index[1]))
+        print('%-25s %8.1fms every page, %8.1fms from page 1 (%d outcomes)' % (os.path.basename(filename),
+            odds_time*1000, outcomes_time*1000, len(outcomes)))
+    if not choosable.import_numpy():
+        print('NumPy is not available for the synthetic books')
+        return
+    for num_pages in [100000, 1000000]:
+        snapshot = synthetic_snapshot(num_pages)
+        start_time = time.time()
+        choosable.reading_odds(snapshot)
+        odds_time = time.time() - start_time
+        start_time = time.time()
+        (outcomes, length) = choosable.reading_outcomes(snapshot, 0)
+        outcomes_time = time.time() - start_time
+        print('%-25s %8.2fs every page, %8.2fs from page 1 (%0.1f pages per reading)' % (
+            '%d pages' % (num_pages), odds_time, outcomes_time, length))
+
+def http_load(port, requests, clients, per_client):
+    """
+    Hammers the --serve API on the given port with the given number of
+    concurrent keep-alive clients, each making per_client requests.
+    requests is a function taking (client number, request number) and
+    returning a (method, path, JSON body or None) tuple.  Returns the
+    number of requests per second, and a count of the status codes seen.
+    """
+    import json
+    import asyncio
+
+    statuses = {}
+
+    async def client(num):
+        (reader, writer) = await asyncio.open_connection('127.0.0.1', port)
+        for i in range(per_client):
+            (method, path, body) = requests(num, i)
+            if body is None:
+                data = b''
+            else:
+                data = json.dumps(body).encode('utf-8')
+            writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n' % (
+                method, path, len(data))).encode('latin-1') + data)
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    async def main():
+        await asyncio.gather(*[client(num) for num in range(clients)])
+
+    start_time = time.time()
+    asyncio.run(main())
+    return ((clients * per_client) / (time.time() - start_time), statuses)
+
+def bench_serve(filenames, tmpdir):
+    """
+    Load-tests the --serve HTTP API on a big synthetic book, reporting
+    requests per second for reads, and for a mix of reads and changes.
+    The server runs in its own process, like it would for real.
+    """
+    if sys.version_info < (3,):
+        print('Requires Python 3')
+        return
+
+    num_pages = 10000
+    filename = os.path.join(tmpdir, 'serve.yaml')
+    synthetic_book(num_pages).save(filename)
+
+    server = subprocess.Popen([sys.executable, '-u', 'choosable.py', '-f', filename,
+        '-c', 'none', '--serve', '--port', '0'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        port = None
+        while port is None:
+            line = server.stdout.readline()
+            if line == '':
+                print('Server did not start')
+                return
+            if line.startswith('Serving'):
+                port = int(line.split(':')[2].split('/')[0])
+
+        # The server logs every request, so keep reading them
+        drain = threading.Thread(target=lambda: server.stdout.read())
+        drain.daemon = True
+        drain.start()
+
+        def reads(num, i):
+            pagenum = (num * 7919 + i * 104729) % num_pages + 1
+            if i % 4 == 0:
+                return ('GET', '/pages/%d/choices' % (pagenum), None)
+            return ('GET', '/pages/%d' % (pagenum), None)
+
+        def mixed(num, i):
+            # Every ten requests: change a page's summary, add a choice
+            # to it, delete that choice again, and read pages.
+            pagenum = (num * 7919 + (i // 10) * 104729) % num_pages + 1
+            target = num_pages * 2 + num * 1000 + i // 10
+            if i % 10 == 0:
+                return ('PATCH', '/pages/%d' % (pagenum), {'summary': 'updated by client %d' % (num)})
+            elif i % 10 == 1:
+                return ('POST', '/pages/%d/choices' % (pagenum), {'target': target, 'summary': 'new'})
+            elif i % 10 == 2:
+                return ('DELETE', '/pages/%d/choices/%d' % (pagenum, target), None)
+            return reads(num, i)
+
+        print('%d pages' % (num_pages))
+        print('  %-12s %8s %12s  %s' % ('Workload', 'Clients', 'Requests/s', 'Statuses'))
+        for (name, requests) in [('reads', reads), ('mixed', mixed)]:
+            for clients in [1, 10, 50]:
+                (rate, statuses) = http_load(port, requests, clients, 2000 // clients)
+                print('  %-12s %8d %12.0f  %s' % (name, clients, rate,
+                    ', '.join(['%d: %d' % (status, statuses[status]) for status in sorted(statuses.keys())])))
+    finally:
+        server.terminate()
+        server.wait()
+
+BENCHMARKS = {
+        'check': bench_check,
+        'characters': bench_characters,
+        'collapse': bench_collapse,
+        'compress': bench_compress,
+        'digest': bench_digest,
+        'export': bench_export,
+        'layout': bench_layout,
+        'listing': bench_listing,
+        'merge': bench_merge,
+        'odds': bench_odds,
+        'reach': bench_reach,
+        'route': bench_route,
+        'render': bench_render,
+        'report': bench_report,
+        'search': bench_search,
+        'startup': bench_startup,
+        'strings': bench_strings,
+        'serve': bench_serve,
+        'snapshot': bench_snapshot,
+    }
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Chooseable-Path Adventure Tracker Benchmarks')
+    parser.add_argument('benchmark',
+        nargs='*',
+        help='Benchmark(s) to run (defaults to all of them): %s' % (', '.join(sorted(BENCHMARKS.keys()))))
+    parser.add_argument('-f', '--filename',
+        action='append',
+        help='Book file(s) to benchmark against (defaults to examples/*.yaml)')
+    args = parser.parse_args()
+
+    filenames = args.filename
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join('examples', '*.yaml')))
+    benchmarks = args.benchmark
+    if not benchmarks:
+        benchmarks = sorted(BENCHMARKS.keys())
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark "%s"' % (name))
+
+    tmpdir = tempfile.mkdtemp()
+    status = 0
+    for name in benchmarks:
+        print('')
+        print('=== %s ===' % (name))
+        if BENCHMARKS[name](filenames, tmpdir) is False:
+            status = 1
+    print('')
+    sys.exit(status)
@@ -27,16 +27,53 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
+import re
 import sys
-import yaml
+import math
+import stat
+import array
+import time
+import heapq
+import bisect
+import threading
 import argparse
-import itertools
-import subprocess
 
-try:
-    import colorama
-except ImportError:
-    pass
+# Anything which takes a while to import, and which isn't needed every
+# time we run, is imported by whatever needs it, the first time it's
+# needed.  Since we get run from scripts a lot, startup time matters.
+# NumPy and colorama are optional, and are imported by import_numpy()
+# and import_colorama() below.
+colorama = None
+numpy = None
+
+def import_colorama():
+    """
+    Imports colorama, if we haven't already.  Returns True if it's
+    available.
+    """
+    global colorama
+    if colorama is None:
+        try:
+            import colorama as colorama_module
+        except ImportError:
+            return False
+        colorama = colorama_module
+    return True
+
+def import_numpy():
+    """
+    Imports NumPy, if we haven't already.  Returns True if it's
+    available.  NumPy takes longer to import than everything else we
+    use put together, so it's only loaded for the built-in renderer.
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            return False
+        numpy = numpy_module
+    return True
 
 def sortkey_pages(item):
     """
@@ -51,6 +88,1759 @@ def sortkey_pages(item):
     else:
         return item
 
+# Non-numeric page numbers which would clash with the node names we use
+# in our graphviz output (or otherwise confuse it)
+RESERVED_PAGE_PREFIXES = ['char_', 'cluster', 'shape', 'stub_']
+RESERVED_PAGES = ['ending']
+
+def check_pagenum(pagenum):
+    """
+    Checks to see if the given page number is one we can actually use.
+    Returns None if so, or a string describing the problem otherwise.
+    """
+    if isinstance(pagenum, int):
+        return None
+    if ' ' in pagenum:
+        return 'Page numbers cannot contain spaces'
+    for prefix in RESERVED_PAGE_PREFIXES:
+        if pagenum.startswith(prefix):
+            return 'Page numbers cannot start with "%s"' % (prefix)
+    if pagenum in RESERVED_PAGES:
+        return 'Page numbers cannot be "%s"' % (pagenum)
+    return None
+
+def graph_nodes(book, pagenums=None):
+    """
+    Returns a dict describing every node which should show up in a graph
+    of the given book, keyed by page number.  That's all the pages we've
+    visited, plus all the pages which are linked to but which we haven't
+    visited yet.  Each value is a dict with the keys "label", "visited",
+    "canonical", "ending", "fontcolor", and "fillcolor".  Ending pages
+    get their own special colors rather than the character's.  Pass in
+    a set of page numbers to only include those pages.
+    """
+
+    # Set up a structure to hold page definitions simultaneously
+    # for pages we've visited, and pages we haven't.  That way
+    # the "known" path won't veer off the left so much, or at
+    # least if it does so it'll only be by chance instead of
+    # design.
+    all_pages = {}
+
+    # First up - Visited pages!
+    pages = book.pages_sorted(pagenums)
+    for page in pages:
+        node = {
+                'label': 'Page %s - %s' % (page.pagenum, page.summary),
+                'visited': True,
+                'canonical': page.canonical,
+                'ending': page.ending,
+            }
+        if page.ending:
+            node['fontcolor'] = 'white'
+            node['fillcolor'] = 'azure4'
+        else:
+            node['fontcolor'] = page.character.fontcolor
+            node['fillcolor'] = page.character.fillcolor
+        all_pages[page.pagenum] = node
+
+    # Unvisited pages
+    for page in pages:
+        for choice in page.choices_sorted():
+            if choice.target not in book.pages and (pagenums is None or choice.target in pagenums):
+                if choice.target in all_pages:
+                    print('NOTICE: Overwriting existing not-visited link for page %s' % (choice.target))
+                all_pages[choice.target] = {
+                        'label': 'Page %s - %s' % (choice.target, choice.summary),
+                        'visited': False,
+                        'canonical': False,
+                        'ending': False,
+                        'fontcolor': 'black',
+                        'fillcolor': 'white',
+                    }
+
+    return all_pages
+
+def linear_chains(book, pagenums=None):
+    """
+    Finds all the maximal "linear chains" of pages in the book: runs of
+    visited pages where each page has exactly one choice, leading to a
+    page which nothing else links to.  Pages in a chain have to share
+    the same character and canonical status, and endings are left alone,
+    so that collapsing a chain down to one node doesn't lose anything
+    that would show up in a graph.  Returns a dict whose keys are the
+    first page number of each chain (of at least two pages), and whose
+    values are the list of page numbers in that chain.  This is a single
+    pass over the pages and choices.  Pass in a set of page numbers to
+    only look at those pages.
+    """
+
+    def next_link(page):
+        # Returns the page following this one in a chain, if there is one
+        if len(page.choices) != 1 or page.ending:
+            return None
+        target = list(page.choices.keys())[0]
+        if target == page.pagenum or target not in book.pages:
+            return None
+        if pagenums is not None and target not in pagenums:
+            return None
+        if len(book.inbound.get(target, ())) != 1:
+            return None
+        next_page = book.pages[target]
+        if (next_page.ending or
+                next_page.character != page.character or
+                next_page.canonical != page.canonical):
+            return None
+        return next_page
+
+    # Anything which is linked to from a previous page isn't the start
+    # of a chain.
+    links = {}
+    linked_to = set()
+    pages = book.pages_sorted(pagenums)
+    for page in pages:
+        next_page = next_link(page)
+        if next_page is not None:
+            links[page.pagenum] = next_page.pagenum
+            linked_to.add(next_page.pagenum)
+
+    chains = {}
+    for page in pages:
+        if page.pagenum in links and page.pagenum not in linked_to:
+            chain = [page.pagenum]
+            while chain[-1] in links:
+                chain.append(links[chain[-1]])
+            chains[page.pagenum] = chain
+    return chains
+
+def dot_lines(book, graph_name, pagenums=None, title=None, collapse=False, annotations=None):
+    """
+    Generates the Graphviz DOT representation of the given book, one
+    line at a time.  This doesn't touch the filesystem or prompt for
+    anything, so it's usable both from the interactive app and from
+    the non-interactive modes (such as --watch).
+
+    Pass in a set of page numbers to only graph part of the book (see
+    Book.neighborhood).  Choices which cross the edge of that set are
+    drawn as dashed lines to small "stub" markers (which name the other
+    page's character, if it's someone else's), and the work done
+    only depends on the size of the set, not the book.  The title
+    defaults to the book title.
+
+    If collapse is True, each linear chain of pages (see linear_chains)
+    will be drawn as a single node.  annotations can map page numbers to
+    an extra line of text to add to those pages' labels.
+    """
+
+    if title is None:
+        title = book.title
+    nodes = graph_nodes(book, pagenums)
+
+    # Work out which pages are getting collapsed into which.  The first
+    # page in a chain stands in for the whole thing.
+    chain_heads = {}
+    if collapse:
+        for (head, chain) in linear_chains(book, pagenums).items():
+            for pagenum in chain:
+                chain_heads[pagenum] = head
+            nodes[head] = dict(nodes[head])
+            nodes[head]['label'] = 'Pages %s to %s (%d pages) - %s ... %s' % (
+                head, chain[-1], len(chain),
+                book.pages[head].summary, book.pages[chain[-1]].summary)
+            for pagenum in chain[1:]:
+                del nodes[pagenum]
+
+    yield "digraph %s {\n" % (graph_name)
+
+    # Put a big ol' label on the top
+    yield "\n"
+    yield "\tlabelloc=\"t\";\n"
+    yield "\tfontsize=100;\n"
+    yield "\tlabel=\"%s\";\n" % (title.replace('"', '\\"'))
+
+    # Set up a character key
+    yield "\n"
+    yield "\t// Character key\n"
+    charlist = book.characters_sorted()
+    for (idx, char) in enumerate(charlist):
+        yield "\tchar_%d [label=\"%s\" fontsize=20 fontcolor=%s fillcolor=%s style=\"filled\"];\n" % (
+                idx, char.name.replace('"', '\\"'), char.fontcolor, char.fillcolor,
+            )
+    yield "\tending [label=\"Ending Page\" fontsize=20 fontcolor=white fillcolor=azure4 style=\"filled\"];\n"
+    yield "\tsubgraph cluster_charkey {\n"
+    yield "\t\tedge[style=invis];\n"
+    yield "\t\tfontsize = 40;\n"
+    yield "\t\tlabel = \"Character Key\";\n"
+    yield "\t\tstyle = \"filled\";\n"
+    yield "\t\tcolor = \"gray90\";\n"
+    yield "\t\t%s -> ending;\n" % (' -> '.join(['char_%d' % (i) for i in range(len(charlist))]))
+    yield "\t}\n"
+
+    # Aand a shape key
+    if pagenums is None:
+        has_canon = len(book.canonical_pages) > 0
+    else:
+        has_canon = not book.canonical_pages.isdisjoint(pagenums)
+    if has_canon:
+        # No need to have a shape key if there's no canon pages
+        yield "\n"
+        yield "\t// Shape key\n"
+        yield "\tshape_canon [label=\"Square = Canonical Choice\" shape=box fontsize=20 fontcolor=black fillcolor=white style=\"bold,filled\"];\n"
+        yield "\tshape_regular [label=\"Oval = Noncanonical Choice\" fontcolor=black fontsize=20 fillcolor=white style=\"filled\"];\n"
+        yield "\tsubgraph cluster_shapekey {\n"
+        yield "\t\tedge[style=invis];\n"
+        yield "\t\tfontsize = 40;\n"
+        yield "\t\tlabel = \"Shape Key\";\n"
+        yield "\t\tstyle = \"filled\";\n"
+        yield "\t\tcolor = \"gray90\";\n"
+        yield "\t\tshape_canon -> shape_regular;\n"
+        yield "\t}\n"
+
+    # Page nodes, both visited and unvisited
+    all_pages = {}
+    for (pagenum, node) in nodes.items():
+        if node['visited']:
+            label = node['label']
+            if annotations is not None and pagenum in annotations:
+                label = '%s\\n%s' % (label, annotations[pagenum])
+            labelstr = 'label="%s"' % (label.replace('"', '\\"'))
+            styles = ['filled']
+            if node['canonical']:
+                labelstr = '%s shape=box' % (labelstr)
+                styles.append('bold')
+            labelstr = '%s fontcolor=%s fillcolor=%s' % (labelstr,
+                node['fontcolor'],
+                node['fillcolor'])
+            if len(styles) > 0:
+                labelstr = '%s style="%s"' % (labelstr, ','.join(styles))
+        else:
+            labelstr = 'label=<<i>(%s)</i>>' % (node['label'].replace('>', '').replace('<', ''))
+        all_pages[pagenum] = labelstr
+
+    # Now aggregate all our pages together
+    yield "\n"
+    yield "\t// Pages\n"
+    for pagenum in sorted(all_pages.keys(), key=sortkey_pages):
+        yield "\t%s [%s];\n" % (pagenum, all_pages[pagenum])
+
+    # Choices!
+    yield "\n"
+    yield "\t// Choices\n"
+    for page in book.pages_sorted(pagenums):
+        for choice in page.choices_sorted():
+            if pagenums is None or choice.target in pagenums:
+                if page.pagenum in chain_heads:
+                    if (choice.target != chain_heads[page.pagenum] and
+                            chain_heads.get(choice.target) == chain_heads[page.pagenum]):
+                        # Choices inside a chain just disappear
+                        continue
+                    yield "\t%s -> %s;\n" % (chain_heads[page.pagenum], choice.target)
+                else:
+                    yield "\t%s -> %s;\n" % (page.pagenum, choice.target)
+
+    # Stubs for choices which lead out of (or into) the pages we were
+    # asked for.
+    if pagenums is not None:
+        stubs = []
+        for page in book.pages_sorted(pagenums):
+            for choice in page.choices_sorted():
+                if choice.target not in pagenums:
+                    stubs.append((chain_heads.get(page.pagenum, page.pagenum), choice.target, True))
+        for pagenum in sorted(pagenums, key=sortkey_pages):
+            for source in sorted(book.inbound.get(pagenum, ()), key=sortkey_pages):
+                if source not in pagenums:
+                    stubs.append((pagenum, source, False))
+        if len(stubs) > 0:
+            yield "\n"
+            yield "\t// Truncated choices\n"
+            for (idx, (pagenum, other, outgoing)) in enumerate(stubs):
+                label = 'Page %s' % (other)
+                if (other in book.pages and pagenum in book.pages and
+                        book.pages[other].character is not book.pages[pagenum].character):
+                    # A handoff to (or from) another character's storyline
+                    label = '%s (%s)' % (label, book.pages[other].character.name)
+                yield "\tstub_%d [label=\"%s\" shape=plaintext fontcolor=gray40];\n" % (idx, label.replace('"', '\\"'))
+                if outgoing:
+                    yield "\t%s -> stub_%d [style=dashed color=gray40];\n" % (pagenum, idx)
+                else:
+                    yield "\tstub_%d -> %s [style=dashed color=gray40];\n" % (idx, pagenum)
+
+    yield "\n"
+    yield "}\n"
+
+# Node attributes in GraphML/GEXF/JSON exports (besides the label), and
+# their types.  See export_nodes.
+EXPORT_ATTRIBUTES = [
+        ('character', 'string'),
+        ('canonical', 'boolean'),
+        ('visited', 'boolean'),
+        ('ending', 'boolean'),
+        ('intermediate', 'boolean'),
+    ]
+
+def export_nodes(book):
+    """
+    Yields a (pagenum, attributes) tuple for every node in an exported
+    graph: every page we've visited, every page which we've seen a choice
+    for but haven't visited, and every intermediate page.  The attributes
+    dict has a "label" (the page summary, or the summary of a choice
+    leading to the page for unvisited pages) plus everything in
+    EXPORT_ATTRIBUTES.  Unvisited pages have a label and character of
+    None.  Unlike graph_nodes, this walks the book's own dicts rather than
+    building anything up, so it uses the same (small) amount of memory no
+    matter how big the book is.  Nodes come out in no particular order.
+    """
+    for page in book.pages.values():
+        yield (page.pagenum, {
+                'label': page.summary,
+                'character': page.character.name,
+                'canonical': page.canonical,
+                'visited': True,
+                'ending': page.ending,
+                'intermediate': page.pagenum in book.intermediates,
+            })
+    for (target, sources) in book.inbound.items():
+        if target not in book.pages:
+            source = min(sources, key=sortkey_pages)
+            yield (target, {
+                    'label': book.pages[source].choices[target].summary,
+                    'character': None,
+                    'canonical': False,
+                    'visited': False,
+                    'ending': False,
+                    'intermediate': target in book.intermediates,
+                })
+    for pagenum in book.intermediates.keys():
+        if pagenum not in book.pages and pagenum not in book.inbound:
+            yield (pagenum, {
+                    'label': None,
+                    'character': None,
+                    'canonical': False,
+                    'visited': False,
+                    'ending': False,
+                    'intermediate': True,
+                })
+
+def export_edges(book):
+    """
+    Yields a (source, target, summary) tuple for every choice in the book,
+    in no particular order.
+    """
+    for page in book.pages.values():
+        for choice in page.choices.values():
+            yield (page.pagenum, choice.target, choice.summary)
+
+def graphml_lines(book):
+    """
+    Generates a GraphML representation of the given book, one line at a
+    time (see export_nodes).  Choice summaries are stored as edge labels.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<graphml xmlns="http://graphml.graphdrawing.org/xmlns"'
+    yield ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    yield ' xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n'
+    yield '  <key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+    for (name, attr_type) in EXPORT_ATTRIBUTES:
+        yield '  <key id="%s" for="node" attr.name="%s" attr.type="%s"/>\n' % (name, name, attr_type)
+    yield '  <key id="choice" for="edge" attr.name="label" attr.type="string"/>\n'
+    yield '  <graph id="%s" edgedefault="directed">\n' % (xml_escape(book.title))
+    for (pagenum, node) in export_nodes(book):
+        yield '    <node id="%s">\n' % (xml_escape(pagenum))
+        for name in ['label'] + [name for (name, attr_type) in EXPORT_ATTRIBUTES]:
+            value = node[name]
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = str(value).lower()
+            yield '      <data key="%s">%s</data>\n' % (name, xml_escape(value))
+        yield '    </node>\n'
+    for (source, target, summary) in export_edges(book):
+        yield '    <edge source="%s" target="%s"><data key="choice">%s</data></edge>\n' % (
+            xml_escape(source), xml_escape(target), xml_escape(summary))
+    yield '  </graph>\n'
+    yield '</graphml>\n'
+
+def gexf_lines(book):
+    """
+    Generates a GEXF (Gephi) representation of the given book, one line
+    at a time (see export_nodes).  Choice summaries are stored as edge
+    labels.
+    """
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+    yield '  <meta><description>%s</description></meta>\n' % (xml_escape(book.title))
+    yield '  <graph defaultedgetype="directed" mode="static">\n'
+    yield '    <attributes class="node">\n'
+    for (name, attr_type) in EXPORT_ATTRIBUTES:
+        yield '      <attribute id="%s" title="%s" type="%s"/>\n' % (name, name, attr_type)
+    yield '    </attributes>\n'
+    yield '    <nodes>\n'
+    for (pagenum, node) in export_nodes(book):
+        if node['label'] is None:
+            yield '      <node id="%s" label="%s">\n' % (xml_escape(pagenum), xml_escape(pagenum))
+        else:
+            yield '      <node id="%s" label="%s">\n' % (xml_escape(pagenum), xml_escape(node['label']))
+        yield '        <attvalues>\n'
+        for (name, attr_type) in EXPORT_ATTRIBUTES:
+            value = node[name]
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = str(value).lower()
+            yield '          <attvalue for="%s" value="%s"/>\n' % (name, xml_escape(value))
+        yield '        </attvalues>\n'
+        yield '      </node>\n'
+    yield '    </nodes>\n'
+    yield '    <edges>\n'
+    for (idx, (source, target, summary)) in enumerate(export_edges(book)):
+        yield '      <edge id="%d" source="%s" target="%s" label="%s"/>\n' % (
+            idx, xml_escape(source), xml_escape(target), xml_escape(summary))
+    yield '    </edges>\n'
+    yield '  </graph>\n'
+    yield '</gexf>\n'
+
+def json_graph_lines(book):
+    """
+    Generates a node-link JSON representation of the given book (the
+    format used by NetworkX's node_link_graph and D3), one node or link
+    per line (see export_nodes).
+    """
+    import json
+
+    # json.dumps() sets up a new encoder every time it's called with any
+    # options, so hang on to one of our own.
+    encode = json.JSONEncoder(sort_keys=True).encode
+
+    yield '{"directed": true, "multigraph": false, "graph": %s,\n' % (encode({'name': book.title}))
+    yield '"nodes": [\n'
+    separator = ''
+    for (pagenum, node) in export_nodes(book):
+        node['id'] = pagenum
+        yield '%s%s' % (separator, encode(node))
+        separator = ',\n'
+    yield '\n],\n'
+    yield '"links": [\n'
+    separator = ''
+    for (source, target, summary) in export_edges(book):
+        yield '%s%s' % (separator, encode({'source': source, 'target': target, 'label': summary}))
+        separator = ',\n'
+    yield '\n]}\n'
+
+# Graph formats we can export to (other than DOT), by file extension
+EXPORT_FORMATS = {
+        'graphml': graphml_lines,
+        'gexf': gexf_lines,
+        'json': json_graph_lines,
+    }
+
+# Compressed book file extensions, and the compression levels we save
+# them with.  gzip's default of 9 is a lot slower than 6 for hardly any
+# gain on YAML.
+BOOK_COMPRESSION = {
+        '.gz': 6,
+        '.xz': 6,
+    }
+
+def compressed_stream(filename, fileobj, mode):
+    """
+    If the given filename is a compressed book (see BOOK_COMPRESSION),
+    wraps the given binary file object in a stream which compresses or
+    decompresses it on the fly, using gzip or lzma, and returns that.
+    mode should be "rb" or "wb".  Returns None for uncompressed books.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.gz':
+        import gzip
+        # An mtime of 0 (and no filename) means saving the same book twice
+        # gives identical files
+        return gzip.GzipFile(filename='', mode=mode, fileobj=fileobj,
+            compresslevel=BOOK_COMPRESSION[extension], mtime=0)
+    elif extension == '.xz':
+        try:
+            import lzma
+        except ImportError:
+            raise Exception('xz-compressed books require Python 3')
+        if mode.startswith('w'):
+            return lzma.LZMAFile(fileobj, mode=mode, preset=BOOK_COMPRESSION[extension])
+        else:
+            return lzma.LZMAFile(fileobj, mode=mode)
+    else:
+        return None
+
+def replace_file(source, dest):
+    """
+    Moves the file at source on top of dest.  os.replace() is atomic
+    (on the same filesystem) but only exists on Python 3.3+, so fall
+    back to os.rename() for python2, which is atomic on POSIX but will
+    complain on Windows if the destination already exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source, dest)
+    else:
+        os.rename(source, dest)
+
+def read_plain_layout(filename):
+    """
+    Reads the node positions out of a layout Graphviz has written in its
+    "plain" format (-Tplain), which we keep around after renders (see
+    GraphvizJobs).  Returns a dict mapping node names to (x, y, width)
+    tuples, in points, or None if there's no usable layout there.
+    """
+    import shlex
+    if not os.path.exists(filename):
+        return None
+    positions = {}
+    try:
+        with open(filename) as df:
+            for line in df:
+                if not line.startswith('node '):
+                    continue
+                if line.startswith('node "'):
+                    parts = shlex.split(line)
+                else:
+                    parts = line.split(None, 5)
+                positions[parts[1]] = (float(parts[2]) * 72, float(parts[3]) * 72, float(parts[4]) * 72)
+    except (IOError, ValueError, IndexError):
+        return None
+    if len(positions) == 0:
+        return None
+    return positions
+
+# Node and choice statements in the DOT files we generate (see dot_lines).
+# The character and shape key choices are indented further, and ignored.
+DOT_NODE_RE = re.compile(r'^\t([^\s\[]+) \[')
+DOT_EDGE_RE = re.compile(r'^\t([^\s]+) -> ([^\s;\[]+)')
+
+def pin_layout(dot_text, positions):
+    """
+    Takes the text of a DOT file we've generated (see dot_lines) and a
+    previous layout (see read_plain_layout), and gives every node a fixed
+    position, so that neato -n can draw it without laying it out again.
+    Nodes which were in the old layout stay where they were.  New ones
+    are put a rank below the nodes whose choices lead to them (or a rank
+    above the nodes they lead to), shuffled sideways until they're clear
+    of anything else on that rank, and anything left over goes in a row
+    underneath the whole graph.  Returns a tuple of the new DOT text, the
+    number of nodes, and the number of those which were newly placed.
+    """
+    nodes = []
+    neighbors = {}
+    for line in dot_text.splitlines():
+        match = DOT_EDGE_RE.match(line)
+        if match:
+            (source, target) = match.groups()
+            neighbors.setdefault(target, []).append((source, -1))
+            neighbors.setdefault(source, []).append((target, 1))
+            continue
+        match = DOT_NODE_RE.match(line)
+        if match:
+            nodes.append(match.group(1))
+
+    placed = {}
+    for node in nodes:
+        if node in positions:
+            placed[node] = positions[node]
+    if len(placed) == 0:
+        return (dot_text, len(nodes), len(nodes))
+
+    # Spacing between ranks is whatever the old layout mostly used, and
+    # the sideways spacing is a bit more than the average node width.
+    heights = sorted(set([round(y, 1) for (x, y, width) in placed.values()]))
+    gaps = sorted([b - a for (a, b) in zip(heights, heights[1:])])
+    if len(gaps) > 0:
+        rank_gap = gaps[len(gaps)//2]
+    else:
+        rank_gap = 72.0
+    spacing = sum([width for (x, y, width) in placed.values()]) / len(placed) + 18
+
+    ranks = {}
+    for (x, y, width) in placed.values():
+        ranks.setdefault(int(round(y / rank_gap)), []).append(x)
+
+    def place(node, x, y):
+        rank = int(round(y / rank_gap))
+        taken = ranks.setdefault(rank, [])
+        for step in range(len(taken) + 1):
+            for offset in (step, -step):
+                candidate = x + offset * spacing
+                if all([abs(candidate - other) >= spacing for other in taken]):
+                    taken.append(candidate)
+                    placed[node] = (candidate, rank * rank_gap, spacing)
+                    return
+
+    # Work outwards from the nodes we already know about, so that runs of
+    # new pages follow on from each other.
+    new_nodes = set([node for node in nodes if node not in placed])
+    queue = [node for node in nodes if node in new_nodes and
+        any([other in placed for (other, direction) in neighbors.get(node, [])])]
+    while len(queue) > 0:
+        next_queue = []
+        for node in queue:
+            if node in placed:
+                continue
+            known = [(placed[other], direction) for (other, direction) in neighbors.get(node, []) if other in placed]
+            parents = [position for (position, direction) in known if direction < 0]
+            if len(parents) > 0:
+                y = min([position[1] for position in parents]) - rank_gap
+            else:
+                parents = [position for (position, direction) in known]
+                y = max([position[1] for position in parents]) + rank_gap
+            place(node, sum([position[0] for position in parents]) / len(parents), y)
+            next_queue.extend([other for (other, direction) in neighbors.get(node, []) if other not in placed])
+        queue = next_queue
+    bottom = min([y for (x, y, width) in placed.values()]) - 2 * rank_gap
+    left = min([x for (x, y, width) in placed.values()])
+    for node in nodes:
+        if node not in placed:
+            place(node, left, bottom)
+
+    # Tacking extra node statements on to the end adds the positions to
+    # the nodes already defined.
+    pins = ['\t%s [pos="%0.2f,%0.2f"];\n' % (node, placed[node][0], placed[node][1]) for node in nodes]
+    body = dot_text.rstrip()
+    if body.endswith('}'):
+        body = body[:-1]
+    return ('%s\n\t// Positions from the previous layout\n%s}\n' % (body, ''.join(pins)), len(nodes), len(new_nodes))
+
+class GraphvizJob(object):
+    """
+    A single run of the Graphviz "dot" binary, running in the background.
+    Output is written to a temporary file and only moved into place once
+    dot finishes successfully, so a cancelled or failed run never leaves a
+    half-written image behind for whatever's viewing the file.
+
+    If layout_file is given, the layout is saved there as well (in
+    Graphviz's "plain" format).  If pinned is set, the DOT file already
+    has every node's position in it (see pin_layout), and it's drawn
+    with "neato -n" instead, which skips laying the graph out.
+    """
+
+    def __init__(self, dot_filename, out_file, export_type, layout_file=None, pinned=False):
+
+        self.dot_filename = dot_filename
+        self.out_file = out_file
+        self.export_type = export_type
+        self.tmp_file = '%s.tmp' % (out_file)
+        self.layout_file = layout_file
+        self.layout_tmp_file = '%s.layout.tmp' % (out_file)
+        self.pinned = pinned
+        self.new_nodes = None
+        self.process = None
+        self.retval = None
+        self.start_time = None
+        self.elapsed = None
+
+    def start(self):
+        """
+        Launches dot and returns ourselves.  Will raise an OSError if
+        the dot binary can't be found.
+        """
+        import subprocess
+        if self.pinned:
+            command = ['neato', '-n']
+        else:
+            command = ['dot']
+        command.extend(['-T%s' % (self.export_type.lower()),
+            self.dot_filename,
+            '-o', self.tmp_file])
+        if self.layout_file is not None:
+            command.extend(['-Tplain', '-o', self.layout_tmp_file])
+        self.start_time = time.time()
+        self.process = subprocess.Popen(command)
+        return self
+
+    def poll(self):
+        """
+        Returns None if dot is still running, or its return value if it's
+        finished.  If it finished successfully, the output file will have
+        been moved into place by the time this returns.
+        """
+        if self.retval is None:
+            retval = self.process.poll()
+            if retval is not None:
+                self.finish(retval)
+        return self.retval
+
+    def wait(self):
+        """
+        Waits for dot to finish, and returns its return value.
+        """
+        if self.retval is None:
+            self.finish(self.process.wait())
+        return self.retval
+
+    def finish(self, retval):
+        """
+        Cleans up after dot has exited with the given return value.
+        """
+        self.retval = retval
+        self.elapsed = time.time() - self.start_time
+        if retval == 0 and os.path.exists(self.tmp_file):
+            replace_file(self.tmp_file, self.out_file)
+        elif os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+        if retval == 0 and self.layout_file is not None and os.path.exists(self.layout_tmp_file):
+            replace_file(self.layout_tmp_file, self.layout_file)
+        elif os.path.exists(self.layout_tmp_file):
+            os.remove(self.layout_tmp_file)
+
+    def cancel(self):
+        """
+        Kills dot if it's still running.  Nothing gets written to our
+        output file.
+        """
+        if self.retval is None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+            self.retval = -1
+            self.elapsed = time.time() - self.start_time
+            for filename in [self.tmp_file, self.layout_tmp_file]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        else:
+            self.poll()
+
+class GraphvizJobs(object):
+    """
+    Keeps track of the GraphvizJobs we've got running in the background,
+    keyed by output file.  Starting a new job for a file which already
+    has one running will cancel the old one, since its output would be
+    out of date anyway.
+
+    If incremental is set, each render also saves its layout next to the
+    DOT file (as DOTFILE.layout), and later renders of the same DOT file
+    reuse it: pages keep their old positions, new pages are slotted in
+    near the pages they're connected to (see pin_layout), and the whole
+    thing is drawn without laying it out again.  If more than
+    MAX_NEW_NODES of the graph is new, it gets a full layout instead.
+    """
+
+    MAX_NEW_NODES = 0.25
+
+    def __init__(self, incremental=True):
+
+        self.jobs = {}
+        self.incremental = incremental
+
+        # How long the last full layout of each layout file took, so that
+        # incremental renders can be compared against it.
+        self.full_times = {}
+
+    def start(self, dot_filename, out_file, export_type):
+        """
+        Starts rendering dot_filename to out_file in the background.
+        Returns a tuple of the new job and the job it superseded (or
+        None).  Will raise an OSError if dot can't be found.
+        """
+        superseded = None
+        if out_file in self.jobs:
+            old_job = self.jobs.pop(out_file)
+            if old_job.poll() is None:
+                old_job.cancel()
+                superseded = old_job
+
+        layout_file = None
+        new_nodes = None
+        render_filename = dot_filename
+        if self.incremental:
+            layout_file = '%s.layout' % (dot_filename)
+            positions = read_plain_layout(layout_file)
+            if positions is not None:
+                with open(dot_filename) as df:
+                    (pinned_text, num_nodes, new_nodes) = pin_layout(df.read(), positions)
+                if new_nodes <= num_nodes * GraphvizJobs.MAX_NEW_NODES:
+                    render_filename = '%s.pinned' % (dot_filename)
+                    tmp_filename = '%s.tmp' % (render_filename)
+                    with open(tmp_filename, 'w') as df:
+                        df.write(pinned_text)
+                    replace_file(tmp_filename, render_filename)
+
+        job = GraphvizJob(render_filename, out_file, export_type,
+            layout_file=layout_file, pinned=(render_filename != dot_filename))
+        if job.pinned:
+            job.new_nodes = new_nodes
+        job.start()
+        self.jobs[out_file] = job
+        return (job, superseded)
+
+    def running(self):
+        """
+        Returns a list of the jobs which are still running
+        """
+        return [self.jobs[out_file] for out_file in sorted(self.jobs.keys()) if self.jobs[out_file].poll() is None]
+
+    def finished(self):
+        """
+        Returns a list of the jobs which have finished since the last
+        time we were asked, and forgets about them.
+        """
+        finished = []
+        for out_file in sorted(self.jobs.keys()):
+            if self.jobs[out_file].poll() is not None:
+                job = self.jobs.pop(out_file)
+                if job.retval == 0 and job.layout_file is not None and not job.pinned:
+                    self.full_times[job.layout_file] = job.elapsed
+                finished.append(job)
+        return finished
+
+    def wait(self):
+        """
+        Waits for all running jobs to finish
+        """
+        for job in self.jobs.values():
+            job.wait()
+
+    def cancel(self):
+        """
+        Cancels all running jobs
+        """
+        for job in self.jobs.values():
+            job.cancel()
+        self.jobs = {}
+
+class SearchIndex(object):
+    """
+    An inverted index over bits of text (page and choice summaries, in
+    practice), for quick searching.  Text is split into lowercase
+    alphanumeric words, and every query word also matches any indexed
+    word it's a prefix of, so searches work while you're still typing.
+    Documents can be any hashable ID, and can be added and removed at
+    will, so the index can be kept up to date as the book changes.
+    """
+
+    WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+    # How much a prefix match counts for, compared to a whole-word match
+    PREFIX_WEIGHT = 0.5
+
+    def __init__(self):
+
+        # word -> {docid: count}
+        self.postings = {}
+
+        # docid -> {word: count}, so that we know what to remove later
+        self.documents = {}
+
+        # Sorted list of all the words we know about, for prefix lookups
+        self.vocabulary = []
+
+    @staticmethod
+    def tokenize(text):
+        """
+        Splits some text up into a list of case-folded words
+        """
+        if text is None:
+            return []
+        if hasattr(text, 'casefold'):
+            text = text.casefold()
+        else:
+            text = text.lower()
+        return SearchIndex.WORD_RE.findall(text)
+
+    def add(self, docid, text):
+        """
+        Adds (or replaces) the text for the given document ID
+        """
+        if docid in self.documents:
+            self.remove(docid)
+        counts = {}
+        for word in SearchIndex.tokenize(text):
+            counts[word] = counts.get(word, 0) + 1
+        self.documents[docid] = counts
+        for (word, count) in counts.items():
+            if word not in self.postings:
+                self.postings[word] = {}
+                bisect.insort(self.vocabulary, word)
+            self.postings[word][docid] = count
+
+    def remove(self, docid):
+        """
+        Removes the given document ID from the index, if it's there.
+        """
+        if docid not in self.documents:
+            return
+        for word in self.documents.pop(docid).keys():
+            postings = self.postings[word]
+            del postings[docid]
+            if len(postings) == 0:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+
+    def search(self, query, limit=None, accept=None):
+        """
+        Returns a list of (score, docid) tuples for every document which
+        matches all the words in the query (either exactly or as a
+        prefix), best matches first.  Rarer words count for more.  Pass
+        in a function as accept to filter documents by ID, and a limit
+        to only return that many results.
+        """
+        terms = SearchIndex.tokenize(query)
+        if len(terms) == 0:
+            return []
+
+        scores = None
+        for term in terms:
+
+            # Every known word starting with this term, and its best score
+            # in each document.
+            term_scores = {}
+            idx = bisect.bisect_left(self.vocabulary, term)
+            while idx < len(self.vocabulary) and self.vocabulary[idx].startswith(term):
+                word = self.vocabulary[idx]
+                postings = self.postings[word]
+                weight = math.log(1.0 + float(len(self.documents)) / len(postings))
+                if word != term:
+                    weight *= SearchIndex.PREFIX_WEIGHT
+                for (docid, count) in postings.items():
+                    score = count * weight
+                    if score > term_scores.get(docid, 0):
+                        term_scores[docid] = score
+                idx += 1
+
+            # Only keep documents matching all the terms so far
+            if scores is None:
+                scores = term_scores
+            else:
+                if len(term_scores) > len(scores):
+                    (smaller, larger) = (scores, term_scores)
+                else:
+                    (smaller, larger) = (term_scores, scores)
+                scores = dict([(docid, score + larger[docid]) for (docid, score) in smaller.items() if docid in larger])
+            if len(scores) == 0:
+                return []
+
+        results = scores.items()
+        if accept is not None:
+            results = [(docid, score) for (docid, score) in results if accept(docid)]
+        if limit is None:
+            return sorted([(score, docid) for (docid, score) in results], key=lambda result: -result[0])
+        else:
+            return heapq.nlargest(limit, [(score, docid) for (docid, score) in results], key=lambda result: result[0])
+
+class ReachabilityIndex(object):
+    """
+    Keeps track of which ending pages, and which choices we haven't
+    followed yet, can be reached from each page in a book.  Each of those
+    interesting pages gets a bit number, and the set of them reachable
+    from any page is stored as a plain int bitset, so merging sets is
+    just an OR.
+
+    The whole index is built by condensing the book's strongly-connected
+    components (loops in the story) and working back from the last pages
+    to the first, so each choice is only looked at once.  Adding pages,
+    choices, or endings is handled incrementally, by pushing the new bits
+    backwards through the pages which link there.  Anything which could
+    make pages *less* reachable just marks the index as out of date, and
+    it gets rebuilt the next time somebody asks.
+    """
+
+    def __init__(self, book):
+
+        self.book = book
+        self.dirty = True
+        self.bits = {}
+        self.reach = {}
+        self.ending_mask = 0
+        self.unvisited_mask = 0
+
+    def invalidate(self):
+        """
+        Marks the index as needing a rebuild
+        """
+        self.dirty = True
+
+    def add_bit(self, pagenum):
+        """
+        Gives the specified page a bit, if it doesn't have one already,
+        and returns it.
+        """
+        if pagenum not in self.bits:
+            self.bits[pagenum] = 1 << len(self.bits)
+        return self.bits[pagenum]
+
+    def rebuild(self):
+        """
+        Rebuilds the whole index, using Tarjan's algorithm to find the
+        strongly-connected components.  Tarjan finds each component only
+        after everything reachable from it, so we can fill in our sets as
+        we go.  This is written without recursion so that long runs of
+        pages don't hit Python's recursion limit.
+        """
+        pages = self.book.pages
+        self.bits = {}
+        self.reach = {}
+        self.ending_mask = 0
+        self.unvisited_mask = 0
+        for page in pages.values():
+            if page.ending:
+                self.ending_mask |= self.add_bit(page.pagenum)
+            for target in page.choices.keys():
+                if target not in pages:
+                    self.unvisited_mask |= self.add_bit(target)
+
+        def successors(pagenum):
+            if pagenum in pages:
+                return iter(pages[pagenum].choices.keys())
+            return iter(())
+
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        for root in pages.keys():
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, successors(root))]
+            while len(work) > 0:
+                (pagenum, targets) = work[-1]
+                for target in targets:
+                    if target not in index:
+                        index[target] = low[target] = len(index)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target, successors(target)))
+                        break
+                    elif target in on_stack:
+                        low[pagenum] = min(low[pagenum], index[target])
+                else:
+                    work.pop()
+                    if len(work) > 0:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[pagenum])
+                    if low[pagenum] == index[pagenum]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == pagenum:
+                                break
+                        members = set(component)
+                        reach = 0
+                        for member in component:
+                            reach |= self.bits.get(member, 0)
+                            for target in successors(member):
+                                if target not in members:
+                                    reach |= self.reach[target]
+                        for member in component:
+                            self.reach[member] = reach
+
+        self.dirty = False
+
+    def propagate(self, pagenum, bits):
+        """
+        Adds the given bits to the specified page, and to every page
+        which can reach it.
+        """
+        queue = [pagenum]
+        while len(queue) > 0:
+            pagenum = queue.pop()
+            reach = self.reach.get(pagenum, 0)
+            if reach | bits != reach:
+                self.reach[pagenum] = reach | bits
+                queue.extend(self.book.inbound.get(pagenum, ()))
+
+    def page_added(self, page):
+        """
+        Called when a page is added to the book (before its choices are)
+        """
+        if self.dirty:
+            return
+        if page.pagenum in self.bits:
+            self.unvisited_mask &= ~self.bits[page.pagenum]
+        if page.ending:
+            self.ending_changed(page)
+
+    def choice_added(self, page, choice):
+        """
+        Called when a choice is added to a page in the book
+        """
+        if self.dirty:
+            return
+        if choice.target not in self.book.pages:
+            bit = self.add_bit(choice.target)
+            self.unvisited_mask |= bit
+            self.reach[choice.target] = self.reach.get(choice.target, 0) | bit
+        self.propagate(page.pagenum, self.reach.get(choice.target, 0))
+
+    def ending_changed(self, page):
+        """
+        Called when a page in the book has been marked (or unmarked) as
+        an ending
+        """
+        if self.dirty:
+            return
+        if page.ending:
+            bit = self.add_bit(page.pagenum)
+            self.ending_mask |= bit
+            self.propagate(page.pagenum, bit)
+        elif page.pagenum in self.bits:
+            self.ending_mask &= ~self.bits[page.pagenum]
+
+    def counts(self, pagenum):
+        """
+        Returns a tuple of the number of ending pages, and the number of
+        choices we haven't followed yet, which can be reached from the
+        specified page (including the page itself).
+        """
+        if self.dirty:
+            self.rebuild()
+        reach = self.reach.get(pagenum, 0)
+        return (bin(reach & self.ending_mask).count('1'),
+            bin(reach & self.unvisited_mask).count('1'))
+
+class GraphSnapshot(object):
+    """
+    A frozen copy of a book's page graph, flattened into arrays of ints so
+    that graph algorithms don't have to go through page objects, dicts,
+    and hashing for every choice.  Get one from Book.snapshot(), which
+    only rebuilds it after the book has changed.
+
+    Every node (the visited pages in page order, followed by the pages
+    we've only seen choices for) gets a dense index, and pagenums[idx] /
+    index[pagenum] map between the two.  The choices out of node idx lead
+    to targets[offsets[idx]:offsets[idx+1]] (compressed sparse row), and
+    the choices into it come from sources[in_offsets[idx]:in_offsets[idx+1]].
+    Visited pages come first, so node idx has been visited if idx is less
+    than num_visited.  canonical and ending are parallel arrays of 0/1
+    flags, and character holds an index into characters (or -1 for
+    unvisited pages).
+    """
+
+    def __init__(self, book):
+
+        self.version = book.version
+        pages = book.pages_sorted()
+        self.num_visited = len(pages)
+        self.pagenums = [page.pagenum for page in pages]
+        self.pagenums.extend(sorted([target for target in book.inbound.keys() if target not in book.pages],
+            key=sortkey_pages))
+        self.index = dict([(pagenum, idx) for (idx, pagenum) in enumerate(self.pagenums)])
+        self.characters = sorted(book.characters.keys())
+        num_nodes = len(self.pagenums)
+
+        # Everything's built up in lists first, since they're quicker to
+        # work with than arrays, and then packed into arrays at the end.
+        char_index = dict([(name, idx) for (idx, name) in enumerate(self.characters)])
+        index = self.index
+        offsets = [0]
+        targets = []
+        edge_sources = []
+        for (idx, page) in enumerate(pages):
+            targets.extend([index[target] for target in page.choices.keys()])
+            edge_sources.extend([idx] * len(page.choices))
+            offsets.append(len(targets))
+        offsets.extend([len(targets)] * (num_nodes - self.num_visited))
+        self.offsets = array.array('i', offsets)
+        self.targets = array.array('i', targets)
+
+        self.canonical = array.array('b', [page.canonical for page in pages])
+        self.ending = array.array('b', [page.ending for page in pages])
+        self.character = array.array('i', [char_index.get(page.character.name, -1) for page in pages])
+        unvisited = num_nodes - self.num_visited
+        self.canonical.extend([0] * unvisited)
+        self.ending.extend([0] * unvisited)
+        self.character.extend([-1] * unvisited)
+
+        # The reverse graph, built with a counting sort on the targets
+        counts = [0] * (num_nodes + 1)
+        for target in targets:
+            counts[target+1] += 1
+        for idx in range(num_nodes):
+            counts[idx+1] += counts[idx]
+        self.in_offsets = array.array('i', counts)
+        sources = [0] * len(targets)
+        for (target, source) in zip(targets, edge_sources):
+            sources[counts[target]] = source
+            counts[target] += 1
+        self.sources = array.array('i', sources)
+
+    def __len__(self):
+        return len(self.pagenums)
+
+    def successors(self, idx):
+        """
+        Returns the node indexes which node idx has choices leading to
+        """
+        return self.targets[self.offsets[idx]:self.offsets[idx+1]]
+
+    def predecessors(self, idx):
+        """
+        Returns the node indexes which have choices leading to node idx
+        """
+        return self.sources[self.in_offsets[idx]:self.in_offsets[idx+1]]
+
+    def bfs(self, source, reverse=False):
+        """
+        Returns an array of the number of choices it takes to get to each
+        node from node index source (or -1 if it can't be reached).  Pass
+        reverse to follow choices backwards instead, giving the distance
+        from each node to source.
+        """
+        if reverse:
+            (offsets, targets) = (self.in_offsets, self.sources)
+        else:
+            (offsets, targets) = (self.offsets, self.targets)
+        depth = array.array('i', [-1]) * len(self.pagenums)
+        depth[source] = 0
+        frontier = [source]
+        level = 0
+        while len(frontier) > 0:
+            level += 1
+            next_frontier = []
+            for idx in frontier:
+                for target in targets[offsets[idx]:offsets[idx+1]]:
+                    if depth[target] < 0:
+                        depth[target] = level
+                        next_frontier.append(target)
+            frontier = next_frontier
+        return depth
+
+    def reachable(self, source):
+        """
+        Returns the set of node indexes which can be reached from node
+        index source (including itself)
+        """
+        return set([idx for (idx, depth) in enumerate(self.bfs(source)) if depth >= 0])
+
+    def components(self, ignore=None):
+        """
+        Finds the strongly-connected components (loops in the story)
+        using Tarjan's algorithm, without recursion.  Returns a tuple of
+        an array giving each node's component number, and the number of
+        components.  Components are numbered in reverse topological
+        order: every choice leads to a component with the same or a
+        lower number.  If ignore is given, choices out of any node idx
+        with ignore[idx] set are left out, as if it had none.
+        """
+        (offsets, targets) = (self.offsets, self.targets)
+        num_nodes = len(self.pagenums)
+        order = array.array('i', [-1]) * num_nodes
+        low = array.array('i', [0]) * num_nodes
+        component = array.array('i', [-1]) * num_nodes
+        stack = []
+        counter = 0
+        num_components = 0
+        for root in range(num_nodes):
+            if order[root] >= 0:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            work = [(root, offsets[root])]
+            while len(work) > 0:
+                (idx, pos) = work[-1]
+                if ignore is not None and ignore[idx]:
+                    end = pos
+                else:
+                    end = offsets[idx+1]
+                while pos < end:
+                    target = targets[pos]
+                    pos += 1
+                    if order[target] < 0:
+                        work[-1] = (idx, pos)
+                        order[target] = low[target] = counter
+                        counter += 1
+                        stack.append(target)
+                        work.append((target, offsets[target]))
+                        break
+                    elif component[target] < 0 and order[target] < low[idx]:
+                        low[idx] = order[target]
+                else:
+                    work.pop()
+                    if len(work) > 0:
+                        parent = work[-1][0]
+                        if low[idx] < low[parent]:
+                            low[parent] = low[idx]
+                    if low[idx] == order[idx]:
+                        while True:
+                            member = stack.pop()
+                            component[member] = num_components
+                            if member == idx:
+                                break
+                        num_components += 1
+        return (component, num_components)
+
+    def path_counts(self, source):
+        """
+        Returns a list of the number of different ways of getting from
+        node index source to each node (0 for nodes which can't be
+        reached).  Ways which go round a loop could be counted forever,
+        so raises an Exception if there's a loop reachable from source.
+        """
+        (component, num_components) = self.components()
+        reached = self.bfs(source)
+        sizes = [0] * num_components
+        self_loop = False
+        for idx in range(len(self.pagenums)):
+            if reached[idx] >= 0:
+                sizes[component[idx]] += 1
+                for pos in range(self.offsets[idx], self.offsets[idx+1]):
+                    if self.targets[pos] == idx:
+                        self_loop = True
+        # A page with a choice back to itself is a loop too, even though
+        # it's a component all by itself.
+        if max(sizes) > 1 or self_loop:
+            raise Exception('There is a loop reachable from page %s' % (self.pagenums[source]))
+
+        # Components are in reverse topological order, so walking them
+        # from the highest number down visits every page before anything
+        # it leads to.
+        nodes = sorted([idx for idx in range(len(self.pagenums)) if reached[idx] >= 0],
+            key=lambda idx: -component[idx])
+        counts = [0] * len(self.pagenums)
+        counts[source] = 1
+        for idx in nodes:
+            for pos in range(self.offsets[idx], self.offsets[idx+1]):
+                counts[self.targets[pos]] += counts[idx]
+        return counts
+
+    def numpy_arrays(self):
+        """
+        Returns a dict of our arrays as NumPy arrays (sharing memory with
+        ours rather than copying them), or None if NumPy isn't available.
+        """
+        if not import_numpy():
+            return None
+        arrays = {}
+        for name in ['offsets', 'targets', 'in_offsets', 'sources', 'character']:
+            arrays[name] = numpy.frombuffer(getattr(self, name), dtype=numpy.intc)
+        for name in ['canonical', 'ending']:
+            arrays[name] = numpy.frombuffer(getattr(self, name), dtype=numpy.int8)
+        return arrays
+
+def graph_report(snapshot, start=1):
+    """
+    Builds a statistics report about the shape of a book from a
+    GraphSnapshot, using NumPy (which must be available) so that it's
+    quick even on huge books.  Returns a dict (which can go straight out
+    as JSON) with:
+
+        pages, unvisited, choices   Node and choice counts
+        out_degree                  Histogram of the number of choices on
+                                    each visited page, as a list indexed
+                                    by the number of choices
+        in_degree                   The same, for choices leading to each
+                                    page (visited or not)
+        depth                       Histogram of how many choices it takes
+                                    to get to each page from the start page
+                                    (shortest route), indexed by depth
+        unreachable                 Pages which can't be reached from the
+                                    start page at all
+        canon_choices,              Choices leading to canonical pages, and
+        noncanon_choices            to anything else
+        canon_ratio                 canon_choices / noncanon_choices (or
+                                    None if there aren't any of the latter)
+        endings, dead_ends          Visited pages with no choices which
+                                    are marked as endings, and which aren't
+        characters                  A dict of per-character stats: "pages",
+                                    "endings", "mean_depth" and
+                                    "max_depth" (over pages reachable
+                                    from the start), and "mean_choices"
+    """
+    if not import_numpy():
+        raise Exception('The statistics report requires NumPy')
+    arrays = snapshot.numpy_arrays()
+    num_nodes = len(snapshot)
+    num_visited = snapshot.num_visited
+    offsets = arrays['offsets']
+    targets = arrays['targets']
+
+    out_degree = numpy.diff(offsets)[:num_visited]
+    in_degree = numpy.diff(arrays['in_offsets'])
+
+    # Breadth-first search a whole layer at a time.  Each layer's choices
+    # are pulled out of targets in one go, by working out the position of
+    # every choice from its page's offset.
+    depth = numpy.full(num_nodes, -1, dtype=numpy.intc)
+    last_seen = numpy.zeros(num_nodes, dtype=numpy.intc)
+    if start in snapshot.index:
+        frontier = numpy.array([snapshot.index[start]], dtype=numpy.intc)
+        depth[frontier] = 0
+        level = 0
+        while frontier.size > 0:
+            level += 1
+            starts = offsets[frontier]
+            counts = offsets[frontier+1] - starts
+            total = int(counts.sum())
+            if total == 0:
+                break
+            firsts = numpy.cumsum(counts) - counts
+            positions = numpy.arange(total) - numpy.repeat(firsts - starts, counts)
+            found = targets[positions]
+            found = found[depth[found] < 0]
+            # Drop duplicates without sorting: each page remembers the
+            # last position it was found at, and only that one is kept.
+            order = numpy.arange(found.size, dtype=numpy.intc)
+            last_seen[found] = order
+            frontier = found[last_seen[found] == order]
+            depth[frontier] = level
+    reached = depth >= 0
+
+    target_canon = arrays['canonical'][targets] != 0
+    canon_choices = int(numpy.count_nonzero(target_canon))
+    noncanon_choices = int(targets.size - canon_choices)
+    if noncanon_choices > 0:
+        canon_ratio = float(canon_choices) / noncanon_choices
+    else:
+        canon_ratio = None
+
+    ending = arrays['ending'][:num_visited] != 0
+    no_choices = out_degree == 0
+
+    # Per-character numbers, all done with bincount over the character
+    # index of each visited page.
+    character = arrays['character'][:num_visited]
+    known = character >= 0
+    num_chars = len(snapshot.characters)
+    char_pages = numpy.bincount(character[known], minlength=num_chars)
+    char_endings = numpy.bincount(character[known & ending], minlength=num_chars)
+    char_choices = numpy.bincount(character[known], weights=out_degree[known], minlength=num_chars)
+    char_reached_mask = known & reached[:num_visited]
+    char_reached = numpy.bincount(character[char_reached_mask], minlength=num_chars)
+    char_depth = numpy.bincount(character[char_reached_mask],
+        weights=depth[:num_visited][char_reached_mask], minlength=num_chars)
+    char_max_depth = numpy.full(num_chars, -1, dtype=numpy.intc)
+    numpy.maximum.at(char_max_depth, character[char_reached_mask], depth[:num_visited][char_reached_mask])
+
+    characters = {}
+    for (idx, name) in enumerate(snapshot.characters):
+        if char_pages[idx] == 0:
+            continue
+        stats = {
+                'pages': int(char_pages[idx]),
+                'endings': int(char_endings[idx]),
+                'mean_choices': float(char_choices[idx]) / int(char_pages[idx]),
+                'mean_depth': None,
+                'max_depth': None,
+            }
+        if char_reached[idx] > 0:
+            stats['mean_depth'] = float(char_depth[idx]) / int(char_reached[idx])
+            stats['max_depth'] = int(char_max_depth[idx])
+        characters[name] = stats
+
+    return {
+            'pages': int(num_visited),
+            'unvisited': int(num_nodes - num_visited),
+            'choices': int(targets.size),
+            'out_degree': numpy.bincount(out_degree).tolist(),
+            'in_degree': numpy.bincount(in_degree).tolist(),
+            'depth': numpy.bincount(depth[reached]).tolist(),
+            'unreachable': int(num_nodes - numpy.count_nonzero(reached)),
+            'canon_choices': canon_choices,
+            'noncanon_choices': noncanon_choices,
+            'canon_ratio': canon_ratio,
+            'endings': int(numpy.count_nonzero(no_choices & ending)),
+            'dead_ends': int(numpy.count_nonzero(no_choices & ~ending)),
+            'characters': characters,
+        }
+
+# Loops in the story are solved by sweeping over their pages again and
+# again, until nothing changes by more than ODDS_TOLERANCE (relative to
+# its size, for lengths) or we've done ODDS_MAX_SWEEPS sweeps.
+ODDS_TOLERANCE = 1e-12
+ODDS_MAX_SWEEPS = 10000
+
+def odds_components(snapshot):
+    """
+    The setup shared by reading_odds and reading_outcomes.  Returns a
+    tuple of an array saying which nodes finish a reading (endings, dead
+    ends, and unvisited pages), an array of each node's component
+    (ignoring any choices out of those finishing nodes, so that every
+    loop is made of pages the reader carries on from), and a list of
+    the nodes in each component.
+    """
+    num_nodes = len(snapshot)
+    num_visited = snapshot.num_visited
+    (offsets, ending) = (snapshot.offsets, snapshot.ending)
+    absorbing = array.array('b', [1]) * num_nodes
+    for idx in range(num_visited):
+        if not ending[idx] and offsets[idx] < offsets[idx+1]:
+            absorbing[idx] = 0
+    (component, num_components) = snapshot.components(ignore=absorbing)
+    members = [[] for comp in range(num_components)]
+    for idx in range(num_nodes):
+        members[component[idx]].append(idx)
+    return (absorbing, component, members)
+
+def reading_odds(snapshot):
+    """
+    Treats reading the book as an absorbing Markov chain: on each visited
+    page the reader picks one of its choices at random (all equally
+    likely), until they land on an ending, a dead end (a page with no
+    choices which isn't marked as an ending), or a page we haven't
+    visited yet.  Returns a dict of lists, indexed by node (see
+    GraphSnapshot):
+
+        ending, dead_end,   The chances of the reading finishing on each
+        unvisited           sort of page (whatever's left over is the
+                            chance of going round a loop forever)
+        length              The expected number of pages read, counting
+                            the first and last, or None if there's a
+                            chance of never finishing
+
+    Components are solved in reverse topological order, so every page
+    outside a loop is worked out directly from the pages its choices
+    lead to, and each loop is solved iteratively once everything it
+    leads out to is known.
+    """
+    (absorbing, component, members) = odds_components(snapshot)
+    num_nodes = len(snapshot)
+    (offsets, targets) = (snapshot.offsets, snapshot.targets)
+    ending = [0.0] * num_nodes
+    dead_end = [0.0] * num_nodes
+    unvisited = [0.0] * num_nodes
+    length = [1.0] * num_nodes
+    for (comp, nodes) in enumerate(members):
+        idx = nodes[0]
+        if absorbing[idx]:
+            if idx >= snapshot.num_visited:
+                unvisited[idx] = 1.0
+            elif snapshot.ending[idx]:
+                ending[idx] = 1.0
+            else:
+                dead_end[idx] = 1.0
+            continue
+
+        # Most pages aren't part of a loop, and can be done in one go
+        choices = targets[offsets[idx]:offsets[idx+1]]
+        if len(nodes) == 1 and idx not in choices:
+            weight = 1.0 / len(choices)
+            ending[idx] = sum([ending[target] for target in choices]) * weight
+            dead_end[idx] = sum([dead_end[target] for target in choices]) * weight
+            unvisited[idx] = sum([unvisited[target] for target in choices]) * weight
+            lengths = [length[target] for target in choices]
+            if None in lengths:
+                length[idx] = None
+            else:
+                length[idx] = 1.0 + sum(lengths) * weight
+            continue
+
+        # See if there's a way out of this loop, and whether the reading
+        # is sure to finish once it's taken.
+        looped = len(nodes) > 1
+        escapes = False
+        finite = True
+        for idx in nodes:
+            for target in targets[offsets[idx]:offsets[idx+1]]:
+                if component[target] != comp:
+                    escapes = True
+                    if length[target] is None:
+                        finite = False
+                elif target == idx:
+                    looped = True
+        if not finite or not escapes:
+            for idx in nodes:
+                length[idx] = None
+        if not escapes:
+            # A loop with no way out.  Nothing ever finishes from here.
+            continue
+
+        sweeps = 0
+        while True:
+            change = 0.0
+            for idx in nodes:
+                (start, end) = (offsets[idx], offsets[idx+1])
+                weight = 1.0 / (end - start)
+                (to_ending, to_dead_end, to_unvisited, to_length) = (0.0, 0.0, 0.0, 0.0)
+                for target in targets[start:end]:
+                    to_ending += ending[target]
+                    to_dead_end += dead_end[target]
+                    to_unvisited += unvisited[target]
+                    if finite:
+                        to_length += length[target]
+                to_ending *= weight
+                to_dead_end *= weight
+                to_unvisited *= weight
+                change = max(change, abs(to_ending - ending[idx]),
+                    abs(to_dead_end - dead_end[idx]), abs(to_unvisited - unvisited[idx]))
+                ending[idx] = to_ending
+                dead_end[idx] = to_dead_end
+                unvisited[idx] = to_unvisited
+                if finite:
+                    to_length = 1.0 + to_length * weight
+                    change = max(change, abs(to_length - length[idx]) / to_length)
+                    length[idx] = to_length
+            sweeps += 1
+            if not looped or change <= ODDS_TOLERANCE or sweeps >= ODDS_MAX_SWEEPS:
+                break
+
+    return {
+            'ending': ending,
+            'dead_end': dead_end,
+            'unvisited': unvisited,
+            'length': length,
+        }
+
+def reading_outcomes(snapshot, source):
+    """
+    The same Markov chain as reading_odds, but worked forwards from a
+    single node index source.  Returns a tuple of a dict mapping the node
+    index of every ending, dead end, and unvisited page the reading could
+    finish on to the chance of it finishing there, and the expected
+    number of pages read (or None if there's a chance of never
+    finishing).  Only the part of the book reachable from source is
+    looked at.
+    """
+    (absorbing, component, members) = odds_components(snapshot)
+    (offsets, targets) = (snapshot.offsets, snapshot.targets)
+    (in_offsets, sources) = (snapshot.in_offsets, snapshot.sources)
+
+    # inflow holds the expected number of times the reader arrives at
+    # each page from outside its component.  Walking the components
+    # from source's number downwards means that's all known by the time
+    # we get to a component.
+    inflow = [0.0] * len(snapshot)
+    inflow[source] = 1.0
+    outcomes = {}
+    length = 0.0
+    for comp in range(component[source], -1, -1):
+        nodes = members[comp]
+        if not any([inflow[idx] for idx in nodes]):
+            continue
+        idx = nodes[0]
+        if absorbing[idx]:
+            outcomes[idx] = inflow[idx]
+            if length is not None:
+                length += inflow[idx]
+            continue
+
+        # The expected number of visits to each page in the component
+        visits = dict([(idx, inflow[idx]) for idx in nodes])
+        looped = len(nodes) > 1
+        escapes = False
+        for idx in nodes:
+            for target in targets[offsets[idx]:offsets[idx+1]]:
+                if component[target] != comp:
+                    escapes = True
+                elif target == idx:
+                    looped = True
+        if not escapes:
+            # Stuck going round this loop forever
+            length = None
+            continue
+        if looped:
+            sweeps = 0
+            while True:
+                change = 0.0
+                for idx in nodes:
+                    total = inflow[idx]
+                    for other in sources[in_offsets[idx]:in_offsets[idx+1]]:
+                        if component[other] == comp:
+                            total += visits[other] / (offsets[other+1] - offsets[other])
+                    if total > 0:
+                        change = max(change, abs(total - visits[idx]) / total)
+                    visits[idx] = total
+                sweeps += 1
+                if change <= ODDS_TOLERANCE or sweeps >= ODDS_MAX_SWEEPS:
+                    break
+
+        for idx in nodes:
+            (start, end) = (offsets[idx], offsets[idx+1])
+            share = visits[idx] / (end - start)
+            for target in targets[start:end]:
+                if component[target] != comp:
+                    inflow[target] += share
+            if length is not None:
+                length += visits[idx]
+
+    return (outcomes, length)
+
+class BackgroundSaver(object):
+    """
+    Writes books out to disk on a background thread, so that the UI never
+    has to sit around waiting for YAML to be dumped.  Callers hand us a
+    savedict (see Book.get_savedict), which is a snapshot of the book that
+    doesn't share anything with the live objects, so the book can keep
+    changing while we write.  If several snapshots come in while we're
+    busy, only the most recent one gets written.  The result of each save
+    is kept around until someone asks for it with pop_results().
+    """
+
+    def __init__(self):
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.results = []
+        self.thread = None
+
+    def submit(self, savedict, filename):
+        """
+        Queues up the given savedict to be written to filename
+        """
+        with self.condition:
+            self.pending = (savedict, filename)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        Main loop of the background thread
+        """
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                (savedict, filename) = self.pending
+                self.pending = None
+                self.busy = True
+
+            start_time = time.time()
+            error = None
+            try:
+                Book.write_savedict(savedict, filename)
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                self.busy = False
+                self.results.append((filename, time.time() - start_time, error))
+                self.condition.notify_all()
+
+    def wait(self):
+        """
+        Waits until everything we've been given has been written out
+        """
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+
+    def pop_results(self):
+        """
+        Returns a list of (filename, elapsed seconds, exception) tuples for
+        the saves which have finished since we were last asked.  The
+        exception will be None if the save was successful.
+        """
+        with self.condition:
+            results = self.results
+            self.results = []
+        return results
+
+def content_digest(parts):
+    """
+    Returns the SHA-1 digest (as a hex string) of a list of strings, or
+    anything which can be turned into one.  Each part is prefixed with
+    its length, so that two different lists can't run together into the
+    same text.
+    """
+    import hashlib
+    hasher = hashlib.sha1()
+    for part in parts:
+        data = (u'%s' % (part,)).encode('utf-8')
+        hasher.update(('%d:' % (len(data))).encode('ascii'))
+        hasher.update(data)
+    return hasher.hexdigest()
+
+# Page digests are added together, modulo this, for the book digest
+DIGEST_MODULUS = 1 << 160
+
 class Character(object):
     """
     Class to hold information about a character.  Note that
@@ -110,11 +1900,16 @@ class Choice(object):
         return savedict
 
     @staticmethod
-    def from_dict(choicedict):
+    def from_dict(choicedict, strings=None):
         """
         Converts a dictionary (from YAML save) to object and returns.
+        Pass in a strings dict to share identical summaries between
+        objects (see Book.load_from_dict).
         """
-        choice = Choice(choicedict['target'], choicedict['summary'])
+        summary = choicedict['summary']
+        if strings is not None:
+            summary = strings.setdefault(summary, summary)
+        choice = Choice(choicedict['target'], summary)
         return choice
 
     def print_text(self):
@@ -139,6 +1934,14 @@ class Page(object):
 
         self.choices = {}
 
+        # The book we belong to, if any.  Set by Book.add_page_obj so that
+        # the book can keep its indexes up to date when our choices change.
+        self.book = None
+
+        # Our content digest (see digest), worked out when it's first
+        # asked for and forgotten whenever we change.
+        self.cached_digest = None
+
     def to_dict(self):
         """
         Returns a dictionary representation of ourselves, for use in
@@ -156,23 +1959,41 @@ class Page(object):
         return savedict
 
     @staticmethod
-    def from_dict(pagedict, characters):
+    def from_dict(pagedict, characters, strings=None):
         """
         Converts a dictionary (from YAML save) to Page object.
         Needs a characters structure so that we can assign page
-        ownership properly.
+        ownership properly.  Pass in a strings dict to share identical
+        summaries between objects (see Book.load_from_dict).
         """
         if pagedict['character'] not in characters:
             raise Exception('Character "%s" not found for page %s' % (pagedict['character'], pagedict['pagenum']))
+        summary = pagedict['summary']
+        if strings is not None:
+            summary = strings.setdefault(summary, summary)
         page = Page(pagedict['pagenum'],
                 character=characters[pagedict['character']],
-                summary=pagedict['summary'],
+                summary=summary,
                 canonical=pagedict['canonical'],
                 ending=pagedict['ending'])
         for choicedict in pagedict['choices'].values():
-            page.add_choice_obj(Choice.from_dict(choicedict))
+            page.add_choice_obj(Choice.from_dict(choicedict, strings))
         return page
 
+    def digest(self):
+        """
+        Returns a digest (as a hex string) of everything about us which
+        gets saved: our page number, character, summary, flags, and
+        choices.  Two pages with the same digest are the same.
+        """
+        if self.cached_digest is None:
+            parts = [self.pagenum, self.character.name, self.summary, int(self.canonical), int(self.ending)]
+            for choice in self.choices_sorted():
+                parts.append(choice.target)
+                parts.append(choice.summary)
+            self.cached_digest = content_digest(parts)
+        return self.cached_digest
+
     def print_text(self):
         """
         Prints out a text summary of ourselves
@@ -202,6 +2023,9 @@ class Page(object):
             raise Exception('Target %s already exists on page %s' % (choice.target, self.pagenum))
 
         self.choices[choice.target] = choice
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.choice_added(self, choice)
         return choice
 
     def choices_sorted(self):
@@ -215,19 +2039,53 @@ class Page(object):
         Deletes the choice pointing at the specified target.  Raises
         an KeyError if the target is not found
         """
-        del self.choices[target]
+        choice = self.choices.pop(target)
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.choice_deleted(self, choice)
+
+    def set_summary(self, summary):
+        """
+        Sets our summary
+        """
+        self.summary = summary
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.summary_changed(self)
+
+    def set_character(self, character):
+        """
+        Sets the character this page belongs to
+        """
+        old_character = self.character
+        self.character = character
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.character_changed(self, old_character)
 
     def toggle_canonical(self):
         """
         Toggles our canonical state
         """
         self.canonical = not self.canonical
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.canonical_changed(self)
 
     def toggle_ending(self):
         """
         Toggles our 'ending' stage
         """
         self.ending = not self.ending
+        self.cached_digest = None
+        if self.book is not None:
+            self.book.ending_changed(self)
+
+class PageRow(list):
+    """
+    A page in a string-table book (see Book.pack_savedict).  This is just
+    a list, but it's written out on a single line.
+    """
 
 class Book(object):
     """
@@ -241,9 +2099,47 @@ class Book(object):
         self.title = title
         self.filename = filename
         self.characters = {}
+
+        # Whether to save with a string table (see pack_savedict)
+        self.string_table = False
         self.pages = {}
         self.intermediates = {}
 
+        # Index of which pages link to any given page (visited or not),
+        # so that we can walk the graph backwards without having to scan
+        # every page.  Keys are target page numbers, values are sets of
+        # the page numbers which have a choice pointing there.
+        self.inbound = {}
+
+        # Which pages belong to each character (keyed by character name),
+        # and which pages are canonical or endings, so that we don't have
+        # to scan every page to find them.  Values are sets of page
+        # numbers.
+        self.character_pages = {}
+        self.canonical_pages = set()
+        self.ending_pages = set()
+
+        # Full-text index of page and choice summaries.  Page documents
+        # are keyed by ('page', pagenum), and choices by ('choice',
+        # pagenum, target).
+        self.search_index = SearchIndex()
+
+        # Which endings and unfollowed choices can be reached from each
+        # page.  Only built once somebody asks for it.
+        self.reachability = ReachabilityIndex(self)
+
+        # Bumped whenever pages, choices, or page flags change, so that
+        # we know when our GraphSnapshot is out of date.
+        self.version = 0
+        self.graph_snapshot = None
+
+        # Page digests rolled up into the book digest (see digest): the
+        # digest each page had when it was last rolled in, their sum, and
+        # the pages which have changed since then.
+        self.page_digests = {}
+        self.page_digest_sum = 0
+        self.dirty_digests = set()
+
     @staticmethod
     def load_from_dict(savedict):
         """
@@ -251,6 +2147,7 @@ class Book(object):
         """
 
         book = Book(savedict['book']['title'])
+        book.string_table = savedict['book'].get('string_table', False)
 
         # "intermediates" is a new variable, don't rely on it being
         # in the file.
@@ -258,25 +2155,53 @@ class Book(object):
             for intermediate in savedict['intermediates']:
                 book.add_intermediate(intermediate)
 
+        # The same summary often turns up on a page and on the choices
+        # leading to it (or on several choices), so only keep one copy
+        # of each.
+        strings = {}
         for chardict in savedict['characters'].values():
             book.add_character_obj(Character.from_dict(chardict))
         for pagedict in savedict['pages'].values():
-            book.add_page_obj(Page.from_dict(pagedict, book.characters))
+            book.add_page_obj(Page.from_dict(pagedict, book.characters, strings))
 
         return book
 
     @staticmethod
-    def load(filename):
+    def read_savedict(filename):
         """
-        Loads from a YAML filename, returns a new Book object.
+        Reads the dictionary out of a YAML file, without turning it into
+        a Book.  Files ending in .gz or .xz are decompressed as they're
+        read (see compressed_stream).
         """
+        import yaml
         data = None
-        with open(filename, 'r') as df:
-            data = yaml.load(df.read())
+        with open(filename, 'rb') as raw:
+            df = compressed_stream(filename, raw, 'rb')
+            if df is None:
+                df = raw
+            # The libyaml-based loader is several times faster, if PyYAML
+            # was built with it.  Either way, the file is parsed as it's
+            # read rather than being read in all at once.
+            try:
+                data = yaml.load(df, Loader=getattr(yaml, 'CLoader', yaml.Loader))
+            finally:
+                df.close()
 
         if data is None:
             raise Exception('YAML data not found in file')
 
+        if 'strings' in data:
+            data = Book.unpack_savedict(data)
+
+        return data
+
+    @staticmethod
+    def load(filename):
+        """
+        Loads from a YAML filename, returns a new Book object.
+        """
+        data = Book.read_savedict(filename)
+
         # Now do the object population
         book = Book.load_from_dict(data)
         book.filename = filename
@@ -298,6 +2223,8 @@ class Book(object):
         savedict['book'] = {
                 'title': self.title,
             }
+        if self.string_table:
+            savedict['book']['string_table'] = True
 
         savedict['characters'] = {}
         for character in self.characters.values():
@@ -329,11 +2256,139 @@ class Book(object):
         savedict = self.get_savedict()
 
         # Save ourselves out
-        with open(filename, 'w') as df:
-            yaml.dump(savedict, df)
+        Book.write_savedict(savedict, filename)
 
         # And that's it!
 
+    @staticmethod
+    def write_savedict(savedict, filename):
+        """
+        Writes a savedict (from get_savedict) out to the given filename.
+        We write to a temporary file in the same directory first, and only
+        move it over the top of the real file once it's safely on disk, so
+        a crash halfway through won't leave a truncated book behind.  Files
+        ending in .gz or .xz are compressed as they're written (see
+        compressed_stream).  Books which want a string table are written
+        in that format (see pack_savedict).
+        """
+        import yaml
+        import tempfile
+
+        # The libyaml-based dumper is several times faster, if PyYAML
+        # was built with it.
+        dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+        if savedict['book'].get('string_table', False):
+            savedict = Book.pack_savedict(savedict)
+            class RowDumper(dumper):
+                pass
+            RowDumper.add_representer(PageRow, lambda representer, row: representer.represent_sequence(
+                'tag:yaml.org,2002:seq', row, flow_style=True))
+            dumper = RowDumper
+
+        dirname = os.path.dirname(os.path.abspath(filename))
+        (fd, tmp_filename) = tempfile.mkstemp(dir=dirname,
+            prefix='.%s.' % (os.path.basename(filename)),
+            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                df = compressed_stream(filename, raw, 'wb')
+                if df is None:
+                    df = raw
+                yaml.dump(savedict, df, Dumper=dumper, encoding='utf-8')
+                if df is not raw:
+                    # Flushes the end of the compressed data (but leaves
+                    # raw open)
+                    df.close()
+                raw.flush()
+                os.fsync(raw.fileno())
+
+            # mkstemp() creates files which only we can read, so keep the
+            # permissions of whatever we're replacing.
+            if os.path.exists(filename):
+                os.chmod(tmp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+            else:
+                os.chmod(tmp_filename, 0o644)
+
+            replace_file(tmp_filename, filename)
+        except:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+    # Bits in the flags column of pack_savedict's page rows
+    FLAG_CANONICAL = 1
+    FLAG_ENDING = 2
+
+    @staticmethod
+    def pack_savedict(savedict):
+        """
+        Converts a savedict (from get_savedict) into the more compact
+        string-table format, where each distinct page summary, choice
+        summary, and character name is only stored once, in a "strings"
+        list, and everything else refers to it by index.  Each page is
+        stored as a single row of the "pages" list:
+
+            [pagenum, character, summary, flags, target, summary, ...]
+
+        ...where character and the summaries are indexes into "strings",
+        flags has FLAG_CANONICAL and FLAG_ENDING set as appropriate, and
+        there's a target/summary pair for each choice.  The book title,
+        characters, and intermediates are stored as usual.
+        """
+        strings = []
+        indexes = {}
+        def index(text):
+            if text not in indexes:
+                indexes[text] = len(strings)
+                strings.append(text)
+            return indexes[text]
+
+        rows = []
+        for pagenum in sorted(savedict['pages'].keys(), key=sortkey_pages):
+            pagedict = savedict['pages'][pagenum]
+            flags = 0
+            if pagedict['canonical']:
+                flags |= Book.FLAG_CANONICAL
+            if pagedict['ending']:
+                flags |= Book.FLAG_ENDING
+            row = PageRow([pagenum, index(pagedict['character']), index(pagedict['summary']), flags])
+            for target in sorted(pagedict['choices'].keys(), key=sortkey_pages):
+                row.append(target)
+                row.append(index(pagedict['choices'][target]['summary']))
+            rows.append(row)
+
+        packed = dict(savedict)
+        packed['strings'] = strings
+        packed['pages'] = rows
+        return packed
+
+    @staticmethod
+    def unpack_savedict(packed):
+        """
+        Converts a savedict in string-table format (see pack_savedict)
+        back into the usual format.  Strings used more than once end up
+        as the same object.
+        """
+        strings = packed['strings']
+        pages = {}
+        for row in packed['pages']:
+            choices = {}
+            for idx in range(4, len(row), 2):
+                choices[row[idx]] = {'target': row[idx], 'summary': strings[row[idx+1]]}
+            pages[row[0]] = {
+                    'pagenum': row[0],
+                    'character': strings[row[1]],
+                    'summary': strings[row[2]],
+                    'canonical': (row[3] & Book.FLAG_CANONICAL) != 0,
+                    'ending': (row[3] & Book.FLAG_ENDING) != 0,
+                    'choices': choices,
+                }
+
+        savedict = dict(packed)
+        del savedict['strings']
+        savedict['pages'] = pages
+        return savedict
+
     def print_text(self):
         """
         Prints out a text summary of the book
@@ -374,9 +2429,16 @@ class Book(object):
             raise Exception('Cannot rename character "%s" to "%s" because a character already exists with that name' % (
                 char.name, newname))
 
+        oldname = char.name
         del self.characters[char.name]
         char.name = newname
         self.add_character_obj(char)
+        self.version += 1
+        if oldname in self.character_pages:
+            self.character_pages[newname] = self.character_pages.pop(oldname)
+            for pagenum in self.character_pages[newname]:
+                self.pages[pagenum].cached_digest = None
+                self.dirty_digests.add(pagenum)
 
     def delete_character(self, charname):
         """
@@ -390,9 +2452,9 @@ class Book(object):
 
         # Next check for page ownership (this is almost certainly already
         # checked-for before this, but do it here as well)
-        for page in self.pages_sorted():
-            if page.character.name == charname:
-                raise Exception('Character "%s" is the active character on page %s!' % (charname, page.pagenum))
+        if charname in self.character_pages:
+            pagenum = sorted(self.character_pages[charname], key=sortkey_pages)[0]
+            raise Exception('Character "%s" is the active character on page %s!' % (charname, pagenum))
 
         # Now go ahead and delete it
         del self.characters[charname]
@@ -433,8 +2495,12 @@ class Book(object):
         the given prefix and the given number of pages per line.
         Method taken from: http://stackoverflow.com/questions/434287/what-is-the-most-pythonic-way-to-iterate-over-a-list-in-chunks
         """
+        try:
+            from itertools import zip_longest
+        except ImportError:
+            from itertools import izip_longest as zip_longest
         args = [iter(self.intermediates_sorted())] * num_per_line
-        for pagenums in itertools.izip_longest(*args):
+        for pagenums in zip_longest(*args):
             numlist = [str(x) for x in pagenums]
             while numlist[-1] == 'None':
                 numlist.pop()
@@ -448,6 +2514,16 @@ class Book(object):
         if page.pagenum in self.pages:
             raise Exception('Page %s already exists' % (page.pagenum))
         self.pages[page.pagenum] = page
+        page.book = self
+        self.search_index.add(('page', page.pagenum), page.summary)
+        self.reachability.page_added(page)
+        self.index_flags(page)
+        if page.character is not None:
+            self.character_pages.setdefault(page.character.name, set()).add(page.pagenum)
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+        for choice in page.choices.values():
+            self.choice_added(page, choice)
         return page
 
     def delete_page(self, pagenum):
@@ -455,60 +2531,1821 @@ class Book(object):
         Deletes the specified page.  Will raise a KeyError
         if the page is not found
         """
-        del self.pages[pagenum]
+        page = self.pages.pop(pagenum)
+        self.search_index.remove(('page', pagenum))
+        self.canonical_pages.discard(pagenum)
+        self.ending_pages.discard(pagenum)
+        if page.character is not None:
+            self.unindex_character(page.character, pagenum)
+        for choice in page.choices.values():
+            self.choice_deleted(page, choice)
+        page.book = None
+        self.reachability.invalidate()
+        self.version += 1
+        self.dirty_digests.discard(pagenum)
+        if pagenum in self.page_digests:
+            self.page_digest_sum = (self.page_digest_sum - int(self.page_digests.pop(pagenum), 16)) % DIGEST_MODULUS
+
+    def choice_added(self, page, choice):
+        """
+        Called by our pages whenever a choice is added to them, to keep
+        our indexes up to date.
+        """
+        if choice.target not in self.inbound:
+            self.inbound[choice.target] = set()
+        self.inbound[choice.target].add(page.pagenum)
+        self.search_index.add(('choice', page.pagenum, choice.target), choice.summary)
+        self.reachability.choice_added(page, choice)
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+
+    def choice_deleted(self, page, choice):
+        """
+        Called by our pages whenever a choice is removed from them, to
+        keep our indexes up to date.
+        """
+        sources = self.inbound[choice.target]
+        sources.discard(page.pagenum)
+        if len(sources) == 0:
+            del self.inbound[choice.target]
+        self.search_index.remove(('choice', page.pagenum, choice.target))
+        self.reachability.invalidate()
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+
+    def ending_changed(self, page):
+        """
+        Called by our pages whenever they're marked (or unmarked) as an
+        ending, to keep our indexes up to date.
+        """
+        self.reachability.ending_changed(page)
+        self.index_flags(page)
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+
+    def canonical_changed(self, page):
+        """
+        Called by our pages whenever they're marked (or unmarked) as
+        canonical.
+        """
+        self.index_flags(page)
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+
+    def character_changed(self, page, old_character):
+        """
+        Called by our pages whenever they're given to a different
+        character.
+        """
+        if old_character is not None:
+            self.unindex_character(old_character, page.pagenum)
+        if page.character is not None:
+            self.character_pages.setdefault(page.character.name, set()).add(page.pagenum)
+        self.version += 1
+        self.dirty_digests.add(page.pagenum)
+
+    def index_flags(self, page):
+        """
+        Brings canonical_pages and ending_pages into line with the
+        given page's flags.
+        """
+        if page.canonical:
+            self.canonical_pages.add(page.pagenum)
+        else:
+            self.canonical_pages.discard(page.pagenum)
+        if page.ending:
+            self.ending_pages.add(page.pagenum)
+        else:
+            self.ending_pages.discard(page.pagenum)
 
-    def pages_sorted(self):
+    def unindex_character(self, character, pagenum):
         """
-        Returns a list of pages sorted by page number
+        Removes the given page from the character's entry in
+        character_pages, dropping the entry once it's empty (so that
+        only characters who own pages are in there).
         """
-        return [self.pages[idx] for idx in sorted(self.pages.keys(), key=sortkey_pages)]
+        pagenums = self.character_pages.get(character.name)
+        if pagenums is not None:
+            pagenums.discard(pagenum)
+            if len(pagenums) == 0:
+                del self.character_pages[character.name]
 
-    def intermediates_sorted(self):
+    def character_pages_sorted(self, charname):
         """
-        Returns a list of intermediate pages sorted by page number
+        Returns a list of the pages belonging to the given character
+        name, sorted by page number.
         """
-        return sorted(self.intermediates.keys())
+        return self.pages_sorted(self.character_pages.get(charname, ()))
 
-    def characters_sorted(self):
+    def snapshot(self):
         """
-        Returns a list of characters sorted by name
+        Returns a GraphSnapshot of the book, for running graph algorithms
+        over.  The snapshot is kept around, and only rebuilt if the book
+        has changed since it was taken, so don't change it.
         """
-        return [self.characters[name] for name in sorted(self.characters.keys())]
+        if self.graph_snapshot is None or self.graph_snapshot.version != self.version:
+            self.graph_snapshot = GraphSnapshot(self)
+        return self.graph_snapshot
 
-    def get_page(self, pagenum):
+    def summary_changed(self, page):
         """
-        Gets a page, given a page number.  Will raise a KeyError
-        if not found.
+        Called by our pages whenever their summary changes, to keep our
+        indexes up to date.
         """
-        return self.pages[pagenum]
+        self.search_index.add(('page', page.pagenum), page.summary)
+        self.dirty_digests.add(page.pagenum)
 
-class App(object):
-    """
-    Main mostly-interactive application.  This class probably knows too much
-    about the Book (and other) classes, and should probably abstract access to
-    that stuff a bit more, but whatever.
-    """
+    def digest(self):
+        """
+        Returns a digest (as a hex string) of the whole book: its title,
+        characters, intermediate pages, save format, and every page's
+        digest (see Page.digest).  If the digest hasn't changed, neither
+        has anything which gets saved.  Page digests are added together
+        rather than hashed in order, so only pages which have changed
+        since the last call have to be looked at.
+        """
+        for pagenum in self.dirty_digests:
+            digest = self.pages[pagenum].digest()
+            if pagenum in self.page_digests:
+                self.page_digest_sum -= int(self.page_digests[pagenum], 16)
+            self.page_digests[pagenum] = digest
+            self.page_digest_sum = (self.page_digest_sum + int(digest, 16)) % DIGEST_MODULUS
+        self.dirty_digests = set()
 
-    COLOR_CHOICES = ['none', 'light', 'dark']
-    COLOR_NONE = COLOR_CHOICES[0]
-    COLOR_LIGHT = COLOR_CHOICES[1]
-    COLOR_DARK = COLOR_CHOICES[2]
+        parts = [self.title, int(self.string_table), '%x' % (self.page_digest_sum)]
+        for char in self.characters_sorted():
+            parts.extend([char.name, char.fillcolor, char.fontcolor])
+        parts.extend(self.intermediates_sorted())
+        return content_digest(parts)
 
-    def __init__(self):
+    def search(self, query, limit=None):
+        """
+        Searches page summaries, and the summaries of choices leading to
+        pages we haven't visited yet.  Returns a list of (score, object)
+        tuples, best matches first, where the object is either a Page or
+        a (Page, Choice) tuple.
+        """
+        def accept(docid):
+            # Choices leading to pages we've visited aren't very interesting
+            return docid[0] == 'page' or docid[2] not in self.pages
+
+        results = []
+        for (score, docid) in self.search_index.search(query, limit=limit, accept=accept):
+            page = self.pages[docid[1]]
+            if docid[0] == 'page':
+                results.append((score, page))
+            else:
+                results.append((score, (page, page.choices[docid[2]])))
+        return results
+
+    def reachable_counts(self, pagenum):
+        """
+        Returns a tuple of the number of ending pages, and the number of
+        choices we haven't followed yet, which can be reached from the
+        specified page.
+        """
+        return self.reachability.counts(pagenum)
+
+    def route(self, source, target, prefer_canon=False):
+        """
+        Finds the shortest way to get from the source page to the target
+        page (which doesn't have to have been visited yet) by following
+        choices.  Returns a list of page numbers from source to target,
+        or None if there's no way to get there.  If prefer_canon is set,
+        then when there's more than one shortest route, we'll pick the
+        one which goes through the most canonical pages.
+
+        This searches forwards from the source and backwards (using our
+        inbound index) from the target at the same time, a whole layer
+        at a time, always growing whichever side is smaller.  As soon as
+        the two meet, every shortest route goes through one of the pages
+        where they met, so we never have to look further than that.
+        """
+        if source not in self.pages:
+            return None
+        if source == target:
+            return [source]
+
+        def canon(pagenum):
+            if prefer_canon and pagenum in self.pages and self.pages[pagenum].canonical:
+                return 1
+            return 0
+
+        def forward(pagenum):
+            if pagenum in self.pages:
+                return self.pages[pagenum].choices.keys()
+            return ()
+
+        def backward(pagenum):
+            return self.inbound.get(pagenum, ())
+
+        # For each side: the pages found so far, mapped to the list of
+        # pages one step closer to that side's starting point, the best
+        # number of canonical pages on the way there, and the most
+        # recent layer found.
+        sides = []
+        for (start, neighbors) in [(source, forward), (target, backward)]:
+            sides.append({
+                    'links': {start: []},
+                    'score': {start: canon(start)},
+                    'layer': [start],
+                    'neighbors': neighbors,
+                })
+        (ahead, behind) = sides
+
+        meeting = []
+        while len(meeting) == 0:
+            (side, other) = sorted([ahead, behind], key=lambda side: len(side['layer']))
+            if len(side['layer']) == 0:
+                return None
+            links = side['links']
+            new_layer = []
+            found = set()
+            for pagenum in side['layer']:
+                for neighbor in side['neighbors'](pagenum):
+                    if neighbor not in links:
+                        links[neighbor] = [pagenum]
+                        new_layer.append(neighbor)
+                        found.add(neighbor)
+                    elif neighbor in found:
+                        links[neighbor].append(pagenum)
+            for neighbor in new_layer:
+                side['score'][neighbor] = canon(neighbor) + max([side['score'][link] for link in links[neighbor]])
+                if neighbor in other['links']:
+                    meeting.append(neighbor)
+            side['layer'] = new_layer
+
+        # Pick the best meeting point, and follow the best links back out
+        # to both ends.
+        def best(pagenums, score):
+            return min(pagenums, key=lambda pagenum: (-score(pagenum), sortkey_pages(pagenum)))
+        middle = best(meeting, lambda pagenum: ahead['score'][pagenum] + behind['score'][pagenum] - canon(pagenum))
+        route = []
+        for side in (ahead, behind):
+            half = []
+            pagenum = middle
+            while len(side['links'][pagenum]) > 0:
+                pagenum = best(side['links'][pagenum], side['score'].get)
+                half.append(pagenum)
+            route.append(half)
+        return list(reversed(route[0])) + [middle] + route[1]
+
+    def neighborhood(self, center, radius):
+        """
+        Returns the set of page numbers (visited or not) which are within
+        the given number of choices of the center page, following choices
+        both forwards and backwards.  Only looks at the pages involved, so
+        it's cheap no matter how big the book is.
+        """
+        found = set([center])
+        frontier = [center]
+        for hop in range(radius):
+            next_frontier = []
+            for pagenum in frontier:
+                neighbors = list(self.inbound.get(pagenum, ()))
+                if pagenum in self.pages:
+                    neighbors.extend(self.pages[pagenum].choices.keys())
+                for neighbor in neighbors:
+                    if neighbor not in found:
+                        found.add(neighbor)
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return found
+
+    def pages_sorted(self, pagenums=None):
+        """
+        Returns a list of pages sorted by page number.  Pass in a set
+        of page numbers to only return those pages (any which aren't
+        actually pages in the book will be skipped).
+        """
+        if pagenums is None:
+            return [self.pages[idx] for idx in sorted(self.pages.keys(), key=sortkey_pages)]
+        else:
+            return [self.pages[idx] for idx in sorted(pagenums, key=sortkey_pages) if idx in self.pages]
+
+    def intermediates_sorted(self):
+        """
+        Returns a list of intermediate pages sorted by page number
+        """
+        return sorted(self.intermediates.keys(), key=sortkey_pages)
+
+    def characters_sorted(self):
+        """
+        Returns a list of characters sorted by name
+        """
+        return [self.characters[name] for name in sorted(self.characters.keys())]
+
+    def get_page(self, pagenum):
+        """
+        Gets a page, given a page number.  Will raise a KeyError
+        if not found.
+        """
+        return self.pages[pagenum]
+
+    def statistics(self):
+        """
+        Returns a dict of various statistics about the book: the number
+        of pages ("total_pages", "canon_pages", "ending_pages", and
+        "intermediate_pages"), the number of pages per character name
+        ("character_counts"), and a list of the numeric pages we haven't
+        seen yet ("missing_pages").
+        """
+        char_counts = dict([(name, len(pagenums)) for (name, pagenums) in self.character_pages.items()])
+
+        # This is ridiculous, but: unique real+intermediate pages, filtered
+        # to ensure that there's ony numeric entries, since we have non-
+        # numeric pages now.
+        pages = sorted([x for x in set(list(self.pages.keys()) + list(self.intermediates.keys())) if isinstance(x, int)])
+        if len(pages) > 0:
+            missing = list(range(1, pages[-1]+1))
+            for page in reversed(pages):
+                del missing[page-1]
+        else:
+            missing = []
+
+        return {
+                'total_pages': len(self.pages),
+                'canon_pages': len(self.canonical_pages),
+                'ending_pages': len(self.ending_pages),
+                'intermediate_pages': len(self.intermediates),
+                'character_counts': char_counts,
+                'missing_pages': missing,
+            }
+
+# Page attributes which diff_books and merge_books compare one at a time,
+# so that (say) one person fixing a summary while someone else marks the
+# page as canon isn't considered a conflict.
+PAGE_FIELDS = ['character', 'summary', 'canonical', 'ending']
+
+def book_entries(book):
+    """
+    Flattens a book into a dict of everything in it, so that books can be
+    compared key-by-key.  Keys are tuples:
+
+        ('title',)                          The book title
+        ('character', name)                 Character.to_dict()
+        ('page', pagenum, field)            One of PAGE_FIELDS
+        ('choice', pagenum, target)         The choice summary
+        ('intermediate', pagenum)           True
+    """
+    entries = {('title',): book.title}
+    for char in book.characters.values():
+        entries[('character', char.name)] = char.to_dict()
+    for page in book.pages.values():
+        for (field, value) in page_fields(page).items():
+            entries[('page', page.pagenum, field)] = value
+        for choice in page.choices.values():
+            entries[('choice', page.pagenum, choice.target)] = choice.summary
+    for pagenum in book.intermediates.keys():
+        entries[('intermediate', pagenum)] = True
+    return entries
+
+def page_fields(page):
+    """
+    Returns a dict of the PAGE_FIELDS values for the given page
+    """
+    return {
+            'character': page.character.name,
+            'summary': page.summary,
+            'canonical': page.canonical,
+            'ending': page.ending,
+        }
+
+def sortkey_entries(key):
+    """
+    Used by sorted() calls against book_entries() keys.  Sorts the title
+    first, then characters, then everything to do with each page in
+    page order.
+    """
+    if key[0] == 'title':
+        return (0, '', 0, '')
+    elif key[0] == 'character':
+        return (1, key[1], 0, '')
+    elif key[0] == 'choice':
+        return (2, sortkey_pages(key[1]), 1, sortkey_pages(key[2]))
+    elif key[0] == 'page' and len(key) == 3:
+        return (2, sortkey_pages(key[1]), 0, key[2])
+    else:
+        return (2, sortkey_pages(key[1]), 0, '')
+
+def diff_books(old, new):
+    """
+    Compares two books, and returns a sorted list of differences as
+    (status, key, old value, new value) tuples, where status is one of
+    'added', 'removed' or 'changed', and key is a book_entries() key.
+    Values are None where the entry doesn't exist.  Pages which were
+    added or removed entirely are reported once, with a key of ('page',
+    pagenum) and a dict of PAGE_FIELDS as the value.
+    """
+    old_entries = book_entries(old)
+    new_entries = book_entries(new)
+    changes = []
+    for (key, old_value) in old_entries.items():
+        if key not in new_entries:
+            if key[0] != 'page':
+                changes.append(('removed', key, old_value, None))
+            elif key[2] == 'character':
+                page = old.pages[key[1]]
+                changes.append(('removed', key[:2], page_fields(page), None))
+        elif new_entries[key] != old_value:
+            changes.append(('changed', key, old_value, new_entries[key]))
+    for (key, new_value) in new_entries.items():
+        if key not in old_entries:
+            if key[0] != 'page':
+                changes.append(('added', key, None, new_value))
+            elif key[2] == 'character':
+                page = new.pages[key[1]]
+                changes.append(('added', key[:2], None, page_fields(page)))
+    return sorted(changes, key=lambda change: sortkey_entries(change[1]))
+
+def merge_books(base, ours, theirs):
+    """
+    Three-way merges two books which were both changed from a common base
+    book.  Anything changed on only one side (or changed the same way on
+    both) is merged automatically.  Anything changed differently on both
+    sides is a conflict, and our version wins.  Returns a tuple of the
+    merged book and a sorted list of conflicts, as (key, base value, our
+    value, their value) tuples, where key is a book_entries() key and
+    values are None where the entry doesn't exist.
+    """
+    base_entries = book_entries(base)
+    our_entries = book_entries(ours)
+    their_entries = book_entries(theirs)
+
+    merged = {}
+    conflicts = []
+    for key in set(our_entries) | set(their_entries):
+        base_value = base_entries.get(key)
+        our_value = our_entries.get(key)
+        their_value = their_entries.get(key)
+        if our_value == their_value or their_value == base_value:
+            value = our_value
+        elif our_value == base_value:
+            value = their_value
+        else:
+            conflicts.append((key, base_value, our_value, their_value))
+            value = our_value
+        if value is not None:
+            merged[key] = value
+
+    # Merging key-by-key can leave some loose ends behind when one side
+    # deleted a page (or character) which the other side was still using.
+    # In that case we keep the page around, and call it a conflict.
+    conflicted = set([conflict[0] for conflict in conflicts])
+    pagenums = set()
+    charnames = set()
+    for key in list(merged.keys()):
+        if key[0] == 'page' or key[0] == 'choice':
+            pagenums.add(key[1])
+    for pagenum in pagenums:
+        missing = [field for field in PAGE_FIELDS if ('page', pagenum, field) not in merged]
+        if len(missing) == 0:
+            continue
+        for field in missing:
+            key = ('page', pagenum, field)
+            for entries in (our_entries, their_entries, base_entries):
+                if key in entries:
+                    merged[key] = entries[key]
+                    break
+        if not any([('page', pagenum, field) in conflicted for field in PAGE_FIELDS]):
+            key = ('page', pagenum, 'summary')
+            conflicts.append((key, base_entries.get(key), our_entries.get(key), their_entries.get(key)))
+    for pagenum in pagenums:
+        charnames.add(merged[('page', pagenum, 'character')])
+    for name in charnames:
+        key = ('character', name)
+        if key not in merged:
+            merged[key] = our_entries.get(key, their_entries.get(key))
+            if key not in conflicted:
+                conflicts.append((key, base_entries.get(key), our_entries.get(key), their_entries.get(key)))
+
+    # Now build the merged book back up
+    book = Book(merged.get(('title',), ours.title))
+    book.string_table = ours.string_table
+    for (key, value) in merged.items():
+        if key[0] == 'character':
+            book.add_character_obj(Character.from_dict(value))
+    for pagenum in pagenums:
+        book.add_page_obj(Page(pagenum,
+            character=book.characters[merged[('page', pagenum, 'character')]],
+            summary=merged[('page', pagenum, 'summary')],
+            canonical=merged[('page', pagenum, 'canonical')],
+            ending=merged[('page', pagenum, 'ending')]))
+    for (key, value) in merged.items():
+        if key[0] == 'choice':
+            book.pages[key[1]].add_choice(key[2], value)
+        elif key[0] == 'intermediate':
+            book.add_intermediate(key[1])
+
+    return (book, sorted(conflicts, key=lambda conflict: sortkey_entries(conflict[0])))
+
+def lint_book(book, start=1, savedict=None):
+    """
+    Checks a book for structural problems which the UI wouldn't let you
+    create, but which can still turn up in a hand-edited (or badly
+    merged) YAML file.  Every page and choice is only looked at once, so
+    this is cheap enough to run whenever a book is loaded.  Loading a
+    book ignores the keys of the "pages" and "choices" dicts in the YAML,
+    so pass in the savedict the book was loaded from to check those too.
+    Returns a list of (code, pagenum, message) tuples, sorted by page
+    number, where code is one of:
+
+        bad-pagenum         A page number which isn't an int or a str
+        reserved-pagenum    A non-numeric page number we can't use (see
+                            check_pagenum)
+        page-key-mismatch   A page stored under a different page number
+                            than its own
+        choice-key-mismatch A choice stored under a different target
+                            than its own
+        unknown-character   A page owned by a character not in the book
+        page-and-intermediate  A page which is also an intermediate page
+        missing-start       The start page doesn't exist
+        unreachable         A page which can't be reached from the start
+
+    pagenum will be None for problems with the book as a whole.
+    """
+    problems = []
+
+    if savedict is not None:
+        for (key, pagedict) in savedict['pages'].items():
+            if pagedict['pagenum'] != key:
+                problems.append(('page-key-mismatch', pagedict['pagenum'], 'Page %s is stored as page %s' % (
+                    pagedict['pagenum'], key)))
+            for (target, choicedict) in pagedict['choices'].items():
+                if choicedict['target'] != target:
+                    problems.append(('choice-key-mismatch', pagedict['pagenum'],
+                        'Choice to %s on page %s is stored as a choice to %s' % (
+                            choicedict['target'], pagedict['pagenum'], target)))
+
+    def check_number(pagenum, what):
+        if not isinstance(pagenum, (int, str)) or isinstance(pagenum, bool):
+            problems.append(('bad-pagenum', pagenum, '%s %r is not a valid page number' % (what, pagenum)))
+            return
+        problem = check_pagenum(pagenum)
+        if problem is not None:
+            problems.append(('reserved-pagenum', pagenum, '%s %s: %s' % (what, pagenum, problem)))
+
+    def check_page(key, page):
+        check_number(key, 'Page')
+        if page.pagenum != key:
+            problems.append(('page-key-mismatch', key, 'Page %s is stored as page %s' % (page.pagenum, key)))
+        if book.characters.get(page.character.name) is not page.character:
+            problems.append(('unknown-character', key, 'Page %s belongs to unknown character "%s"' % (
+                key, page.character.name)))
+        if key in book.intermediates:
+            problems.append(('page-and-intermediate', key, 'Page %s is also an intermediate page' % (key)))
+        for (target, choice) in page.choices.items():
+            if choice.target != target:
+                problems.append(('choice-key-mismatch', key, 'Choice to %s on page %s is stored as a choice to %s' % (
+                    choice.target, key, target)))
+            if target not in book.pages:
+                check_number(target, 'Choice on page %s to' % (key))
+
+    # Walk the book from the start page, checking pages as we find them,
+    # and then check whatever we didn't find.
+    reached = set()
+    if start in book.pages:
+        reached.add(start)
+        queue = [start]
+        while len(queue) > 0:
+            pagenum = queue.pop()
+            page = book.pages[pagenum]
+            check_page(pagenum, page)
+            for target in page.choices.keys():
+                if target in book.pages and target not in reached:
+                    reached.add(target)
+                    queue.append(target)
+    elif len(book.pages) > 0:
+        problems.append(('missing-start', None, 'Start page %s does not exist' % (start)))
+    for (pagenum, page) in book.pages.items():
+        if pagenum not in reached:
+            check_page(pagenum, page)
+            if start in book.pages:
+                problems.append(('unreachable', pagenum, 'Page %s cannot be reached from page %s' % (pagenum, start)))
+
+    for pagenum in book.intermediates.keys():
+        if pagenum not in book.pages:
+            check_number(pagenum, 'Intermediate page')
+
+    return sorted(problems, key=lambda problem: sortkey_pages(problem[1]) if isinstance(problem[1], (int, str)) else '')
+
+def format_problem(filename, code, pagenum, message):
+    """
+    Formats a problem found by lint_book for printing, as "filename: page
+    PAGENUM: code: message" (or without the page, for problems with the
+    book as a whole).  The page isn't given as "filename:PAGENUM:", since
+    editors and the like would read that as a line number.
+    """
+    if pagenum is None:
+        return '%s: %s: %s' % (filename, code, message)
+    return '%s: page %s: %s: %s' % (filename, pagenum, code, message)
+
+class BookError(Exception):
+    """
+    Raised by BookEngine when it's asked to do something which can't be
+    done.  kind says what sort of problem it is (see the constants below),
+    so that front ends can report it however they like.
+    """
+
+    INVALID = 'invalid'
+    NOT_FOUND = 'not found'
+    CONFLICT = 'conflict'
+
+    def __init__(self, kind, message):
+        super(BookError, self).__init__(message)
+        self.kind = kind
+        self.message = message
+
+class BookEngine(object):
+    """
+    Headless access to a Book, for use from other Python code (and by the
+    App, --query, and --serve).  Nothing in here prompts or prints;
+    queries return plain lists and dicts (which can go straight out as
+    JSON), and changes are checked before they're made, raising a
+    BookError if they can't be.  The Book itself is available as .book,
+    for anything that isn't covered here.
+    """
+
+    # Re-exported so that code which is handed an engine (like
+    # choosable_server) doesn't have to import us to catch errors
+    Error = BookError
+
+    # The queries which query() knows about, and the arguments they take.
+    # Arguments named PAGE, FROM or TO are page numbers.
+    QUERIES = {
+            'info': [],
+            'stats': [],
+            'pages': [],
+            'frontier': [],
+            'lint': [],
+            'page': ['PAGE'],
+            'choices': ['PAGE'],
+            'reachable': ['PAGE'],
+            'route': ['FROM', 'TO'],
+            'paths': ['FROM', 'TO'],
+            'search': ['TEXT'],
+            'report': [],
+            'odds': ['PAGE'],
+            'list': ['FILTER'],
+        }
+    PAGE_ARGS = ['PAGE', 'FROM', 'TO']
+
+    def __init__(self, book):
+        self.book = book
+
+        # Problems found when the book was loaded with check=True
+        # (see lint_book)
+        self.problems = []
+
+    @staticmethod
+    def load(filename, check=False):
+        """
+        Loads the given book file and returns an engine for it.  If check
+        is set, the book will also be checked for problems, which end up
+        in our problems attribute.
+        """
+        if not check:
+            return BookEngine(Book.load(filename))
+        savedict = Book.read_savedict(filename)
+        book = Book.load_from_dict(savedict)
+        book.filename = filename
+        engine = BookEngine(book)
+        engine.problems = lint_book(book, savedict=savedict)
+        return engine
+
+    def save(self, filename=None):
+        """
+        Saves the book, to the given filename or wherever it was loaded from
+        """
+        self.book.save(filename)
+
+    ###
+    ### Helpers
+    ###
+
+    @staticmethod
+    def parse_pagenum(value):
+        """
+        Page numbers are ints if they look like one, otherwise strings.
+        Raises a BookError if the result isn't a page number we can use.
+        """
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
+        if value is None or value == '':
+            raise BookError(BookError.INVALID, 'A page number is required')
+        problem = check_pagenum(value)
+        if problem is not None:
+            raise BookError(BookError.INVALID, problem)
+        return value
+
+    def lookup_page(self, pagenum):
+        """
+        Returns the given page, or raises a BookError
+        """
+        if pagenum not in self.book.pages:
+            raise BookError(BookError.NOT_FOUND, 'Page %s not found' % (pagenum))
+        return self.book.pages[pagenum]
+
+    def lookup_character(self, name):
+        """
+        Returns the given character, or raises a BookError
+        """
+        if name not in self.book.characters:
+            raise BookError(BookError.INVALID, 'Character "%s" not found' % (name))
+        return self.book.characters[name]
+
+    def page_data(self, page, choices=True):
+        """
+        Returns the data for a page, optionally including its choices
+        """
+        data = {
+                'pagenum': page.pagenum,
+                'character': page.character.name,
+                'summary': page.summary,
+                'canonical': page.canonical,
+                'ending': page.ending,
+                'from': sorted(self.book.inbound.get(page.pagenum, ()), key=sortkey_pages),
+                'digest': page.digest(),
+            }
+        if choices:
+            data['choices'] = [self.choice_data(choice) for choice in page.choices_sorted()]
+        return data
+
+    def choice_data(self, choice):
+        """
+        Returns the data for a choice
+        """
+        return {
+                'target': choice.target,
+                'summary': choice.summary,
+                'visited': choice.target in self.book.pages,
+            }
+
+    ###
+    ### Queries
+    ###
+
+    def info(self):
+        """
+        Title, characters, statistics, and the book digest (see
+        Book.digest)
+        """
+        return {
+                'title': self.book.title,
+                'characters': [char.name for char in self.book.characters_sorted()],
+                'stats': self.stats(),
+                'digest': self.book.digest(),
+            }
+
+    def stats(self):
+        """
+        Statistics about the book (see Book.statistics)
+        """
+        return self.book.statistics()
+
+    def pages(self):
+        """
+        All pages, without their choices
+        """
+        return [self.page_data(page, choices=False) for page in self.book.pages_sorted()]
+
+    def page(self, pagenum):
+        """
+        A single page, with its choices
+        """
+        return self.page_data(self.lookup_page(pagenum))
+
+    def choices(self, pagenum):
+        """
+        The choices on a page
+        """
+        return [self.choice_data(choice) for choice in self.lookup_page(pagenum).choices_sorted()]
+
+    def frontier(self):
+        """
+        Every choice leading to a page we haven't visited yet
+        """
+        frontier = []
+        for target in sorted(self.book.inbound.keys(), key=sortkey_pages):
+            if target in self.book.pages:
+                continue
+            for source in sorted(self.book.inbound[target], key=sortkey_pages):
+                frontier.append({
+                        'target': target,
+                        'summary': self.book.pages[source].choices[target].summary,
+                        'from': source,
+                    })
+        return frontier
+
+    def search(self, text, limit=None):
+        """
+        Searches page summaries, and choices leading to unvisited pages
+        (see Book.search)
+        """
+        results = []
+        for (score, result) in self.book.search(text, limit=limit):
+            if isinstance(result, tuple):
+                (page, choice) = result
+                results.append({
+                        'score': score,
+                        'type': 'choice',
+                        'from': page.pagenum,
+                        'target': choice.target,
+                        'summary': choice.summary,
+                    })
+            else:
+                results.append({
+                        'score': score,
+                        'type': 'page',
+                        'pagenum': result.pagenum,
+                        'summary': result.summary,
+                    })
+        return results
+
+    def reachable(self, pagenum):
+        """
+        How many endings and unvisited pages can be reached from a page
+        """
+        self.lookup_page(pagenum)
+        (endings, unvisited) = self.book.reachable_counts(pagenum)
+        return {'endings': endings, 'unvisited': unvisited}
+
+    def route(self, source, target, prefer_canon=False):
+        """
+        The shortest list of pages leading from source to target, or
+        None if there isn't one (see Book.route)
+        """
+        self.lookup_page(source)
+        return self.book.route(source, target, prefer_canon=prefer_canon)
+
+    def paths(self, source, target):
+        """
+        How many different ways there are of getting from source to target
+        by following choices (see GraphSnapshot.path_counts).  If there's
+        a loop reachable from source there'd be no end to them, so that's
+        an error.
+        """
+        self.lookup_page(source)
+        snapshot = self.book.snapshot()
+        try:
+            counts = snapshot.path_counts(snapshot.index[source])
+        except Exception as e:
+            raise BookError(BookError.INVALID, str(e))
+        if target in snapshot.index:
+            paths = counts[snapshot.index[target]]
+        else:
+            paths = 0
+        return {'from': source, 'to': target, 'paths': paths}
+
+    def report(self):
+        """
+        Statistics about the shape of the book, starting from page 1 (see
+        graph_report).  Requires NumPy.
+        """
+        if not import_numpy():
+            raise BookError(BookError.INVALID, 'The statistics report requires NumPy')
+        return graph_report(self.book.snapshot())
+
+    def character_pagenums(self):
+        """
+        Splits the book up into each character's storyline, for graphing
+        them separately.  Returns a list of (character name, set of page
+        numbers) tuples for every character with any pages, in the same
+        order as the character key.  Each set has the character's pages
+        plus the unvisited pages they lead to, so that choices which hand
+        over to another character are the only ones left as stubs (see
+        dot_lines).
+        """
+        storylines = []
+        for char in self.book.characters_sorted():
+            if char.name not in self.book.character_pages:
+                continue
+            pagenums = set(self.book.character_pages[char.name])
+            for pagenum in self.book.character_pages[char.name]:
+                for target in self.book.pages[pagenum].choices.keys():
+                    if target not in self.book.pages:
+                        pagenums.add(target)
+            storylines.append((char.name, pagenums))
+        return storylines
+
+    def odds(self, pagenum):
+        """
+        If a reader starts at the given page and picks choices at random,
+        the chances of them finishing on an ending, a dead end, an
+        unvisited page, or never finishing at all, the expected number of
+        pages they'll read (None if they might never finish), and the
+        chance of finishing on each particular page (see reading_outcomes)
+        """
+        self.lookup_page(pagenum)
+        snapshot = self.book.snapshot()
+        (outcomes, length) = reading_outcomes(snapshot, snapshot.index[pagenum])
+        result = {
+                'ending': 0.0,
+                'dead_end': 0.0,
+                'unvisited': 0.0,
+                'length': length,
+                'outcomes': [],
+            }
+        for (idx, chance) in outcomes.items():
+            if idx >= snapshot.num_visited:
+                kind = 'unvisited'
+            elif snapshot.ending[idx]:
+                kind = 'ending'
+            else:
+                kind = 'dead_end'
+            result[kind] += chance
+            result['outcomes'].append({'pagenum': snapshot.pagenums[idx], 'type': kind, 'chance': chance})
+        if length is None:
+            result['never'] = max(0.0, 1.0 - result['ending'] - result['dead_end'] - result['unvisited'])
+        else:
+            result['never'] = 0.0
+        result['outcomes'].sort(key=lambda outcome: (-outcome['chance'], sortkey_pages(outcome['pagenum'])))
+        return result
+
+    def page_odds(self):
+        """
+        The chances of a reader picking choices at random finishing on an
+        ending, a dead end, or an unvisited page, and the expected number
+        of pages read, starting from every visited page (see
+        reading_odds).  Returns a dict mapping page numbers to dicts.
+        """
+        snapshot = self.book.snapshot()
+        odds = reading_odds(snapshot)
+        result = {}
+        for (idx, pagenum) in enumerate(snapshot.pagenums[:snapshot.num_visited]):
+            result[pagenum] = {
+                    'ending': odds['ending'][idx],
+                    'dead_end': odds['dead_end'][idx],
+                    'unvisited': odds['unvisited'][idx],
+                    'length': odds['length'][idx],
+                }
+        return result
+
+    def lint(self):
+        """
+        Structural problems with the book (see lint_book)
+        """
+        return [{'code': code, 'pagenum': pagenum, 'message': message}
+                for (code, pagenum, message) in lint_book(self.book)]
+
+    def listing(self, character=None, canonical=None, ending=None, first=None, last=None, visited=True, text=None):
+        """
+        Yields a (pagenum, page) tuple for every page in the book, in
+        order, with intermediate pages mixed in (as (pagenum, None)).
+        Pages are only looked at as they're asked for, so stopping part
+        of the way through a huge book doesn't cost anything.
+
+        The listing can be narrowed down by character name, by the
+        canonical and ending flags (True or False), by a range of page
+        numbers (first and last, both included), and by some text which
+        has to be in the page summary (ignoring case).  visited=False
+        lists the pages that choices lead to which we haven't visited
+        yet instead, and visited=None lists both; those are also yielded
+        as (pagenum, None), so check book.intermediates to tell them
+        apart.  Intermediate and unvisited pages don't have a character,
+        flags, or summary, so they're left out if any of those filters
+        are used.
+        """
+        if character is not None:
+            self.lookup_character(character)
+        if text is not None:
+            text = text.lower()
+
+        # Start from the smallest index we've been given, so that filtered
+        # listings only cost as much as the pages they could match.
+        candidates = []
+        if visited is not False:
+            sets = []
+            if character is not None:
+                sets.append(self.book.character_pages.get(character, set()))
+            if canonical:
+                sets.append(self.book.canonical_pages)
+            if ending:
+                sets.append(self.book.ending_pages)
+            if len(sets) > 0:
+                candidates.extend(min(sets, key=len))
+            else:
+                candidates.extend(self.book.pages.keys())
+        others = (character is None and canonical is None and ending is None and text is None)
+        if others and visited is not False:
+            candidates.extend(self.book.intermediates.keys())
+        if others and visited is not True:
+            candidates.extend([pagenum for pagenum in self.book.inbound.keys()
+                if pagenum not in self.book.pages and pagenum not in self.book.intermediates])
+
+        if first is not None or last is not None:
+            low = None if first is None else sortkey_pages(first)
+            high = None if last is None else sortkey_pages(last)
+            candidates = [pagenum for pagenum in candidates
+                if (low is None or sortkey_pages(pagenum) >= low) and
+                    (high is None or sortkey_pages(pagenum) <= high)]
+
+        for pagenum in sorted(candidates, key=sortkey_pages):
+            page = self.book.pages.get(pagenum)
+            if page is None:
+                yield (pagenum, None)
+                continue
+            if character is not None and page.character.name != character:
+                continue
+            if canonical is not None and page.canonical != bool(canonical):
+                continue
+            if ending is not None and page.ending != bool(ending):
+                continue
+            if text is not None and text not in page.summary.lower():
+                continue
+            yield (pagenum, page)
+
+    @staticmethod
+    def parse_listing_filter(filter_text):
+        """
+        Turns a filter typed in by the user into keyword arguments for
+        listing.  The filter is a list of words: "canon", "noncanon",
+        "ending", "nonending", "unvisited", "all" (visited and unvisited
+        pages), "char:NAME", and page ranges like "10-50", "10-" or
+        "-50".  Anything else is text to look for in the page summaries.
+        Names with spaces in them can be quoted.  Raises a BookError if
+        the filter can't be understood.
+        """
+        import shlex
+        try:
+            words = shlex.split(filter_text)
+        except ValueError as e:
+            raise BookError(BookError.INVALID, 'Invalid filter: %s' % (e))
+        flags = {
+                'canon': ('canonical', True),
+                'noncanon': ('canonical', False),
+                'ending': ('ending', True),
+                'nonending': ('ending', False),
+                'unvisited': ('visited', False),
+                'all': ('visited', None),
+            }
+        args = {}
+        text = []
+        for word in words:
+            lower = word.lower()
+            match = re.match(r'^(\d*)-(\d*)$', word)
+            if lower in flags:
+                (key, value) = flags[lower]
+                args[key] = value
+            elif lower.startswith('char:'):
+                if word[5:] == '':
+                    raise BookError(BookError.INVALID, 'A character name is required after "char:"')
+                args['character'] = word[5:]
+            elif match and word != '-':
+                if match.group(1) != '':
+                    args['first'] = int(match.group(1))
+                if match.group(2) != '':
+                    args['last'] = int(match.group(2))
+            else:
+                text.append(word)
+        if len(text) > 0:
+            args['text'] = ' '.join(text)
+        return args
+
+    def list(self, filter_text, offset=0, limit=None):
+        """
+        Pages matching a filter (see parse_listing_filter), without their
+        choices, skipping the first offset matches and stopping after
+        limit of them.  Intermediate and unvisited pages are just listed
+        by number, with a "type" of "intermediate" or "unvisited".
+        """
+        import itertools
+        if offset < 0 or (limit is not None and limit < 0):
+            raise BookError(BookError.INVALID, 'Offsets and limits cannot be negative')
+        listing = self.listing(**BookEngine.parse_listing_filter(filter_text))
+        if limit is None:
+            listing = itertools.islice(listing, offset, None)
+        else:
+            listing = itertools.islice(listing, offset, offset + limit)
+        results = []
+        for (pagenum, page) in listing:
+            if page is not None:
+                results.append(self.page_data(page, choices=False))
+            elif pagenum in self.book.intermediates:
+                results.append({'pagenum': pagenum, 'type': 'intermediate'})
+            else:
+                results.append({'pagenum': pagenum, 'type': 'unvisited'})
+        return results
+
+    def query(self, words, prefer_canon=False):
+        """
+        Runs a query given as a list of words (the query name and then
+        its arguments, as strings) and returns the result.  See QUERIES
+        for what's available.  Used for --query.
+        """
+        if len(words) == 0 or words[0] not in BookEngine.QUERIES:
+            raise BookError(BookError.INVALID, 'Unknown query, must be one of: %s' % (
+                ', '.join(sorted(BookEngine.QUERIES.keys()))))
+        name = words[0]
+        argnames = BookEngine.QUERIES[name]
+        args = list(words[1:])
+        if name == 'list':
+            args = [' '.join(args)]
+        elif name == 'search' and len(args) > 0:
+            args = [' '.join(args)]
+        if len(args) != len(argnames):
+            raise BookError(BookError.INVALID, 'Usage: %s' % (' '.join([name] + argnames)))
+        for (idx, argname) in enumerate(argnames):
+            if argname in BookEngine.PAGE_ARGS:
+                args[idx] = self.parse_pagenum(args[idx])
+        if name == 'route':
+            return self.route(args[0], args[1], prefer_canon=prefer_canon)
+        return getattr(self, name)(*args)
+
+    ###
+    ### Graphviz
+    ###
+
+    def dot_lines(self, graph_name, pagenums=None, title=None, collapse=False, odds=False):
+        """
+        Yields the lines of a Graphviz DOT file for the book (see
+        dot_lines).  If odds is set, each page is labelled with its
+        chance of leading to an ending and the expected number of pages
+        read from it (see page_odds).
+        """
+        annotations = None
+        if odds:
+            annotations = {}
+            for (pagenum, page_odds) in self.page_odds().items():
+                if page_odds['length'] is None:
+                    length = 'may never end'
+                else:
+                    length = '%0.1f pages' % (page_odds['length'])
+                annotations[pagenum] = '%d%% ending, %s' % (round(100 * page_odds['ending']), length)
+        return dot_lines(self.book, graph_name, pagenums=pagenums, title=title, collapse=collapse,
+            annotations=annotations)
+
+    def write_dot(self, dot_filename, pagenums=None, title=None, collapse=False, odds=False):
+        """
+        Writes a Graphviz DOT file for the book (or just the given set of
+        page numbers), overwriting anything already there.  We write to a
+        temporary file first, so that any renders which are still running
+        from an older version of the file don't get confused.  If collapse
+        is set, returns a dict describing what got collapsed ("chains" and
+        "removed", and for whole books "nodes" and "choices" before
+        collapsing), otherwise None.  odds is passed on to dot_lines.
+        """
+        graph_name = dot_filename.split('.')[0]
+        tmp_filename = '%s.tmp' % (dot_filename)
+        with open(tmp_filename, 'w') as df:
+            for line in self.dot_lines(graph_name, pagenums=pagenums, title=title, collapse=collapse, odds=odds):
+                df.write(line)
+        replace_file(tmp_filename, dot_filename)
+
+        if not collapse:
+            return None
+        chains = linear_chains(self.book, pagenums)
+        report = {
+                'chains': len(chains),
+                'removed': sum([len(chain)-1 for chain in chains.values()]),
+            }
+        if pagenums is None:
+            report['nodes'] = len(self.book.pages) + len([t for t in self.book.inbound.keys() if t not in self.book.pages])
+            report['choices'] = sum([len(sources) for sources in self.book.inbound.values()])
+        return report
+
+    def write_export(self, filename, export_format=None):
+        """
+        Writes the book out as GraphML, GEXF, or node-link JSON (see
+        EXPORT_FORMATS), overwriting anything already there.  The format
+        defaults to the filename's extension.  Lines are written as
+        they're generated, so this doesn't need much memory even for
+        huge books.
+        """
+        if export_format is None:
+            export_format = filename.split('.')[-1].lower()
+        if export_format not in EXPORT_FORMATS:
+            raise BookError(BookError.INVALID, 'Unknown export format "%s", must be one of: %s' % (
+                export_format, ', '.join(sorted(EXPORT_FORMATS.keys()))))
+        tmp_filename = '%s.tmp' % (filename)
+        with open(tmp_filename, 'w') as df:
+            for line in EXPORT_FORMATS[export_format](self.book):
+                df.write(line)
+        replace_file(tmp_filename, filename)
+
+    ###
+    ### Changes
+    ###
+
+    def set_title(self, title):
+        """
+        Changes the book title
+        """
+        if title == '':
+            raise BookError(BookError.INVALID, 'The book title cannot be empty')
+        self.book.title = title
+
+    def add_character(self, name):
+        """
+        Adds a new character, and returns its name
+        """
+        if name == '':
+            raise BookError(BookError.INVALID, 'Character names cannot be empty')
+        if name in self.book.characters:
+            raise BookError(BookError.CONFLICT, 'Character "%s" already exists' % (name))
+        return self.book.add_character(name).name
+
+    def create_page(self, pagenum, character, summary, canonical=False, ending=False):
+        """
+        Creates a new page, and returns its data
+        """
+        pagenum = self.parse_pagenum(pagenum)
+        if pagenum in self.book.pages:
+            raise BookError(BookError.CONFLICT, 'Page %s already exists' % (pagenum))
+        if self.book.has_intermediate(pagenum):
+            raise BookError(BookError.CONFLICT, 'Page %s is already set as an intermediate page' % (pagenum))
+        character = self.lookup_character(character)
+        if summary == '':
+            raise BookError(BookError.INVALID, 'Page summaries cannot be empty')
+        page = self.book.add_page(pagenum, character=character, summary=summary)
+        if canonical:
+            page.toggle_canonical()
+        if ending:
+            page.toggle_ending()
+        return self.page_data(page)
+
+    def update_page(self, pagenum, character=None, summary=None, canonical=None, ending=None):
+        """
+        Changes whichever of the page's attributes aren't None, and
+        returns its new data.  Nothing is changed unless everything's
+        valid.
+        """
+        page = self.lookup_page(pagenum)
+        if character is not None:
+            character = self.lookup_character(character)
+        if summary == '':
+            raise BookError(BookError.INVALID, 'Page summaries cannot be empty')
+        if character is not None:
+            page.set_character(character)
+        if summary is not None:
+            page.set_summary(summary)
+        if canonical is not None and bool(canonical) != page.canonical:
+            page.toggle_canonical()
+        if ending is not None and bool(ending) != page.ending:
+            page.toggle_ending()
+        return self.page_data(page)
+
+    def delete_page(self, pagenum):
+        """
+        Deletes a page (but never the last one in the book)
+        """
+        self.lookup_page(pagenum)
+        if len(self.book.pages) == 1:
+            raise BookError(BookError.CONFLICT, 'Refusing to delete the last page in the book')
+        self.book.delete_page(pagenum)
+
+    def add_choice(self, pagenum, target, summary):
+        """
+        Adds a choice to a page, and returns its data
+        """
+        page = self.lookup_page(pagenum)
+        target = self.parse_pagenum(target)
+        if summary == '':
+            raise BookError(BookError.INVALID, 'Choice summaries cannot be empty')
+        if target in page.choices:
+            raise BookError(BookError.CONFLICT, 'Target %s already exists on page %s' % (target, pagenum))
+        return self.choice_data(page.add_choice(target, summary))
+
+    def delete_choice(self, pagenum, target):
+        """
+        Deletes a choice from a page
+        """
+        page = self.lookup_page(pagenum)
+        if target not in page.choices:
+            raise BookError(BookError.NOT_FOUND, 'Choice with target of %s not found on page %s' % (target, pagenum))
+        page.delete_choice(target)
+
+    def add_intermediate(self, pagenum):
+        """
+        Marks a page number as an intermediate page
+        """
+        pagenum = self.parse_pagenum(pagenum)
+        if pagenum in self.book.pages:
+            raise BookError(BookError.CONFLICT, 'Page %s already exists' % (pagenum))
+        self.book.add_intermediate(pagenum)
+
+    def delete_intermediate(self, pagenum):
+        """
+        Unmarks a page number as an intermediate page
+        """
+        if not self.book.has_intermediate(pagenum):
+            raise BookError(BookError.NOT_FOUND, 'Page %s is not an intermediate page' % (pagenum))
+        self.book.delete_intermediate(pagenum)
+
+# Graphviz colors are the X11 set, and SVG only knows the CSS set.  The two
+# mostly agree on names, but X11 has numbered variants (and the odd name
+# of its own) which CSS doesn't.  This covers the ones we've got in the
+# examples plus a few common ones; other numbered colors will fall back
+# to their un-numbered base name, which is close enough.
+GRAPHVIZ_COLORS = {
+        'azure1': '#f0ffff', 'azure2': '#e0eeee', 'azure3': '#c1cdcd', 'azure4': '#838b8b',
+        'blue1': '#0000ff', 'blue2': '#0000ee', 'blue3': '#0000cd', 'blue4': '#00008b',
+        'brown1': '#ff4040', 'brown2': '#ee3b3b', 'brown3': '#cd3333', 'brown4': '#8b2323',
+        'burlywood1': '#ffd39b', 'burlywood2': '#eec591', 'burlywood3': '#cdaa7d', 'burlywood4': '#8b7355',
+        'cadetblue1': '#98f5ff', 'cadetblue2': '#8ee5ee', 'cadetblue3': '#7ac5cd', 'cadetblue4': '#53868b',
+        'chartreuse1': '#7fff00', 'chartreuse2': '#76ee00', 'chartreuse3': '#66cd00', 'chartreuse4': '#458b00',
+        'darkgoldenrod1': '#ffb90f', 'darkgoldenrod2': '#eead0e', 'darkgoldenrod3': '#cd950c', 'darkgoldenrod4': '#8b6508',
+        'darkorchid1': '#bf3eff', 'darkorchid2': '#b23aee', 'darkorchid3': '#9a32cd', 'darkorchid4': '#68228b',
+        'green1': '#00ff00', 'green2': '#00ee00', 'green3': '#00cd00', 'green4': '#008b00',
+        'hotpink1': '#ff6eb4', 'hotpink2': '#ee6aa7', 'hotpink3': '#cd6090', 'hotpink4': '#8b3a62',
+        'orange1': '#ffa500', 'orange2': '#ee9a00', 'orange3': '#cd8500', 'orange4': '#8b5a00',
+        'red1': '#ff0000', 'red2': '#ee0000', 'red3': '#cd0000', 'red4': '#8b0000',
+        'skyblue1': '#87ceff', 'skyblue2': '#7ec0ee', 'skyblue3': '#6ca6cd', 'skyblue4': '#4a708b',
+        'yellow1': '#ffff00', 'yellow2': '#eeee00', 'yellow3': '#cdcd00', 'yellow4': '#8b8b00',
+        'navyblue': '#000080',
+    }
+
+def svg_color(color):
+    """
+    Converts a Graphviz color name into something SVG will understand.
+    """
+    color = color.lower()
+    if color in GRAPHVIZ_COLORS:
+        return GRAPHVIZ_COLORS[color]
+    for prefix in ['gray', 'grey']:
+        if color.startswith(prefix) and color[len(prefix):].isdigit():
+            value = int(round(int(color[len(prefix):]) * 255 / 100.0))
+            return '#%02x%02x%02x' % (value, value, value)
+    return color.rstrip('0123456789')
+
+def xml_escape(text):
+    """
+    Escapes text for inclusion in XML output (SVG, GraphML, and GEXF)
+    """
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+class LayeredLayout(object):
+    """
+    A Sugiyama-style layered layout of a book's page graph, so that we can
+    draw graphs without needing Graphviz at all.  It's nowhere near as
+    pretty as what dot produces, but it's a lot quicker on big books.  The
+    steps are the usual ones: break cycles, assign each page to a rank,
+    stick dummy nodes on edges which span more than one rank, reorder each
+    rank to reduce edge crossings (barycenter heuristic), and then assign
+    X coordinates.  The iterative bits work on NumPy arrays, so NumPy is
+    required.
+    """
+
+    FONT_SIZE = 14
+    CHAR_WIDTH = 7.5
+    NODE_HEIGHT = 36
+    NODE_PADDING = 24
+    NODE_GAP = 20
+    DUMMY_WIDTH = 4
+    RANK_GAP = 70
+
+    def __init__(self, book, order_passes=12, coord_passes=20):
+
+        if not import_numpy():
+            raise Exception('The built-in renderer requires NumPy.  See https://pypi.python.org/pypi/numpy')
+
+        self.book = book
+        self.order_passes = order_passes
+        self.coord_passes = coord_passes
+
+        # Real nodes are indexed in page order, and dummy nodes get
+        # tacked onto the end once we know how many we need.
+        self.nodes = graph_nodes(book)
+        self.node_ids = sorted(self.nodes.keys(), key=sortkey_pages)
+        self.index = dict([(pagenum, idx) for (idx, pagenum) in enumerate(self.node_ids)])
+        self.num_real = len(self.node_ids)
+
+        # (source, target) index pairs for every choice.  Choices which
+        # loop back to their own page don't participate in the layout.
+        self.edges = []
+        self.self_loops = []
+        for page in book.pages_sorted():
+            for choice in page.choices_sorted():
+                source = self.index[page.pagenum]
+                target = self.index[choice.target]
+                if source == target:
+                    self.self_loops.append(source)
+                else:
+                    self.edges.append((source, target))
+
+        self.widths = None
+        self.ranks = None
+        self.layers = None
+        self.chains = None
+        self.x = None
+        self.crossings = None
+
+    def run(self):
+        """
+        Performs the whole layout, and returns ourselves
+        """
+        reversed_edges = self.remove_cycles()
+        self.assign_ranks(reversed_edges)
+        self.add_dummies(reversed_edges)
+        self.order_layers()
+        self.assign_coordinates()
+        return self
+
+    def remove_cycles(self):
+        """
+        Does a depth-first search (in page order, so that page 1 is
+        generally the root) and returns the set of edges which point back
+        up the search tree.  Flipping those edges around makes the graph
+        acyclic.
+        """
+        children = [[] for idx in range(self.num_real)]
+        for (source, target) in self.edges:
+            children[source].append(target)
+
+        state = [0] * self.num_real
+        back_edges = set()
+        for root in range(self.num_real):
+            if state[root] != 0:
+                continue
+            state[root] = 1
+            stack = [(root, iter(children[root]))]
+            while stack:
+                (node, remaining) = stack[-1]
+                advanced = False
+                for child in remaining:
+                    if state[child] == 0:
+                        state[child] = 1
+                        stack.append((child, iter(children[child])))
+                        advanced = True
+                        break
+                    elif state[child] == 1:
+                        back_edges.add((node, child))
+                if not advanced:
+                    state[node] = 2
+                    stack.pop()
+        return back_edges
+
+    def assign_ranks(self, reversed_edges):
+        """
+        Longest-path ranking over the acyclic version of the graph: every
+        node ends up one rank below the lowest of its parents.
+        """
+        children = [[] for idx in range(self.num_real)]
+        indegree = [0] * self.num_real
+        for (source, target) in self.edges:
+            if (source, target) in reversed_edges:
+                (source, target) = (target, source)
+            children[source].append(target)
+            indegree[target] += 1
+
+        ranks = [0] * self.num_real
+        queue = [idx for idx in range(self.num_real) if indegree[idx] == 0]
+        while queue:
+            node = queue.pop()
+            for child in children[node]:
+                if ranks[node] + 1 > ranks[child]:
+                    ranks[child] = ranks[node] + 1
+                indegree[child] -= 1
+                if indegree[child] == 0:
+                    queue.append(child)
+        self.ranks = ranks
+
+    def add_dummies(self, reversed_edges):
+        """
+        Splits every edge which spans more than one rank into a chain of
+        dummy nodes, one per rank, and sets up our initial per-rank
+        ordering.  self.chains ends up with the list of nodes each edge
+        passes through, in the original direction of the edge.
+        """
+        ranks = list(self.ranks)
+        widths = []
+        for pagenum in self.node_ids:
+            widths.append(len(self.nodes[pagenum]['label']) * LayeredLayout.CHAR_WIDTH + LayeredLayout.NODE_PADDING)
+
+        self.chains = []
+        for (source, target) in self.edges:
+            flipped = (source, target) in reversed_edges
+            if flipped:
+                (top, bottom) = (target, source)
+            else:
+                (top, bottom) = (source, target)
+            chain = [top]
+            for rank in range(ranks[top] + 1, ranks[bottom]):
+                chain.append(len(ranks))
+                ranks.append(rank)
+                widths.append(LayeredLayout.DUMMY_WIDTH)
+            chain.append(bottom)
+            if flipped:
+                chain.reverse()
+            self.chains.append((chain, flipped))
+
+        self.ranks = numpy.array(ranks, dtype=numpy.int64)
+        self.widths = numpy.array(widths, dtype=numpy.float64)
+
+        # Start off with each rank in page order, which tends to be a
+        # decent approximation of reading order.
+        num_ranks = int(self.ranks.max()) + 1 if len(ranks) > 0 else 0
+        order = numpy.argsort(self.ranks, kind='mergesort')
+        bounds = numpy.searchsorted(self.ranks[order], numpy.arange(num_ranks + 1))
+        self.layers = [order[bounds[rank]:bounds[rank+1]] for rank in range(num_ranks)]
+
+        # Edge segments between adjacent ranks, as (upper, lower) arrays
+        # grouped by the rank of the upper node.
+        uppers = [[] for rank in range(num_ranks)]
+        lowers = [[] for rank in range(num_ranks)]
+        for (chain, flipped) in self.chains:
+            if flipped:
+                chain = list(reversed(chain))
+            for (upper, lower) in zip(chain[:-1], chain[1:]):
+                uppers[ranks[upper]].append(upper)
+                lowers[ranks[upper]].append(lower)
+        self.segments = [(numpy.array(uppers[rank], dtype=numpy.int64),
+            numpy.array(lowers[rank], dtype=numpy.int64)) for rank in range(num_ranks)]
+
+    def layer_positions(self):
+        """
+        Returns an array holding each node's position within its rank
+        """
+        positions = numpy.zeros(len(self.ranks), dtype=numpy.float64)
+        for layer in self.layers:
+            positions[layer] = numpy.arange(len(layer))
+        return positions
+
+    def count_crossings(self, positions):
+        """
+        Counts the total number of edge crossings given the current
+        ordering, by counting inversions between each pair of ranks.
+        """
+        total = 0
+        for (upper, lower) in self.segments:
+            if len(upper) < 2:
+                continue
+            order = numpy.lexsort((positions[lower], positions[upper]))
+            lower_pos = positions[lower][order].astype(numpy.int64)
+
+            # Fenwick tree inversion count
+            size = int(lower_pos.max()) + 2
+            tree = [0] * (size + 1)
+            seen = 0
+            for pos in lower_pos.tolist():
+                idx = pos + 1
+                not_greater = 0
+                while idx > 0:
+                    not_greater += tree[idx]
+                    idx -= idx & (-idx)
+                total += seen - not_greater
+                seen += 1
+                idx = pos + 1
+                while idx <= size:
+                    tree[idx] += 1
+                    idx += idx & (-idx)
+        return total
+
+    def sweep(self, positions, rank, upper, lower, use_upper):
+        """
+        Reorders a single rank by the barycenter (average position) of
+        its neighbors in the adjacent rank.  Nodes with no neighbors
+        there just stay where they are.
+        """
+        layer = self.layers[rank]
+        if len(layer) < 2 or len(upper) == 0:
+            return
+        if use_upper:
+            (mine, theirs) = (lower, upper)
+        else:
+            (mine, theirs) = (upper, lower)
+        local = positions[mine].astype(numpy.int64)
+        sums = numpy.bincount(local, weights=positions[theirs], minlength=len(layer))
+        counts = numpy.bincount(local, minlength=len(layer))
+        barycenters = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), numpy.arange(len(layer)))
+        layer = layer[numpy.argsort(barycenters, kind='mergesort')]
+        self.layers[rank] = layer
+        positions[layer] = numpy.arange(len(layer))
+
+    def order_layers(self):
+        """
+        Crossing reduction.  Alternates downward and upward barycenter
+        sweeps, keeping whichever ordering had the fewest crossings.
+        """
+        positions = self.layer_positions()
+        best = self.count_crossings(positions)
+        best_layers = list(self.layers)
+        for sweep_num in range(self.order_passes):
+            if sweep_num % 2 == 0:
+                for rank in range(1, len(self.layers)):
+                    (upper, lower) = self.segments[rank-1]
+                    self.sweep(positions, rank, upper, lower, True)
+            else:
+                for rank in range(len(self.layers)-2, -1, -1):
+                    (upper, lower) = self.segments[rank]
+                    self.sweep(positions, rank, upper, lower, False)
+            crossings = self.count_crossings(positions)
+            if crossings < best:
+                best = crossings
+                best_layers = list(self.layers)
+        self.layers = best_layers
+        self.crossings = best
+
+    def assign_coordinates(self):
+        """
+        Assigns X coordinates.  Each rank starts out packed from the left,
+        and then we repeatedly pull each node towards the average X of its
+        neighbors, while keeping the rank in order with enough room
+        between each node.
+        """
+        x = numpy.zeros(len(self.ranks), dtype=numpy.float64)
+        separations = []
+        for layer in self.layers:
+            widths = self.widths[layer]
+            seps = numpy.zeros(len(layer))
+            seps[1:] = (widths[:-1] + widths[1:]) / 2.0 + LayeredLayout.NODE_GAP
+            cumulative = numpy.cumsum(seps)
+            x[layer] = cumulative
+            separations.append(cumulative)
+
+        # Neighbors in both directions, as flat arrays
+        if len(self.segments) > 0:
+            all_upper = numpy.concatenate([upper for (upper, lower) in self.segments])
+            all_lower = numpy.concatenate([lower for (upper, lower) in self.segments])
+        else:
+            all_upper = all_lower = numpy.zeros(0, dtype=numpy.int64)
+        ends = numpy.concatenate([all_upper, all_lower])
+        others = numpy.concatenate([all_lower, all_upper])
+        counts = numpy.bincount(ends, minlength=len(self.ranks))
+
+        for coord_pass in range(self.coord_passes):
+            sums = numpy.bincount(ends, weights=x[others], minlength=len(self.ranks))
+            desired = numpy.where(counts > 0, sums / numpy.maximum(counts, 1), x)
+            for (layer, cumulative) in zip(self.layers, separations):
+                wanted = desired[layer] - cumulative
+                # Closest positions which respect the spacing, pushing from
+                # the left and from the right, and then split the difference.
+                from_left = numpy.maximum.accumulate(wanted)
+                from_right = numpy.minimum.accumulate(wanted[::-1])[::-1]
+                x[layer] = (from_left + from_right) / 2.0 + cumulative
+
+        if len(x) > 0:
+            x -= (x - self.widths / 2.0).min()
+        self.x = x
+
+    def svg_node(self, pagenum, cx, cy, width):
+        """
+        Returns the SVG for a single node (a visited or unvisited page, or
+        one of the entries in the keys).
+        """
+        node = self.nodes[pagenum]
+        height = LayeredLayout.NODE_HEIGHT
+        lines = []
+        if node['visited']:
+            fill = svg_color(node['fillcolor'])
+            if node['canonical']:
+                lines.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="%s" stroke="black" stroke-width="2.5"/>' % (
+                    cx - width/2.0, cy - height/2.0, width, height, fill))
+            else:
+                lines.append('<ellipse cx="%.1f" cy="%.1f" rx="%.1f" ry="%.1f" fill="%s" stroke="black"/>' % (
+                    cx, cy, width/2.0, height/2.0, fill))
+            text = xml_escape(node['label'])
+        else:
+            lines.append('<ellipse cx="%.1f" cy="%.1f" rx="%.1f" ry="%.1f" fill="none" stroke="black"/>' % (
+                cx, cy, width/2.0, height/2.0))
+            text = '<tspan font-style="italic">(%s)</tspan>' % (xml_escape(node['label']))
+        lines.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-family="Times,serif" font-size="%d" fill="%s">%s</text>' % (
+            cx, cy + LayeredLayout.FONT_SIZE/3.0, LayeredLayout.FONT_SIZE, svg_color(node['fontcolor']), text))
+        return lines
+
+    def svg_key(self, title, entries, top):
+        """
+        Returns the SVG for a key box (character or shape key) whose top
+        edge is at the given Y position.  Entries are (label, fontcolor,
+        fillcolor, canonical) tuples.  Returns a tuple of the SVG lines
+        and the height of the box.
+        """
+        lines = []
+        height = LayeredLayout.NODE_HEIGHT
+        x = 20
+        cy = top + 50 + height/2.0
+        nodes = []
+        for (label, fontcolor, fillcolor, canonical) in entries:
+            width = len(label) * LayeredLayout.CHAR_WIDTH + LayeredLayout.NODE_PADDING
+            nodes.append((label, fontcolor, fillcolor, canonical, x + width/2.0, width))
+            x += width + LayeredLayout.NODE_GAP
+        lines.append('<rect x="10" y="%.1f" width="%.1f" height="%.1f" fill="#e5e5e5" stroke="none"/>' % (
+            top, x, height + 70))
+        lines.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-family="Times,serif" font-size="28">%s</text>' % (
+            10 + x/2.0, top + 34, xml_escape(title)))
+        for (label, fontcolor, fillcolor, canonical, cx, width) in nodes:
+            if canonical:
+                lines.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="%s" stroke="black" stroke-width="2.5"/>' % (
+                    cx - width/2.0, cy - height/2.0, width, height, svg_color(fillcolor)))
+            else:
+                lines.append('<ellipse cx="%.1f" cy="%.1f" rx="%.1f" ry="%.1f" fill="%s" stroke="black"/>' % (
+                    cx, cy, width/2.0, height/2.0, svg_color(fillcolor)))
+            lines.append('<text x="%.1f" y="%.1f" text-anchor="middle" font-family="Times,serif" font-size="%d" fill="%s">%s</text>' % (
+                cx, cy + LayeredLayout.FONT_SIZE/3.0, LayeredLayout.FONT_SIZE, svg_color(fontcolor), xml_escape(label)))
+        return (lines, height + 70)
+
+    def svg_lines(self):
+        """
+        Generates the SVG for our (already computed) layout, one line at
+        a time.  Colors and shapes match what we output for Graphviz.
+        """
+        book = self.book
+        height = LayeredLayout.NODE_HEIGHT
+
+        # Title and keys go up top
+        header = []
+        top = 10
+        header.append('<text x="20" y="%d" font-family="Times,serif" font-size="60">%s</text>' % (
+            top + 60, xml_escape(book.title)))
+        top += 90
+        entries = [(char.name, char.fontcolor, char.fillcolor, False) for char in book.characters_sorted()]
+        entries.append(('Ending Page', 'white', 'azure4', False))
+        (lines, key_height) = self.svg_key('Character Key', entries, top)
+        header.extend(lines)
+        top += key_height + 10
+        if any([node['canonical'] for node in self.nodes.values()]):
+            entries = [('Square = Canonical Choice', 'black', 'white', True),
+                ('Oval = Noncanonical Choice', 'black', 'white', False)]
+            (lines, key_height) = self.svg_key('Shape Key', entries, top)
+            header.extend(lines)
+            top += key_height + 10
+        top += 20
+
+        x = self.x + 20
+        y = top + height/2.0 + self.ranks * (height + LayeredLayout.RANK_GAP)
+        if len(x) > 0:
+            total_width = max(float((x + self.widths/2.0).max()) + 20, 600)
+            total_height = float(y.max()) + height/2.0 + 20
+        else:
+            total_width = 600
+            total_height = top
+
+        yield '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+        yield '<svg xmlns="http://www.w3.org/2000/svg" width="%dpt" height="%dpt" viewBox="0 0 %d %d">\n' % (
+            total_width, total_height, total_width, total_height)
+        yield '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="8" markerHeight="8" orient="auto"><path d="M0,0 L10,5 L0,10 z"/></marker></defs>\n'
+        yield '<rect width="100%" height="100%" fill="white"/>\n'
+        for line in header:
+            yield '%s\n' % (line)
+
+        # Edges first, so that nodes get drawn over the top of them
+        for (chain, flipped) in self.chains:
+            points = [(x[node], y[node]) for node in chain]
+            if flipped:
+                points[0] = (points[0][0], points[0][1] - height/2.0)
+                points[-1] = (points[-1][0], points[-1][1] + height/2.0)
+            else:
+                points[0] = (points[0][0], points[0][1] + height/2.0)
+                points[-1] = (points[-1][0], points[-1][1] - height/2.0)
+            yield '<path d="M%s" fill="none" stroke="black" marker-end="url(#arrow)"/>\n' % (
+                ' L'.join(['%.1f,%.1f' % point for point in points]))
+        for node in self.self_loops:
+            right = x[node] + self.widths[node]/2.0
+            yield '<path d="M%.1f,%.1f C%.1f,%.1f %.1f,%.1f %.1f,%.1f" fill="none" stroke="black" marker-end="url(#arrow)"/>\n' % (
+                right - 10, y[node] - height/2.0 + 4,
+                right + 30, y[node] - height,
+                right + 30, y[node] + height,
+                right - 10, y[node] + height/2.0 - 4)
+
+        for (idx, pagenum) in enumerate(self.node_ids):
+            for line in self.svg_node(pagenum, x[idx], y[idx], self.widths[idx]):
+                yield '%s\n' % (line)
+        yield '</svg>\n'
+
+class App(object):
+    """
+    Main mostly-interactive application.  This class probably knows too much
+    about the Book (and other) classes, and should probably abstract access to
+    that stuff a bit more, but whatever.
+    """
+
+    COLOR_CHOICES = ['none', 'light', 'dark']
+    COLOR_NONE = COLOR_CHOICES[0]
+    COLOR_LIGHT = COLOR_CHOICES[1]
+    COLOR_DARK = COLOR_CHOICES[2]
+
+    RENDER_CHOICES = ['png', 'svg', 'svgz', 'pdf', 'ps', 'gif']
+
+    # How often --watch checks the book file for changes, in seconds
+    WATCH_INTERVAL = 0.25
+
+    # Default number of hops around the center page for viewport graphs
+    VIEWPORT_RADIUS = 3
+
+    # Maximum number of search results to show
+    SEARCH_RESULTS = 25
+
+    # Default number of pages to show at a time when listing pages
+    LIST_SIZE = 40
+
+    # Default port for --serve
+    SERVE_PORT = 8016
+
+    def __init__(self, argv=None):
 
         self.book = None
+        self.engine = None
         self.cur_char = None
         self.cur_page = None
 
-        # Check to see if we have the colorama module loaded.  There's...
-        # probably a better way to do this?
+        # Colors are only set up once we know we're going interactive
+        # (see setup_color)
         self.has_colorama = False
-        try:
-            if colorama:
-                self.has_colorama = True
-                colorama.init(autoreset=True)
-        except NameError:
-            pass
+        self.color = App.COLOR_NONE
 
         # Parse arguments
         parser = argparse.ArgumentParser(description='Chooseable-Path Adventure Tracker',
@@ -521,23 +4358,153 @@ class App(object):
             type=str,
             metavar='DOTFILE',
             help='Output a graphviz DOT file instead of interactively editing')
-        if self.has_colorama:
-            color_help = 'Output colorization'
-        else:
-            color_help = 'Output colorization (REQUIRES COLORAMA)'
+        parser.add_argument('--center',
+            type=str,
+            metavar='PAGE',
+            help='Only graph the pages near this page when using --dot (see --radius)')
+        parser.add_argument('--radius',
+            type=int,
+            metavar='HOPS',
+            help='Only graph pages within this many choices of --center when using --dot (--center defaults to page 1)')
+        parser.add_argument('--by-character',
+            action='store_true',
+            help='With --dot or --watch, write a separate DOT file for each character\'s storyline (named after the DOT file and the character), with stubs where choices hand over to another character, and render them in parallel with the -t types')
+        parser.add_argument('--collapse',
+            action='store_true',
+            help='In Graphviz output, collapse runs of pages with only one way in and one way out into a single node')
+        parser.add_argument('--dot-odds',
+            action='store_true',
+            help='In Graphviz output, label each page with its chance of leading to an ending and the expected number of pages read from it (see --odds)')
+        parser.add_argument('-s', '--svg',
+            type=str,
+            metavar='SVGFILE',
+            help='Output an SVG graph using the built-in layout engine (no Graphviz required, but needs NumPy)')
+        parser.add_argument('-x', '--export',
+            type=str,
+            metavar='FILE',
+            help='Export the book graph to GraphML, GEXF, or node-link JSON (picked by the extension: %s) instead of interactively editing' % (
+                ', '.join(['.%s' % (ext) for ext in sorted(EXPORT_FORMATS.keys())])))
+        parser.add_argument('-w', '--watch',
+            action='store_true',
+            help='Watch the book file for changes, regenerating the DOT file (and renders) whenever it changes')
+        parser.add_argument('--debounce',
+            type=float,
+            default=0.5,
+            metavar='SECONDS',
+            help='How long the book file must be unchanged before --watch regenerates the graph')
+        parser.add_argument('-t', '--render',
+            type=str,
+            action='append',
+            choices=App.RENDER_CHOICES,
+            help='Graphviz output type to render in --watch mode (or with --dot and --by-character).  Can be specified more than once (defaults to svg)')
+        parser.add_argument('--full-layout',
+            action='store_true',
+            help='Always have Graphviz lay out the whole graph from scratch, rather than keeping pages where they were in the previous render')
+        parser.add_argument('--prefer-canon',
+            action='store_true',
+            help='When finding routes between pages, prefer canonical pages if there is more than one shortest route')
+        parser.add_argument('--check',
+            action='store_true',
+            help='Check books for structural problems (unreachable pages, reserved page numbers, etc) when loading them')
+        parser.add_argument('--diff',
+            type=str,
+            metavar='OTHER',
+            help='Show the differences between the book and another version of it, instead of interactively editing')
+        parser.add_argument('--merge',
+            type=str,
+            nargs=2,
+            metavar=('BASE', 'OTHER'),
+            help='Three-way merge the changes in OTHER (relative to BASE) into the book, instead of interactively editing')
+        parser.add_argument('-q', '--query',
+            type=str,
+            nargs='+',
+            metavar='QUERY',
+            help='Print the result of a query as JSON, instead of interactively editing.  One of: %s' % (
+                ', '.join([' '.join([name] + args) for (name, args) in sorted(BookEngine.QUERIES.items())])))
+        parser.add_argument('--report',
+            action='store_true',
+            help='Print a report on the shape of the book (choices per page, depth, per-character stats, etc) instead of interactively editing (requires NumPy, see also "--query report")')
+        parser.add_argument('--odds',
+            action='store_true',
+            help='Print the chances of a reader picking choices at random reaching an ending (or a dead end, or an unvisited page) from each page, and how many pages they would read, instead of interactively editing (see also "--query odds")')
+        parser.add_argument('--serve',
+            action='store_true',
+            help='Serve the book as an HTTP/JSON API on localhost instead of interactively editing (requires Python 3)')
+        parser.add_argument('--port',
+            type=int,
+            default=App.SERVE_PORT,
+            help='Port to listen on with --serve')
+        parser.add_argument('--save-delay',
+            type=float,
+            default=2,
+            metavar='SECONDS',
+            help='With --serve, how long to wait after a change before saving, so that bursts of changes are saved together')
+        parser.add_argument('--list-size',
+            type=int,
+            default=App.LIST_SIZE,
+            metavar='PAGES',
+            help='How many pages to show at a time when listing pages (0 to show them all at once)')
+        parser.add_argument('--string-table',
+            action='store_true',
+            help='Save the book in the more compact string-table format (books already in that format stay that way)')
+        parser.add_argument('-a', '--autosave',
+            type=float,
+            metavar='SECONDS',
+            help='Automatically save in the background after making changes, at most once every SECONDS')
         parser.add_argument('-c', '--color',
             type=str,
             choices=App.COLOR_CHOICES,
             default='dark',
-            help=color_help)
-        args = parser.parse_args()
+            help='Output colorization (requires colorama)')
+        args = parser.parse_args(argv)
 
         # Store the data we care about
         self.filename = args.filename
         self.do_dot = args.dot
-        if self.has_colorama:
+        self.do_svg = args.svg
+        self.do_export = args.export
+        self.collapse = args.collapse
+        self.by_character = args.by_character
+        self.dot_odds = args.dot_odds
+        self.autosave_interval = args.autosave
+        self.string_table = args.string_table
+        self.list_size = args.list_size
+        self.saver = BackgroundSaver()
+        self.renders = GraphvizJobs(incremental=not args.full_layout)
+        self.last_digest = None
+        self.last_autosave = 0
+        self.viewport_center = args.center
+        self.viewport_radius = args.radius
+        self.do_watch = args.watch
+        self.do_serve = args.serve
+        self.do_query = args.query
+        self.do_report = args.report
+        self.do_odds = args.odds
+        self.do_check = args.check
+        self.prefer_canon = args.prefer_canon
+        self.do_diff = args.diff
+        self.do_merge = args.merge
+        self.serve_port = args.port
+        self.save_delay = args.save_delay
+        self.debounce = args.debounce
+        self.render_requested = args.render is not None
+        if args.render:
+            self.render_types = args.render
+        else:
+            self.render_types = ['svg']
+        self.initial_color = args.color
+
+    def setup_color(self):
+        """
+        Loads colorama (if available) and sets our initial color palette.
+        This is only done for the interactive UI, so that non-interactive
+        runs don't have to pay for it.
+        """
+        if import_colorama():
+            self.has_colorama = True
+            colorama.init(autoreset=True)
             self.color = None
-            self.set_color(args.color)
+            self.set_color(self.initial_color)
         else:
             self.color = App.COLOR_NONE
             print('Output colorization disabled - "colorama" Python package')
@@ -864,10 +4831,7 @@ class App(object):
 
         # Before confirmation, make sure that the user is not active on
         # any pages.
-        pagelist = []
-        for page in self.book.pages_sorted():
-            if page.character == char:
-                pagelist.append(page.pagenum)
+        pagelist = [page.pagenum for page in self.book.character_pages_sorted(char.name)]
         if len(pagelist) > 0:
             print('')
             self.print_error('Character "%s" is the active character on the following pages:' % (char.name))
@@ -1043,7 +5007,7 @@ class App(object):
         """
         print('')
         summary = self.prompt('New Page Summary')
-        self.cur_page.summary = summary
+        self.cur_page.set_summary(summary)
         print('')
 
     def add_choice(self):
@@ -1110,6 +5074,71 @@ class App(object):
                 print('')
                 self.print_error('Choice with target of %s not found' % (target))
 
+    def search(self):
+        """
+        Searches page summaries (and the summaries of choices we haven't
+        followed yet) for some text.
+        """
+        print('')
+        query = self.prompt('Search for (enter to cancel)')
+        if query == '':
+            return
+
+        results = self.book.search(query, limit=App.SEARCH_RESULTS)
+        print('')
+        if len(results) == 0:
+            self.print_error('No matches found for "%s"' % (query))
+            return
+        self.print_result('Matches for "%s":' % (query))
+        for (score, result) in results:
+            if isinstance(result, Page):
+                print('  Page %s - %s (%s)' % (result.pagenum, result.summary, result.character.name))
+            else:
+                (page, choice) = result
+                print('  Page %s - %s (%sunvisited%s, from page %s)' % (choice.target, choice.summary,
+                    self.color_flags(), self.color_reset(), page.pagenum))
+
+    def route(self):
+        """
+        Shows the shortest sequence of choices which gets from the current
+        page (or page 1, if there's no way from here) to another page.
+        """
+        print('')
+        response = self.prompt('Route to page (enter to cancel)')
+        if response == '':
+            return
+        target = self.parse_pagenum(response)
+
+        source = self.cur_page.pagenum
+        route = self.book.route(source, target, prefer_canon=self.prefer_canon)
+        if route is None and source != 1:
+            route = self.book.route(1, target, prefer_canon=self.prefer_canon)
+            if route is not None:
+                print('')
+                self.print_result('No route from page %s, showing the route from page 1 instead' % (source))
+                source = 1
+        print('')
+        if route is None:
+            self.print_error('No route found to page %s' % (target))
+            return
+
+        if len(route) == 2:
+            plural = ''
+        else:
+            plural = 's'
+        self.print_result('Route from page %s to page %s (%d choice%s):' % (source, target, len(route) - 1, plural))
+        for (pagenum, next_pagenum) in zip(route, route[1:]):
+            page = self.book.pages[pagenum]
+            extratext = ''
+            if page.canonical:
+                extratext = ' (%sCANON%s)' % (self.color_flags(), self.color_reset())
+            print('  Page %s - %s%s' % (pagenum, page.summary, extratext))
+            print('    -> %s' % (page.choices[next_pagenum].summary))
+        if target in self.book.pages:
+            print('  Page %s - %s' % (target, self.book.pages[target].summary))
+        else:
+            print('  Page %s (%sunvisited%s)' % (target, self.color_flags(), self.color_reset()))
+
     def page_switch(self, pagenum=None):
         """
         Switches to a new page.  If the page already exists, we'll
@@ -1128,25 +5157,10 @@ class App(object):
                 # we're using text-based labels for everything in there, and we
                 # don't want to introduce syntax errors or double-define any
                 # nodes.
-                if ' ' in response:
-                    print('')
-                    self.print_error('Page numbers cannot contain spaces')
-                    return None
-                elif response[:5] == 'char_':
-                    print('')
-                    self.print_error('Page numbers cannot start with "char_"')
-                    return None
-                elif response[:7] == 'cluster':
-                    print('')
-                    self.print_error('Page numbers cannot start with "cluster"')
-                    return None
-                elif response[:5] == 'shape':
+                problem = check_pagenum(response)
+                if problem is not None:
                     print('')
-                    self.print_error('Page numbers cannot start with "shape"')
-                    return None
-                elif response == 'ending':
-                    print('')
-                    self.print_error('Page numbers cannot be "ending"')
+                    self.print_error(problem)
                     return None
                 pagenum = response
 
@@ -1248,47 +5262,77 @@ class App(object):
 
     def list_pages(self):
         """
-        Lists all the pages we know about, and also various statistics.
+        Lists the pages we know about (or the ones matching a filter, see
+        BookEngine.parse_listing_filter), a screenful at a time, and also
+        various statistics.
         """
 
-        char_counts = {}
-        ending_count = 0
-        canon_count = 0
+        print('')
+        response = self.prompt('Filter (enter for all pages, "?" for help)')
+        if response == '?':
+            print('')
+            print('Filters are made up of any of these, separated by spaces:')
+            print('  canon, noncanon, ending, nonending  - Only pages with (or without) those flags')
+            print('  unvisited, all                      - Only pages we haven\'t visited yet, or everything')
+            print('  char:NAME                           - Only the given character\'s pages (quote names with spaces)')
+            print('  10-50, 10-, -50                     - Only pages in that range')
+            print('  anything else                       - Text to look for in the page summaries')
+            print('')
+            response = self.prompt('Filter (enter for all pages)')
 
         # List our intermediate pages inline with the regular pages,
-        # because we can.
-        intermediates = self.book.intermediates_sorted()
-        cur_intermediate = 0
-
+        # because we can.  The listing is only worked through as far as
+        # we actually get, so stopping early on a big book is cheap.
         print('')
-        for page in self.book.pages_sorted():
-            # If we have intermediates that come before our page,
-            # output them now.
-            while ((cur_intermediate < len(intermediates)) and
-                (intermediates[cur_intermediate] < page.pagenum)):
-                    self.print_intermediates_line('%s - (intermediate page)' % (intermediates[cur_intermediate]))
-                    cur_intermediate += 1
-            if page.character.name not in char_counts:
-                char_counts[page.character.name] = 1
-            else:
-                char_counts[page.character.name] += 1
-            extratext = ''
-            if page.ending:
-                extratext = '%s - %sENDING%s' % (extratext, self.color_flags(), self.color_reset())
-                ending_count += 1
-            if page.canonical:
-                extratext = '%s - %sCANON%s' % (extratext, self.color_flags(), self.color_reset())
-                canon_count += 1
-            print('%s - %s (%s)%s' % (page.pagenum, page.summary, page.character.name, extratext))
-        for intermediate in intermediates[cur_intermediate:]:
-            self.print_intermediates_line('%s - (intermediate page)' % (intermediates[cur_intermediate]))
+        shown = 0
+        finished = True
+        try:
+            filters = BookEngine.parse_listing_filter(response)
+            for (pagenum, page) in self.engine.listing(**filters):
+                if self.list_size > 0 and shown > 0 and shown % self.list_size == 0:
+                    if self.prompt('Enter for more, "q" to stop').lower() == 'q':
+                        finished = False
+                        break
+                shown += 1
+                if page is None:
+                    if pagenum in self.book.intermediates:
+                        self.print_intermediates_line('%s - (intermediate page)' % (pagenum))
+                    else:
+                        print('%s - (%sunvisited%s)' % (pagenum, self.color_flags(), self.color_reset()))
+                    continue
+                extratext = ''
+                if page.ending:
+                    extratext = '%s - %sENDING%s' % (extratext, self.color_flags(), self.color_reset())
+                if page.canonical:
+                    extratext = '%s - %sCANON%s' % (extratext, self.color_flags(), self.color_reset())
+                print('%s - %s (%s)%s' % (page.pagenum, page.summary, page.character.name, extratext))
+        except BookError as e:
+            self.print_error(e.message)
+            print('')
+            return
+
+        # Statistics are for the whole book, so only bother with them when
+        # we're not filtering.
+        if len(filters) > 0:
+            print('')
+            if finished:
+                if shown == 1:
+                    plural = ''
+                else:
+                    plural = 's'
+                self.print_result('%d matching page%s' % (shown, plural))
+            print('')
+            return
+
         print('')
-        self.print_result('Total pages known: %d' % (len(self.book.pages)))
-        self.print_result('Canon Pages: %s' % (canon_count))
-        self.print_result('Ending Pages: %s' % (ending_count))
-        if len(self.book.intermediates) > 0:
-            self.print_result('Intermediate Pages: %s' % (len(self.book.intermediates)))
+        stats = self.engine.stats()
+        self.print_result('Total pages known: %d' % (stats['total_pages']))
+        self.print_result('Canon Pages: %s' % (stats['canon_pages']))
+        self.print_result('Ending Pages: %s' % (stats['ending_pages']))
+        if stats['intermediate_pages'] > 0:
+            self.print_result('Intermediate Pages: %s' % (stats['intermediate_pages']))
         self.print_result('Character Counts:')
+        char_counts = stats['character_counts']
         for (char, count) in [(name, char_counts[name]) for name in sorted(char_counts.keys())]:
             if count == 1:
                 plural = ''
@@ -1296,18 +5340,10 @@ class App(object):
                 plural = 's'
             self.print_result('  %s: %d page%s' % (char, count, plural))
 
-        # Also, what the heck.  Let's go ahead and make a list of all pages
-        # that we've MISSED in here.  Mostly useful for doublechecking things
-        # if you think you're basically done with the book.
-        missing = []
-        # This is ridiculous, but: unique real+intermediate pages, filtered
-        # to ensure that there's ony numeric entries, since we have non-
-        # numeric pages now.
-        pages = sorted([x for x in set(list(self.book.pages.keys()) + list(self.book.intermediates.keys())) if isinstance(x, int)])
-        last_page = pages[-1]
-        total_pages = list(range(1,last_page+1))
-        for page in reversed(pages):
-            del total_pages[page-1]
+        # Also, what the heck.  Let's go ahead and list all the pages that
+        # we've MISSED in here.  Mostly useful for doublechecking things if
+        # you think you're basically done with the book.
+        total_pages = stats['missing_pages']
         if len(total_pages) < 100:
             self.print_result('Missing pages: %d' % (len(total_pages)))
         if len(total_pages) != 0 and len(total_pages) < 30:
@@ -1318,11 +5354,43 @@ class App(object):
 
     def save(self):
         """
-        Saves out to our filename
+        Saves out to our filename.  The actual writing happens in the
+        background, and we'll report on how it went the next time the
+        main screen is drawn.
         """
 
-        self.book.save()
-        self.print_result('Saved to %s' % (self.book.filename))
+        self.last_digest = self.book.digest()
+        self.last_autosave = time.time()
+        self.saver.submit(self.book.get_savedict(), self.book.filename)
+        self.print_result('Saving to %s' % (self.book.filename))
+
+    def autosave(self):
+        """
+        Saves in the background if autosaving is turned on, enough time
+        has gone by since the last save, and the book has changed since
+        then (which the book digest tells us without building a savedict).
+        """
+        if self.autosave_interval is None:
+            return
+        if time.time() - self.last_autosave < self.autosave_interval:
+            return
+        digest = self.book.digest()
+        if digest == self.last_digest:
+            return
+        self.last_digest = digest
+        self.last_autosave = time.time()
+        self.saver.submit(self.book.get_savedict(), self.book.filename)
+
+    def report_saves(self):
+        """
+        Reports on any background saves which have finished since the
+        last time we checked.
+        """
+        for (filename, elapsed, error) in self.saver.pop_results():
+            if error is None:
+                self.print_result('Saved to %s (%0.2fs)' % (filename, elapsed))
+            else:
+                self.print_error('ERROR: Could not save to %s: %s' % (filename, error))
 
     def toggle_canonical(self):
         """
@@ -1348,14 +5416,21 @@ class App(object):
         print('')
         self.print_result('Book title changed to: %s' % (self.book.title))
 
+    def default_filename(self, extension):
+        """
+        Returns a default filename for an export of ours, based on the
+        book filename, using the given extension.
+        """
+        filename_parts = self.filename.split('.')
+        return '%s.%s' % (filename_parts[0], extension)
+
     def generate_graphviz(self):
         """
         User-requested generation of Graphviz DOT file.
         """
 
         # Construct our default filename to use
-        filename_parts = self.filename.split('.')
-        default_file = '%s.dot' % (filename_parts[0])
+        default_file = self.default_filename('dot')
 
         # Get a filename from the user
         print('')
@@ -1373,6 +5448,7 @@ class App(object):
         # Actually do the export, and try running graphviz to boot.
         if self.export_dot(filename):
             # Check for existence of 'dot' binary
+            import subprocess
             try:
                 with open(os.devnull, 'w') as df:
                     retval = subprocess.call(['dot', '-V'], stdout=df, stderr=df)
@@ -1381,6 +5457,17 @@ class App(object):
                 print('')
                 self.print_error('Graphviz "dot" executable not found, you will have to generate the PNG yourself')
                 print('')
+                if import_numpy() and self.prompt_yn('Generate SVG with the built-in renderer instead'):
+                    default_svg = '%s.svg' % (filename.split('.')[0])
+                    out_file = self.prompt('Filename for SVG output [%s]' % (default_svg))
+                    if out_file == '':
+                        out_file = default_svg
+                    if out_file == self.filename:
+                        print('')
+                        self.print_error('ERROR: Refusing to write SVG on top of book data YAML file.')
+                        return
+                    print('')
+                    self.export_svg(out_file)
                 return
 
             # Now ask if the user wants to output to PNG or SVG
@@ -1410,22 +5497,144 @@ class App(object):
                 if not response:
                     return 1
             print('')
-            self.print_result('Attempting to generate %s' % (out_file))
+            self.start_render(filename, out_file, extension)
+
+    def start_render(self, dot_filename, out_file, export_type):
+        """
+        Starts rendering the given dotfile with Graphviz in the background.
+        We'll report on how it went the next time the main screen is drawn.
+        """
+        uppercase = export_type.upper()
+        try:
+            (job, superseded) = self.renders.start(dot_filename, out_file, export_type)
+            if superseded is not None:
+                self.print_result('Cancelled older render of %s' % (out_file))
+            self.print_result('Generating %s in the background' % (out_file))
+        except OSError:
+            self.print_error('Graphviz "dot" executable not found, you will have to generate the %s yourself' % (uppercase))
+
+    def report_renders(self):
+        """
+        Reports on any background renders which have finished since the
+        last time we checked.
+        """
+        for job in self.renders.finished():
+            if job.retval == 0 and job.pinned:
+                if job.layout_file in self.renders.full_times:
+                    compared = ', vs %0.2fs for the last full layout' % (self.renders.full_times[job.layout_file])
+                else:
+                    compared = ''
+                self.print_result('%s generated to %s (%0.2fs, kept the previous layout and placed %d new node%s%s)' % (
+                    job.export_type.upper(), job.out_file, job.elapsed,
+                    job.new_nodes, '' if job.new_nodes == 1 else 's', compared))
+            elif job.retval == 0:
+                self.print_result('%s generated to %s (%0.2fs)' % (job.export_type.upper(), job.out_file, job.elapsed))
+            else:
+                self.print_error('Error generating %s, you will have to generate that yourself' % (job.out_file))
+
+    def export_svg(self, svg_filename):
+        """
+        Export our book to an SVG file using our built-in layout engine,
+        rather than Graphviz.
+        """
+
+        # Check to see if the filename exists already
+        if os.path.exists(svg_filename):
+            response = self.prompt_yn('File "%s" already exists.  Overwrite' % (svg_filename))
+            if not response:
+                return False
+
+        try:
+            start_time = time.time()
+            layout = LayeredLayout(self.book).run()
+            with open(svg_filename, 'w') as df:
+                for line in layout.svg_lines():
+                    df.write(line)
+        except Exception as e:
+            self.print_error('Could not generate SVG: %s' % (e))
+            return False
+
+        self.print_result('SVG saved as "%s" (%d crossings, %0.2fs)' % (
+            svg_filename, layout.crossings, time.time() - start_time))
+        return True
+
+    def parse_pagenum(self, response):
+        """
+        Converts user input into a page number: an int if it looks like
+        one, otherwise the string itself.
+        """
+        try:
+            return int(response)
+        except ValueError:
+            return response
+
+    def generate_viewport(self):
+        """
+        User-requested generation of a graph of just the pages around
+        the current page (or some other page), which is much quicker to
+        generate and easier to read than the whole book.
+        """
+
+        print('')
+        response = self.prompt('Center page [%s]' % (self.cur_page.pagenum))
+        if response == '':
+            center = self.cur_page.pagenum
+        else:
+            center = self.parse_pagenum(response)
+        if center not in self.book.pages:
+            print('')
+            self.print_error('Page %s not found!' % (center))
+            return
+
+        response = self.prompt('Number of choices to follow from page %s [%d]' % (center, App.VIEWPORT_RADIUS))
+        if response == '':
+            radius = App.VIEWPORT_RADIUS
+        else:
             try:
-                retval = subprocess.call(['dot', '-T%s' % (extension), filename, '-o', out_file])
+                radius = int(response)
+            except ValueError:
                 print('')
-                if retval == 0:
-                    self.print_result('%s generated to %s' % (uppercase, out_file))
-                else:
-                    self.print_error('Error generating %s, you will have to generate that yourself')
-            except OSError:
+                self.print_error('Please input a valid number!')
+                return
+
+        default_file = self.default_filename('page%s.dot' % (center))
+        filename = self.prompt('Filename for Graphviz DOT export [%s]' % (default_file))
+        if filename == '':
+            filename = default_file
+        if filename == self.filename:
+            print('')
+            self.print_error('ERROR: Refusing to write DOT file on top of book data YAML file.')
+            return
+
+        if self.export_viewport(filename, center, radius):
+            # Only swap out the last extension, so that "romeo.page5.dot"
+            # doesn't end up on top of the whole-book "romeo.svg"
+            out_file = '%s.svg' % (os.path.splitext(filename)[0])
+            if os.path.exists(out_file):
                 print('')
-                self.print_error('Graphviz "dot" executable not found, you will have to generate the %s yourself' % (uppercase))
+                if not self.prompt_yn('File "%s" already exists.  Overwrite' % (out_file)):
+                    return
+            print('')
+            self.start_render(filename, out_file, 'svg')
 
-    def export_dot(self, dot_filename):
+    def export_viewport(self, dot_filename, center, radius):
+        """
+        Export the pages within the given number of choices from the
+        center page to a Graphviz DOT file.
+        """
+        if center not in self.book.pages:
+            self.print_error('Page %s not found!' % (center))
+            return False
+        pagenums = self.book.neighborhood(center, radius)
+        self.print_result('Graphing %d pages within %d choices of page %s' % (len(pagenums), radius, center))
+        return self.export_dot(dot_filename, pagenums=pagenums,
+            title='%s (around page %s)' % (self.book.title, center))
+
+    def export_dot(self, dot_filename, pagenums=None, title=None):
         """
         Export our book to a Graphviz DOT file, using the
-        passed-in dot_filename.
+        passed-in dot_filename.  Pass in a set of page numbers
+        to only export those pages.
         """
 
         # Check to see if the filename exists already
@@ -1434,122 +5643,548 @@ class App(object):
             if not response:
                 return False
 
-        book = self.book
-        fileparts = dot_filename.split('.')
-        with open(dot_filename, 'w') as df:
-            df.write("digraph %s {\n" % (fileparts[0]))
-
-            # Put a big ol' label on the top
-            df.write("\n");
-            df.write("\tlabelloc=\"t\";\n");
-            df.write("\tfontsize=100;\n");
-            df.write("\tlabel=\"%s\";\n" % (book.title.replace('"', '\\"')))
-
-            # Set up a character key
-            df.write("\n")
-            df.write("\t// Character key\n")
-            charlist = book.characters_sorted()
-            for (idx, char) in enumerate(charlist):
-                df.write("\tchar_%d [label=\"%s\" fontsize=20 fontcolor=%s fillcolor=%s style=\"filled\"];\n" % (
-                        idx, char.name.replace('"', '\\"'), char.fontcolor, char.fillcolor,
-                    ))
-            df.write("\tending [label=\"Ending Page\" fontsize=20 fontcolor=white fillcolor=azure4 style=\"filled\"];\n");
-            df.write("\tsubgraph cluster_charkey {\n");
-            df.write("\t\tedge[style=invis];\n");
-            df.write("\t\tfontsize = 40;\n");
-            df.write("\t\tlabel = \"Character Key\";\n");
-            df.write("\t\tstyle = \"filled\";\n");
-            df.write("\t\tcolor = \"gray90\";\n");
-            df.write("\t\t%s -> ending;\n" % (' -> '.join(['char_%d' % (i) for i in range(len(charlist))])))
-            df.write("\t}\n");
-
-            # Aand a shape key
-            has_canon = False
-            for page in book.pages_sorted():
-                if page.canonical:
-                    has_canon = True
-                    break
-            if has_canon:
-                # No need to have a shape key if there's no canon pages
-                df.write("\n")
-                df.write("\t// Shape key\n");
-                df.write("\tshape_canon [label=\"Square = Canonical Choice\" shape=box fontsize=20 fontcolor=black fillcolor=white style=\"bold,filled\"];\n");
-                df.write("\tshape_regular [label=\"Oval = Noncanonical Choice\" fontcolor=black fontsize=20 fillcolor=white style=\"filled\"];\n");
-                df.write("\tsubgraph cluster_shapekey {\n");
-                df.write("\t\tedge[style=invis];\n");
-                df.write("\t\tfontsize = 40;\n");
-                df.write("\t\tlabel = \"Shape Key\";\n");
-                df.write("\t\tstyle = \"filled\";\n");
-                df.write("\t\tcolor = \"gray90\";\n");
-                df.write("\t\tshape_canon -> shape_regular;\n");
-                df.write("\t}\n");
-
-            # Set up a structure to hold page definitions simultaneously
-            # for pages we've visited, and pages we haven't.  That way
-            # the "known" path won't veer off the left so much, or at
-            # least if it does so it'll only be by chance instead of
-            # design.
-            all_pages = {}
-
-            # First up - Visited pages!
-            for page in book.pages_sorted():
-                labelstr = 'label="Page %s - %s"' % (
-                    page.pagenum,
-                    page.summary.replace('"', '\\"')
-                )
-                styles = ['filled']
-                if page.canonical:
-                    labelstr = '%s shape=box' % (labelstr)
-                    styles.append('bold')
-                if page.ending:
-                    labelstr = '%s fontcolor=white fillcolor=azure4' % (labelstr)
-                else:
-                    labelstr = '%s fontcolor=%s fillcolor=%s' % (labelstr,
-                        page.character.fontcolor,
-                        page.character.fillcolor)
-                if len(styles) > 0:
-                    labelstr = '%s style="%s"' % (labelstr, ','.join(styles))
-                all_pages[page.pagenum] = labelstr
-
-            # Unvisited pages
-            unknown_pages = {}
-            for page in book.pages_sorted():
-                for choice in page.choices_sorted():
-                    if choice.target not in book.pages:
-                        if choice.target in unknown_pages:
-                            print('NOTICE: Overwriting existing not-visited link for page %s' % (choice.target))
-                        unknown_pages[choice.target] = '(Page %s - %s)' % (choice.target, choice.summary.replace('>', '').replace('<', ''))
-            for (page, text) in unknown_pages.items():
-                all_pages[page] = 'label=<<i>%s</i>>' % (text)
-
-            # Now aggregate all our pages together
-            df.write("\n");
-            df.write("\t// Pages\n");
-            for pagenum in sorted(all_pages.keys(), key=sortkey_pages):
-                df.write("\t%s [%s];\n" % (pagenum, all_pages[pagenum]))
-
-            # Choices!
-            df.write("\n");
-            df.write("\t// Choices\n");
-            for page in book.pages_sorted():
-                for choice in page.choices_sorted():
-                    df.write("\t%s -> %s;\n" % (page.pagenum, choice.target))
-            df.write("\n");
-            df.write("}\n")
+        collapsed = self.engine.write_dot(dot_filename, pagenums=pagenums, title=title,
+            collapse=self.collapse, odds=self.dot_odds)
+        if collapsed is not None:
+            (chains, removed) = (collapsed['chains'], collapsed['removed'])
+            if 'nodes' in collapsed:
+                self.print_result('Collapsed %d chains: %d -> %d nodes, %d -> %d choices' % (
+                    chains, collapsed['nodes'], collapsed['nodes'] - removed,
+                    collapsed['choices'], collapsed['choices'] - removed))
+            else:
+                self.print_result('Collapsed %d chains, removing %d nodes and %d choices' % (
+                    chains, removed, removed))
 
         self.print_result('Graphviz dot file saved as "%s"' % (dot_filename))
         return True
 
+    def dot_targets(self, dot_filename):
+        """
+        Returns a list of the DOT files to write when asked for
+        dot_filename, as (filename, pagenums, title) tuples: just the one
+        for the whole book, or with --by-character, one for each
+        character's storyline (see BookEngine.character_pagenums), named
+        after dot_filename and the character.
+        """
+        if not self.by_character:
+            return [(dot_filename, None, None)]
+        dot_parts = dot_filename.split('.')
+        if len(dot_parts) > 1:
+            extension = '.'.join(dot_parts[1:])
+        else:
+            extension = 'dot'
+        targets = []
+        used = set()
+        for (name, pagenums) in self.engine.character_pagenums():
+            slug = re.sub(r'\W+', '_', name).strip('_').lower()
+            if slug == '' or slug in used:
+                slug = '%s_%d' % (slug or 'character', len(targets)+1)
+            used.add(slug)
+            targets.append(('%s_%s.%s' % (dot_parts[0], slug, extension), pagenums,
+                '%s (%s)' % (self.book.title, name)))
+        return targets
+
+    def export_characters(self, dot_filename):
+        """
+        Export each character's storyline to its own DOT file (see
+        dot_targets), then if any render types were asked for with -t,
+        render them all with Graphviz at once and wait for them to finish.
+        """
+        dot_files = []
+        for (filename, pagenums, title) in self.dot_targets(dot_filename):
+            if filename == self.filename:
+                self.print_error('ERROR: Refusing to write DOT file on top of book data YAML file.')
+                return False
+            if not self.export_dot(filename, pagenums=pagenums, title=title):
+                return False
+            dot_files.append(filename)
+        if not self.render_requested or len(dot_files) == 0:
+            return True
+
+        start_time = time.time()
+        try:
+            for filename in dot_files:
+                for export_type in self.render_types:
+                    out_file = '%s.%s' % (filename.split('.')[0], export_type)
+                    if out_file == self.filename:
+                        self.print_error('ERROR: Refusing to write %s on top of book data YAML file.' % (export_type.upper()))
+                        self.renders.cancel()
+                        return False
+                    self.renders.start(filename, out_file, export_type)
+        except OSError:
+            self.renders.cancel()
+            self.print_error('Graphviz "dot" executable not found, only the DOT files were generated')
+            return False
+        jobs = list(self.renders.jobs.values())
+        self.print_result('Rendering %d files in parallel' % (len(jobs)))
+        self.renders.wait()
+        self.report_renders()
+        self.print_result('All renders finished in %0.2fs' % (time.time() - start_time))
+        return all([job.retval == 0 for job in jobs])
+
+    def export_graph(self, filename):
+        """
+        Export our book to GraphML, GEXF, or JSON, depending on the
+        filename's extension (see BookEngine.write_export)
+        """
+        if filename == self.filename:
+            self.print_error('ERROR: Refusing to export on top of book data YAML file.')
+            return False
+        if os.path.exists(filename):
+            response = self.prompt_yn('File "%s" already exists.  Overwrite' % (filename))
+            if not response:
+                return False
+        try:
+            self.engine.write_export(filename)
+        except BookError as e:
+            self.print_error('ERROR: %s' % (e.message))
+            return False
+        self.print_result('Graph exported to "%s"' % (filename))
+        return True
+
+    def watch(self):
+        """
+        Non-interactive mode which keeps an eye on our book file and
+        regenerates the DOT file whenever it changes, rendering it with
+        Graphviz as well.  We just poll with stat() so that there's no
+        extra dependencies.  Changes are debounced so that a burst of
+        writes only triggers one regeneration, renders only happen when
+        the DOT content actually changed, and any renders still in
+        progress from an older change are cancelled.  With --by-character
+        there's a DOT file per character (see dot_targets), and only the
+        ones which changed get rendered again.  If the book's digest
+        hasn't changed, the DOT files aren't even generated.  Runs until
+        Ctrl-C.
+        """
+
+        if not os.path.exists(self.filename):
+            self.print_error('"%s" does not exist' % (self.filename))
+            return 1
+
+        if self.do_dot:
+            dot_filename = self.do_dot
+        else:
+            dot_filename = self.default_filename('dot')
+        if dot_filename == self.filename:
+            self.print_error('ERROR: Refusing to write DOT file on top of book data YAML file.')
+            return 1
+
+        def renders(dot_filename):
+            # The (export type, output file) pairs for a DOT file
+            dot_parts = dot_filename.split('.')
+            return [(export_type, '%s.%s' % (dot_parts[0], export_type)) for export_type in self.render_types]
+        for (export_type, out_file) in renders(dot_filename):
+            if out_file == self.filename:
+                self.print_error('ERROR: Refusing to write %s on top of book data YAML file.' % (export_type.upper()))
+                return 1
+
+        def file_signature():
+            # Inode is in here so that we notice files which have been
+            # replaced rather than written in-place.
+            try:
+                stat = os.stat(self.filename)
+                return (stat.st_mtime, stat.st_size, stat.st_ino)
+            except OSError:
+                return None
+
+        last_dots = {}
+        last_digest = None
+        have_dot = True
+        last_signature = file_signature()
+        changed_at = 0
+        self.print_result('Watching "%s" for changes, Ctrl-C to quit' % (self.filename))
+
+        try:
+            while True:
+
+                # Report on (and forget about) any finished renders
+                self.report_renders()
+
+                # Wait for the file to settle down before doing anything
+                if changed_at is not None and time.time() - changed_at >= self.debounce:
+                    changed_at = None
+                    try:
+                        self.set_book(self.load_book(self.filename))
+                        outputs = []
+                        # If the book's digest hasn't changed (someone's
+                        # just touched the file, say), neither has the graph.
+                        digest = self.book.digest()
+                        if digest != last_digest:
+                            for (out_dot, pagenums, title) in self.dot_targets(dot_filename):
+                                outputs.append((out_dot, ''.join(self.engine.dot_lines(out_dot.split('.')[0],
+                                    pagenums=pagenums, title=title, collapse=self.collapse, odds=self.dot_odds))))
+                            last_digest = digest
+                    except Exception as e:
+                        # Most likely the file's mid-write, or someone's made
+                        # a typo in there.  Either way we'll try again when
+                        # it next changes.
+                        self.print_error('Could not load "%s": %s' % (self.filename, e))
+                        outputs = None
+
+                    if outputs is None:
+                        changed = []
+                    else:
+                        changed = [(out_dot, dot_text) for (out_dot, dot_text) in outputs
+                            if last_dots.get(out_dot) != dot_text]
+                        if len(changed) == 0:
+                            self.print_result('Graph unchanged, not regenerating')
+
+                    for (out_dot, dot_text) in changed:
+                        last_dots[out_dot] = dot_text
+
+                        tmp_filename = '%s.tmp' % (out_dot)
+                        with open(tmp_filename, 'w') as df:
+                            df.write(dot_text)
+                        replace_file(tmp_filename, out_dot)
+                        self.print_result('Graphviz dot file saved as "%s"' % (out_dot))
+
+                        # Anything still rendering is out of date now, and
+                        # will get cancelled as the new renders start.
+                        if have_dot:
+                            try:
+                                for (export_type, out_file) in renders(out_dot):
+                                    if out_file == self.filename:
+                                        continue
+                                    (job, superseded) = self.renders.start(out_dot, out_file, export_type)
+                                    if superseded is not None:
+                                        self.print_result('Cancelled stale %s render' % (export_type.upper()))
+                            except OSError:
+                                self.print_error('Graphviz "dot" executable not found, only the DOT file will be generated')
+                                have_dot = False
+
+                time.sleep(App.WATCH_INTERVAL)
+                signature = file_signature()
+                if signature != last_signature:
+                    last_signature = signature
+                    changed_at = time.time()
+
+        except KeyboardInterrupt:
+            self.renders.cancel()
+            print('')
+            self.print_result('Done watching "%s"' % (self.filename))
+
+        return 0
+
+    def set_book(self, book):
+        """
+        Sets the book we're working on
+        """
+        if self.string_table:
+            book.string_table = True
+        self.book = book
+        self.engine = BookEngine(book)
+
+    def load_book(self, filename):
+        """
+        Loads a book, and checks it for problems if we've been asked to
+        (see lint_book).  Problems are reported one per line, as
+        "filename: page pagenum: code: message" (see format_problem).
+        """
+        engine = BookEngine.load(filename, check=self.do_check)
+        for (code, pagenum, message) in engine.problems:
+            self.print_error(format_problem(filename, code, pagenum, message))
+        return engine.book
+
+    def describe_entry(self, key):
+        """
+        Returns a human-readable description of a book_entries() key
+        """
+        if key[0] == 'title':
+            return 'Book title'
+        elif key[0] == 'character':
+            return 'Character "%s"' % (key[1])
+        elif key[0] == 'page' and len(key) == 2:
+            return 'Page %s' % (key[1])
+        elif key[0] == 'page':
+            return 'Page %s %s' % (key[1], key[2])
+        elif key[0] == 'choice':
+            return 'Page %s choice to %s' % (key[1], key[2])
+        else:
+            return 'Intermediate page %s' % (key[1])
+
+    def describe_value(self, key, value):
+        """
+        Returns a human-readable version of a book_entries() value
+        """
+        if value is None:
+            return '(none)'
+        elif key[0] == 'character':
+            return 'fill %s, font %s' % (value['graphviz_fillcolor'], value['graphviz_fontcolor'])
+        elif key[0] == 'page' and len(key) == 2:
+            flags = ''
+            if value['canonical']:
+                flags = '%s - CANON' % (flags)
+            if value['ending']:
+                flags = '%s - ENDING' % (flags)
+            return '(%s) - %s%s' % (value['character'], value['summary'], flags)
+        elif key[0] == 'intermediate':
+            return ''
+        elif isinstance(value, bool):
+            return str(value)
+        else:
+            return '"%s"' % (value)
+
+    def diff(self):
+        """
+        Non-interactive mode which shows the differences between our
+        book and another version of it.  Returns 0 if they're the same,
+        and 1 otherwise, like diff does.
+        """
+        old = self.load_book(self.filename)
+        new = self.load_book(self.do_diff)
+        changes = diff_books(old, new)
+        if len(changes) == 0:
+            self.print_result('No differences between "%s" and "%s"' % (self.filename, self.do_diff))
+            return 0
+
+        self.print_heading('Differences from "%s" to "%s":' % (self.filename, self.do_diff))
+        print('')
+        for (status, key, old_value, new_value) in changes:
+            if status == 'added':
+                text = self.describe_value(key, new_value)
+            elif status == 'removed':
+                text = self.describe_value(key, old_value)
+            else:
+                text = '%s -> %s' % (self.describe_value(key, old_value), self.describe_value(key, new_value))
+            print(('  %-8s %s %s' % (status, self.describe_entry(key), text)).rstrip())
+        print('')
+        self.print_result('%d difference%s' % (len(changes), '' if len(changes) == 1 else 's'))
+        return 1
+
+    def merge(self):
+        """
+        Non-interactive mode which three-way merges the changes from
+        another version of our book into it, given the version they both
+        started from.  The result is saved over our book.  Any conflicts
+        are reported and resolved in our favor, and we return 1 if there
+        were any (or 0 otherwise).  This makes us usable as a git merge
+        driver - see the README.
+        """
+        (base_filename, other_filename) = self.do_merge
+        ours = self.load_book(self.filename)
+        base = self.load_book(base_filename)
+        theirs = self.load_book(other_filename)
+        (book, conflicts) = merge_books(base, ours, theirs)
+        book.save(self.filename)
+
+        if len(conflicts) == 0:
+            self.print_result('Merged "%s" into "%s" with no conflicts' % (other_filename, self.filename))
+            return 0
+
+        self.print_error('Merged "%s" into "%s" with %d conflict%s, kept our version of:' % (
+            other_filename, self.filename, len(conflicts), '' if len(conflicts) == 1 else 's'))
+        print('')
+        for (key, base_value, our_value, their_value) in conflicts:
+            print('  %s' % (self.describe_entry(key)))
+            print('    base:   %s' % (self.describe_value(key, base_value)))
+            print('    ours:   %s' % (self.describe_value(key, our_value)))
+            print('    theirs: %s' % (self.describe_value(key, their_value)))
+        return 1
+
+    def serve(self):
+        """
+        Non-interactive mode which serves our book as an HTTP/JSON API on
+        localhost, until Ctrl-C.  See choosable_server.py for the details.
+        """
+
+        try:
+            import choosable_server
+        except SyntaxError:
+            self.print_error('ERROR: --serve requires Python 3')
+            return 1
+
+        if not os.path.exists(self.filename):
+            self.print_error('"%s" does not exist' % (self.filename))
+            return 1
+        self.set_book(self.load_book(self.filename))
+
+        def ready(port):
+            self.print_result('Serving "%s" on http://127.0.0.1:%d/, Ctrl-C to quit' % (self.book.title, port))
+
+        def log(line):
+            self.report_saves()
+            print(line)
+
+        server = choosable_server.BookServer(self.engine, self.saver,
+            save_delay=self.save_delay, log=log)
+        server.serve('127.0.0.1', self.serve_port, ready=ready)
+
+        print('')
+        self.saver.wait()
+        self.report_saves()
+        self.print_result('Done serving "%s"' % (self.filename))
+        return 0
+
+    def print_histogram(self, title, counts):
+        """
+        Prints a histogram (a list of counts) as a table with bars
+        """
+        print(title)
+        if len(counts) == 0:
+            return
+        biggest = max(counts)
+        for (value, count) in enumerate(counts):
+            if biggest > 0:
+                bar = '#' * int(round(40.0 * count / biggest))
+            else:
+                bar = ''
+            print(('  %6d %8d  %s' % (value, count, bar)).rstrip())
+        print('')
+
+    def report(self):
+        """
+        Non-interactive mode which prints a report on the shape of the
+        book (see graph_report)
+        """
+        if not os.path.exists(self.filename):
+            self.print_error('"%s" does not exist' % (self.filename))
+            return 1
+        self.set_book(self.load_book(self.filename))
+        try:
+            report = self.engine.report()
+        except BookError as e:
+            self.print_error('ERROR: %s' % (e.message))
+            return 1
+
+        self.print_heading('Report for "%s"' % (self.book.title))
+        print('')
+        print('Pages: %d visited, %d unvisited, %d choices' % (
+            report['pages'], report['unvisited'], report['choices']))
+        print('Pages with no choices: %d endings, %d dead ends' % (report['endings'], report['dead_ends']))
+        print('Pages which can\'t be reached from page 1: %d' % (report['unreachable']))
+        if report['canon_ratio'] is None:
+            ratio = 'n/a'
+        else:
+            ratio = '%0.2f' % (report['canon_ratio'])
+        print('Choices leading to canon pages: %d, to other pages: %d (ratio %s)' % (
+            report['canon_choices'], report['noncanon_choices'], ratio))
+        print('')
+        self.print_histogram('Choices per page (visited pages):', report['out_degree'])
+        self.print_histogram('Choices leading to each page:', report['in_degree'])
+        self.print_histogram('Shortest number of choices from page 1:', report['depth'])
+
+        print('%-20s %8s %8s %14s %11s %10s' % ('Character', 'Pages', 'Endings', 'Choices/page', 'Mean depth', 'Max depth'))
+        for name in sorted(report['characters'].keys()):
+            stats = report['characters'][name]
+            if stats['mean_depth'] is None:
+                (mean_depth, max_depth) = ('-', '-')
+            else:
+                (mean_depth, max_depth) = ('%0.1f' % (stats['mean_depth']), '%d' % (stats['max_depth']))
+            print('%-20s %8d %8d %14.2f %11s %10s' % (name, stats['pages'], stats['endings'],
+                stats['mean_choices'], mean_depth, max_depth))
+        print('')
+        return 0
+
+    def odds(self):
+        """
+        Non-interactive mode which prints the chances of a reader picking
+        choices at random finishing on an ending (and so on) from each
+        page, followed by where they'd finish from page 1 (see
+        BookEngine.page_odds and BookEngine.odds)
+        """
+        if not os.path.exists(self.filename):
+            self.print_error('"%s" does not exist' % (self.filename))
+            return 1
+        self.set_book(self.load_book(self.filename))
+
+        self.print_heading('Reading odds for "%s"' % (self.book.title))
+        print('')
+        print('%-10s %8s %9s %10s %8s %14s' % ('Page', 'Ending', 'Dead end', 'Unvisited', 'Never', 'Pages to read'))
+        for (pagenum, odds) in sorted(self.engine.page_odds().items(), key=lambda item: sortkey_pages(item[0])):
+            if odds['length'] is None:
+                never = max(0.0, 1.0 - odds['ending'] - odds['dead_end'] - odds['unvisited'])
+                length = '-'
+            else:
+                never = 0.0
+                length = '%0.1f' % (odds['length'])
+            print('%-10s %7.1f%% %8.1f%% %9.1f%% %7.1f%% %14s' % (pagenum, 100 * odds['ending'],
+                100 * odds['dead_end'], 100 * odds['unvisited'], 100 * never, length))
+        print('')
+
+        if 1 in self.book.pages:
+            odds = self.engine.odds(1)
+            print('Where a reading from page 1 finishes:')
+            for outcome in odds['outcomes']:
+                print('  %-10s %-10s %7.2f%%' % (outcome['pagenum'], outcome['type'].replace('_', ' '),
+                    100 * outcome['chance']))
+            if odds['never'] > 0:
+                print('  %-21s %7.2f%%' % ('(never finishes)', 100 * odds['never']))
+            print('')
+        return 0
+
+    def query(self):
+        """
+        Non-interactive mode which runs a single query against the book
+        (see BookEngine.query) and prints the result as JSON.
+        """
+        import json
+
+        if not os.path.exists(self.filename):
+            sys.stderr.write('"%s" does not exist\n' % (self.filename))
+            return 1
+
+        # Any problems found by --check go to stderr, to keep our output
+        # valid JSON.
+        self.engine = BookEngine.load(self.filename, check=self.do_check)
+        self.book = self.engine.book
+        for (code, pagenum, message) in self.engine.problems:
+            sys.stderr.write('%s\n' % (format_problem(self.filename, code, pagenum, message)))
+
+        try:
+            result = self.engine.query(self.do_query, prefer_canon=self.prefer_canon)
+        except BookError as e:
+            sys.stderr.write('%s\n' % (e.message))
+            return 1
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return 0
+
     def run(self):
         """
         Runs our actual app.  Should be exciting!
         """
 
         # First check if we're doing something non-interactive
-        if self.do_dot:
-            self.book = Book.load(self.filename)
-            return self.export_dot(self.do_dot)
+        if self.do_watch:
+            return self.watch()
+        if self.do_serve:
+            return self.serve()
+        if self.do_query:
+            return self.query()
+        if self.do_report:
+            return self.report()
+        if self.do_odds:
+            return self.odds()
+        if self.do_diff:
+            return self.diff()
+        if self.do_merge:
+            return self.merge()
+        if self.do_dot or self.do_svg or self.do_export:
+            self.set_book(self.load_book(self.filename))
+            retval = True
+            if self.do_dot and self.by_character:
+                retval = self.export_characters(self.do_dot)
+            elif self.do_dot and (self.viewport_center is not None or self.viewport_radius is not None):
+                if self.viewport_center is None:
+                    center = 1
+                else:
+                    center = self.parse_pagenum(self.viewport_center)
+                if self.viewport_radius is None:
+                    radius = App.VIEWPORT_RADIUS
+                else:
+                    radius = self.viewport_radius
+                retval = self.export_viewport(self.do_dot, center, radius)
+            elif self.do_dot:
+                retval = self.export_dot(self.do_dot)
+            if self.do_svg:
+                retval = self.export_svg(self.do_svg) and retval
+            if self.do_export:
+                retval = self.export_graph(self.do_export) and retval
+            if retval:
+                return 0
+            else:
+                return 1
         
+        self.setup_color()
         self.print_heading('Chooseable-Path Adventure Tracker')
         print('')
 
@@ -1565,7 +6200,7 @@ class App(object):
             if newtitle == '':
                 self.print_error('Cancelling book creation!')
                 return 1
-            self.book = Book(newtitle, filename=self.filename)
+            self.set_book(Book(newtitle, filename=self.filename))
 
             # Pick a character (which at this point would just create
             # a new character)
@@ -1583,7 +6218,7 @@ class App(object):
         else:
 
             # Load an existing book
-            self.book = Book.load(self.filename)
+            self.set_book(self.load_book(self.filename))
             self.set_page(1)
 
             self.print_result('Loaded Book "%s"' % (self.book.title))
@@ -1601,6 +6236,9 @@ class App(object):
         OPT_CANON = 't'
         OPT_ENDING = 'e'
         OPT_GRAPHVIZ = 'g'
+        OPT_VIEWPORT = 'v'
+        OPT_SEARCH = 'f'
+        OPT_ROUTE = 'w'
         OPT_INTERMEDIATE = 'i'
         OPT_INTER_DEL = 'o'
         OPT_COLOR = 'r'
@@ -1610,7 +6248,12 @@ class App(object):
             
             # Status display
             print('')
+            self.report_saves()
+            self.report_renders()
             self.print_heading((' %s ' % self.book.title).center(80, '='))
+            running = self.renders.running()
+            if len(running) > 0:
+                self.print_result('[Rendering in background: %s]' % (', '.join([job.out_file for job in running])))
             if self.cur_page.canonical:
                 self.print_flags('**** CANON ****')
             if self.cur_page.ending:
@@ -1631,6 +6274,10 @@ class App(object):
                             reports.append('CANON')
                         if remote_page.ending:
                             reports.append('ENDING')
+                        if len(remote_page.choices) > 0:
+                            (endings, unvisited) = self.book.reachable_counts(choice.target)
+                            reports.append('%d ending%s, %d unvisited page%s reachable' % (
+                                endings, '' if endings == 1 else 's', unvisited, '' if unvisited == 1 else 's'))
                     except KeyError:
                         pass
                     if len(reports) > 0:
@@ -1643,14 +6290,14 @@ class App(object):
                     OPT_PAGE, OPT_DELPAGE, OPT_LISTPAGE, OPT_SUMMARY))
             self.print_commands('[%s] Toggle Canonical [%s] Toggle Ending [%s] Change Book Title' % (
                     OPT_CANON, OPT_ENDING, OPT_BOOKTITLE))
-            self.print_commands('[%s] Add Intermediate [%s] Delete Intermediate' % (
-                    OPT_INTERMEDIATE, OPT_INTER_DEL))
+            self.print_commands('[%s] Add Intermediate [%s] Delete Intermediate [%s] Find [%s] Route to Page' % (
+                    OPT_INTERMEDIATE, OPT_INTER_DEL, OPT_SEARCH, OPT_ROUTE))
             if self.has_colorama:
                 extracommands = ' [%s] Swap Color Style' % (OPT_COLOR)
             else:
                 extracommands = ''
-            self.print_commands('[%s] Save [%s] Graphviz [%s] Quit%s' % (
-                    OPT_SAVE, OPT_GRAPHVIZ, OPT_QUIT, extracommands))
+            self.print_commands('[%s] Save [%s] Graphviz [%s] Graph Nearby Pages [%s] Quit%s' % (
+                    OPT_SAVE, OPT_GRAPHVIZ, OPT_VIEWPORT, OPT_QUIT, extracommands))
 
             # User input
             response = self.prompt('Action')
@@ -1662,7 +6309,7 @@ class App(object):
                 option = response.lower()
                 if option == OPT_CHAR:
                     self.pick_character()
-                    self.cur_page.character = self.cur_char
+                    self.cur_page.set_character(self.cur_char)
                 elif option == OPT_CHOICE:
                     self.add_choice()
                 elif option == OPT_DEL:
@@ -1675,12 +6322,18 @@ class App(object):
                     self.list_pages()
                 elif option == OPT_SUMMARY:
                     self.update_summary()
+                elif option == OPT_SEARCH:
+                    self.search()
+                elif option == OPT_ROUTE:
+                    self.route()
                 elif option == OPT_CANON:
                     self.toggle_canonical()
                 elif option == OPT_ENDING:
                     self.toggle_ending()
                 elif option == OPT_GRAPHVIZ:
                     self.generate_graphviz()
+                elif option == OPT_VIEWPORT:
+                    self.generate_viewport()
                 elif option == OPT_SAVE:
                     self.save()
                 elif option == OPT_INTERMEDIATE:
@@ -1695,11 +6348,19 @@ class App(object):
                     print('')
                     if self.prompt_yn('Save before quitting'):
                         self.save()
+                    self.saver.wait()
+                    self.report_saves()
+                    if len(self.renders.running()) > 0:
+                        self.print_result('Waiting for Graphviz to finish...')
+                        self.renders.wait()
+                    self.report_renders()
                     return 0
                 else:
                     print('')
                     self.print_error('Unknown option, try again!')
 
+            self.autosave()
+
         # Shouldn't be any way to get here, actually.
         return 0
         
@@ -0,0 +1,430 @@
+# vim: set expandtab tabstop=4 shiftwidth=4:
+#
+# Copyright (c) 2016, CJ Kucera
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the development team nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CJ KUCERA BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A small HTTP/JSON API over a loaded Book, used by "choosable.py --serve".
+# This lives in its own file because it needs Python 3 (asyncio), whereas
+# choosable.py itself still runs on Python 2.  Only the standard library
+# is used.  Note that we don't import choosable here - everything we need
+# is handed to us by the App, and we only ever talk to the book through
+# its BookEngine, which does all the real work.
+#
+# Endpoints (page numbers and choice targets are ints if they look like
+# one, otherwise strings):
+#
+#     GET    /book                        Title, characters, and statistics
+#     GET    /stats                       Statistics (see Book.statistics)
+#     GET    /frontier                    Choices leading to unvisited pages
+#     GET    /search?q=TEXT[&limit=N]     Search page/choice summaries
+#     GET    /pages                       All pages, without their choices
+#                                         (?filter=...&offset=N&limit=N for
+#                                         a page of a filtered listing)
+#     POST   /pages                       Create a page
+#     GET    /pages/NUM                   A single page, with its choices
+#     PATCH  /pages/NUM                   Update summary/character/canonical/ending
+#     DELETE /pages/NUM                   Delete a page
+#     GET    /pages/NUM/choices           The choices on a page
+#     POST   /pages/NUM/choices           Add a choice to a page
+#     DELETE /pages/NUM/choices/TARGET    Delete a choice from a page
+
+import json
+import asyncio
+import urllib.parse
+
+class HTTPError(Exception):
+    """
+    Raised by our handlers to send an error response back to the client
+    """
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+class BookServer(object):
+    """
+    Serves a Book over HTTP.  Every request which touches the book runs
+    while holding our lock, so concurrent clients can't step on each
+    other (or see a half-made change).  Changes aren't written out right
+    away - instead, the first change schedules a save for save_delay
+    seconds later, and everything which happens in the meantime goes out
+    along with it.  The actual writing happens in the given
+    BackgroundSaver's thread, so it doesn't hold up any requests.
+    """
+
+    # Largest request body we're willing to read, in bytes
+    MAX_BODY = 1024*1024
+
+    # How long to keep an idle keep-alive connection open, in seconds
+    IDLE_TIMEOUT = 60
+
+    # HTTP statuses for each kind of BookEngine error
+    ERROR_STATUS = {
+            'invalid': 400,
+            'not found': 404,
+            'conflict': 409,
+        }
+
+    STATUS_TEXT = {
+            200: 'OK',
+            201: 'Created',
+            400: 'Bad Request',
+            404: 'Not Found',
+            405: 'Method Not Allowed',
+            409: 'Conflict',
+            413: 'Payload Too Large',
+            500: 'Internal Server Error',
+        }
+
+    def __init__(self, engine, saver, save_delay=2, log=None):
+
+        self.engine = engine
+        self.book = engine.book
+        self.saver = saver
+        self.save_delay = save_delay
+        self.log = log
+
+        self.lock = None
+        self.save_handle = None
+        self.dirty = False
+
+        # The book's digest as of the last save (or loading it), so that
+        # we can tell if there's really anything to save
+        self.saved_digest = self.book.digest()
+        self.server = None
+        self.requests = 0
+
+        self.routes = [
+                (('book',), {'GET': self.get_book}),
+                (('stats',), {'GET': self.get_stats}),
+                (('frontier',), {'GET': self.get_frontier}),
+                (('search',), {'GET': self.get_search}),
+                (('pages',), {'GET': self.get_pages, 'POST': self.create_page}),
+                (('pages', None), {'GET': self.get_page, 'PATCH': self.update_page, 'DELETE': self.delete_page}),
+                (('pages', None, 'choices'), {'GET': self.get_choices, 'POST': self.add_choice}),
+                (('pages', None, 'choices', None), {'DELETE': self.delete_choice}),
+            ]
+
+    ###
+    ### Server management
+    ###
+
+    async def start(self, host, port):
+        """
+        Starts listening on the given host and port.  Pass port 0 to have
+        the OS pick one; the port we actually got is returned.
+        """
+        self.lock = asyncio.Lock()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stops listening, and gets any pending changes written out.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        self.flush()
+
+    def serve(self, host, port, ready=None):
+        """
+        Runs the server until interrupted.  If given, ready is called with
+        the port number once we're listening.
+        """
+        async def main():
+            port_used = await self.start(host, port)
+            if ready is not None:
+                ready(port_used)
+            try:
+                await self.server.serve_forever()
+            finally:
+                await self.stop()
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+        self.flush()
+
+    def changed(self):
+        """
+        Called after any change to the book, to schedule a save
+        """
+        self.dirty = True
+        if self.save_handle is None and self.book.filename is not None:
+            self.save_handle = asyncio.get_running_loop().call_later(self.save_delay, self.flush)
+
+    def flush(self):
+        """
+        Hands the book off to our saver if it's been changed since
+        the last time.
+        """
+        if self.save_handle is not None:
+            self.save_handle.cancel()
+            self.save_handle = None
+        if self.dirty and self.book.filename is not None:
+            self.dirty = False
+            # Changes which cancel each other out don't need saving
+            digest = self.book.digest()
+            if digest != self.saved_digest:
+                self.saved_digest = digest
+                self.saver.submit(self.book.get_savedict(), self.book.filename)
+
+    ###
+    ### HTTP handling
+    ###
+
+    async def handle_connection(self, reader, writer):
+        """
+        Handles a single client connection, which may make any number of
+        requests if it's using keep-alive.
+        """
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), BookServer.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                (status, body, keep_alive) = await self.handle_request(request_line, reader)
+                self.send_response(writer, status, body, keep_alive)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, request_line, reader):
+        """
+        Reads the rest of a request and dispatches it.  Returns a tuple of
+        (status, response data, keep-alive).
+        """
+        try:
+            (method, target, version) = request_line.decode('latin-1').split()
+        except ValueError:
+            return (400, {'error': 'Malformed request line'}, False)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (name, sep, value) = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = (connection == 'keep-alive')
+        else:
+            keep_alive = (connection != 'close')
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return (400, {'error': 'Invalid Content-Length'}, False)
+        if length > BookServer.MAX_BODY:
+            return (413, {'error': 'Request body too large'}, False)
+        body = None
+        if length > 0:
+            body = await reader.readexactly(length)
+
+        self.requests += 1
+        try:
+            async with self.lock:
+                (status, data) = self.dispatch(method, target, body)
+        except HTTPError as e:
+            (status, data) = (e.status, {'error': e.message})
+        except self.engine.Error as e:
+            (status, data) = (BookServer.ERROR_STATUS[e.kind], {'error': e.message})
+        except Exception as e:
+            (status, data) = (500, {'error': str(e)})
+        if self.log is not None:
+            self.log('%s %s %d' % (method, target, status))
+        return (status, data, keep_alive)
+
+    def send_response(self, writer, status, data, keep_alive):
+        """
+        Sends a JSON response back to the client
+        """
+        body = json.dumps(data).encode('utf-8')
+        if keep_alive:
+            connection = 'keep-alive'
+        else:
+            connection = 'close'
+        writer.write(('HTTP/1.1 %d %s\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n'
+            '\r\n' % (status, BookServer.STATUS_TEXT.get(status, ''), len(body), connection)).encode('latin-1'))
+        writer.write(body)
+
+    def dispatch(self, method, target, body):
+        """
+        Finds the handler for the given request and calls it.  Handlers
+        are passed the query string parameters, the decoded JSON body
+        (if any), and any page numbers from the path, and return a tuple
+        of (status, data).
+        """
+        url = urllib.parse.urlsplit(target)
+        parts = tuple([urllib.parse.unquote(part) for part in url.path.strip('/').split('/')])
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        for (pattern, methods) in self.routes:
+            if len(pattern) != len(parts):
+                continue
+            args = []
+            for (expected, part) in zip(pattern, parts):
+                if expected is None:
+                    args.append(self.parse_pagenum(part))
+                elif expected != part:
+                    break
+            else:
+                if method not in methods:
+                    raise HTTPError(405, 'Method %s not allowed on %s' % (method, url.path))
+                if body is not None:
+                    try:
+                        body = json.loads(body.decode('utf-8'))
+                    except ValueError:
+                        raise HTTPError(400, 'Request body is not valid JSON')
+                    if not isinstance(body, dict):
+                        raise HTTPError(400, 'Request body must be a JSON object')
+                else:
+                    body = {}
+                return methods[method](query, body, *args)
+
+        raise HTTPError(404, 'Unknown path %s' % (url.path))
+
+    ###
+    ### Helpers
+    ###
+
+    @staticmethod
+    def parse_pagenum(value):
+        """
+        Page numbers are ints if they look like one, otherwise strings
+        """
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if not isinstance(value, str) or value == '':
+            raise HTTPError(400, 'Invalid page number: %r' % (value,))
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    @staticmethod
+    def get_string(body, key):
+        """
+        Returns a required non-empty string from a request body
+        """
+        value = body.get(key)
+        if not isinstance(value, str) or value == '':
+            raise HTTPError(400, 'A non-empty "%s" string is required' % (key))
+        return value
+
+    ###
+    ### Read-only handlers
+    ###
+
+    def get_book(self, query, body):
+        return (200, self.engine.info())
+
+    def get_stats(self, query, body):
+        return (200, self.engine.stats())
+
+    def get_frontier(self, query, body):
+        return (200, self.engine.frontier())
+
+    def get_search(self, query, body):
+        if 'q' not in query:
+            raise HTTPError(400, 'The "q" parameter is required')
+        limit = None
+        if 'limit' in query:
+            try:
+                limit = int(query['limit'])
+            except ValueError:
+                raise HTTPError(400, 'Invalid limit: %s' % (query['limit']))
+        return (200, self.engine.search(query['q'], limit=limit))
+
+    def get_pages(self, query, body):
+        if 'filter' not in query and 'offset' not in query and 'limit' not in query:
+            return (200, self.engine.pages())
+        numbers = {}
+        for key in ['offset', 'limit']:
+            if key in query:
+                try:
+                    numbers[key] = int(query[key])
+                except ValueError:
+                    raise HTTPError(400, 'Invalid %s: %s' % (key, query[key]))
+        return (200, self.engine.list(query.get('filter', ''), **numbers))
+
+    def get_page(self, query, body, pagenum):
+        return (200, self.engine.page(pagenum))
+
+    def get_choices(self, query, body, pagenum):
+        return (200, self.engine.choices(pagenum))
+
+    ###
+    ### Handlers which change the book
+    ###
+
+    def create_page(self, query, body):
+        page = self.engine.create_page(self.parse_pagenum(body.get('pagenum')),
+            self.get_string(body, 'character'),
+            self.get_string(body, 'summary'),
+            canonical=bool(body.get('canonical', False)),
+            ending=bool(body.get('ending', False)))
+        self.changed()
+        return (201, page)
+
+    def update_page(self, query, body, pagenum):
+        fields = {}
+        for key in ['character', 'summary']:
+            if key in body:
+                fields[key] = self.get_string(body, key)
+        for key in ['canonical', 'ending']:
+            if key in body:
+                fields[key] = bool(body[key])
+        page = self.engine.update_page(pagenum, **fields)
+        self.changed()
+        return (200, page)
+
+    def delete_page(self, query, body, pagenum):
+        self.engine.delete_page(pagenum)
+        self.changed()
+        return (200, {'deleted': pagenum})
+
+    def add_choice(self, query, body, pagenum):
+        choice = self.engine.add_choice(pagenum, self.parse_pagenum(body.get('target')),
+            self.get_string(body, 'summary'))
+        self.changed()
+        return (201, choice)
+
+    def delete_choice(self, query, body, pagenum, target):
+        self.engine.delete_choice(pagenum, target)
+        self.changed()
+        return (200, {'deleted': target})